@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""
+Preprocesado y agregación de la base de datos de accidentes obtenida
+de CrashAPI.
+"""
+
+from __future__ import annotations
+
+#%% DEPENDENCIAS
+
+
+# Manejo de bases de datos
+import pandas as pd
+
+# Manejo de arrays
+import numpy as np
+
+# Para proteger el cubo de accidentes entre hilos
+import threading
+
+from crashdata import STATE_CODES, YEARS, METRIC_COLUMNS
+from instrumentation import RECORDER
+
+
+#%% PREPROCESADO DE LA BASE DE DATOS
+
+
+# Memoria objetivo por fila del dataframe preprocesado: 'statename' como
+# categoría (1 byte), 'year' int16 (2 bytes), 'month' y 'day' int8 (1 byte)
+# y las cuatro medidas de METRIC_COLUMNS como int16 (8 bytes)
+TARGET_BYTES_PER_ROW = 13
+
+
+def _parseDates(dates : pd.Series) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        Extrae día, mes y año de fechas tipo "dd/mm/yyyy hh:mm AM" en una
+        sola pasada vectorizada sobre los bytes de cada fecha. Las fechas
+        que no siguen el formato quedan como 0. El año se comprueba aparte:
+        si solo el día o el mes no son válidos, se conserva el año.
+        
+        dates : pd.Series      -> Columna 'crashdate' de CrashAPI.
+    """
+    
+    # Los 10 primeros caracteres contienen siempre la fecha completa
+    raw = dates.to_numpy(dtype = "S10")
+    chars = np.frombuffer(raw.tobytes(), dtype = np.uint8).reshape(len(raw), 10).astype(np.int16)
+    rows = np.arange(len(raw))
+    
+    # Posiciones de la primera y la segunda barra
+    slash = chars == ord("/")
+    first = slash.argmax(axis = 1)
+    slash[rows, first] = False
+    second = slash.argmax(axis = 1)
+    
+    def number(start : np.ndarray, stop : np.ndarray) -> np.ndarray:
+        value = np.zeros(len(raw), dtype = np.int16)
+        for offset in range(4):
+            position = np.minimum(start + offset, 9)
+            value = np.where(start + offset < stop, value * 10 + chars[rows, position] - ord("0"), value)
+        return value
+    
+    day = number(0, first)
+    month = number(first + 1, second)
+    year = number(second + 1, second + 5)
+    
+    # Descartar lo que no tiene el formato esperado, el año por separado
+    valid_year = (first > 0) & (second > first + 1) & (year >= 1000)
+    valid = valid_year & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    
+    return np.where(valid, day, 0), np.where(valid, month, 0), np.where(valid_year, year, 0)
+
+
+def preprocess(df : pd.DataFrame, counties : bool = False) -> pd.DataFrame:
+    """
+        Transforma un dataframe de pandas obtenido de CrashAPI 
+        que contiene una fecha tipo "dd/mm/yyyy hh:mm AM" en un nuevo dataframe
+        con la fecha separada en columnas enteras (year, month, day) y
+        eliminando datos irrelevantes. El dataframe original no se modifica.
+        
+        'statename' se guarda como categoría, y las fechas y las medidas de
+        METRIC_COLUMNS que tenga 'df' como enteros pequeños, ocupando
+        TARGET_BYTES_PER_ROW bytes por fila.
+        
+        df : pd.Dataframe      -> Dataframe obtenido de CrashAPI.
+                                    Se recomienda utilizar get_dataframe().
+        counties : bool        -> Conservar también 'countyname' (como categoría)
+                                    para groupCountAccidentsByCounty(). Necesita
+                                    pedir los datos con COUNTY_COLUMNS.
+    """
+    
+    with RECORDER.span("preprocess", rows = len(df)):
+        
+        # Transformar fechas y horas de string a columnas (year, month, day) como enteros
+        day, month, year = _parseDates(df["crashdate"])
+        
+        # Las fechas incompletas no se descartan, pero se cuentan
+        RECORDER.add("dates_without_day", int(((month == 0) & (year > 0)).sum()))
+        RECORDER.add("dates_without_year", int((year == 0).sum()))
+        
+        # Los estados conocidos primero para que las categorías coincidan entre años
+        names = list(dict.fromkeys([*STATE_CODES, *df["statename"].dropna().unique()]))
+        
+        # Solo se conservan el estado, la fecha y las medidas, y el condado si se pide
+        preprocessed = pd.DataFrame({"statename": pd.Categorical(df["statename"], categories = names),
+                                     "year": year.astype(np.int16),
+                                     "month": month.astype(np.int8),
+                                     "day": day.astype(np.int8)})
+        for metric in METRIC_COLUMNS:
+            if metric in df.columns:
+                preprocessed[metric] = df[metric].to_numpy(dtype = np.int16)
+        if counties:
+            preprocessed["countyname"] = pd.Categorical(df["countyname"])
+        
+        return preprocessed
+
+
+def bytesPerRow(df : pd.DataFrame) -> float:
+    """
+        Memoria ocupada por fila de un dataframe, contando el contenido
+        real de las columnas de texto. Permite comprobar que preprocess()
+        se mantiene en TARGET_BYTES_PER_ROW.
+        
+        df : pd.Dataframe      -> Dataframe a medir.
+    """
+    if len(df) == 0:
+        return 0.0
+    return df.memory_usage(index = False, deep = True).sum() / len(df)
+
+
+#%% AGRUPACIÓN DE LA BASE DE DATOS
+
+
+def _sumMetrics(df : pd.DataFrame, keys : list[str]) -> pd.DataFrame:
+    """
+        Número de accidentes ('accidents') y suma de cada medida de
+        METRIC_COLUMNS que tenga 'df', en una sola agrupación por 'keys'.
+    """
+    grouped = df.groupby(keys, observed = True)
+    metrics = [metric for metric in METRIC_COLUMNS if metric in df.columns]
+    
+    accident_count = grouped.size().to_frame("accidents")
+    if metrics:
+        accident_count = accident_count.join(grouped[metrics].sum().astype("int64"))
+    
+    return accident_count
+
+
+def _addRates(accident_count : pd.DataFrame) -> pd.DataFrame:
+    """
+        Añade la media por accidente de cada medida ('fatals_per_accident'...),
+        0 donde no hay accidentes.
+    """
+    accidents = accident_count["accidents"].to_numpy(dtype = np.float64)
+    for metric in METRIC_COLUMNS:
+        if metric in accident_count.columns:
+            accident_count[metric + "_per_accident"] = np.divide(accident_count[metric].to_numpy(dtype = np.float64), 
+                                                                 accidents, out = np.zeros_like(accidents), 
+                                                                 where = accidents > 0)
+    return accident_count
+
+
+def groupCountAccidents(df : pd.DataFrame) -> pd.DataFrame:
+    """
+        Transforma un dataframe de pandas obtenido de CrashAPI en
+        otro dataframe que agrupa las observaciones por estado y
+        las cuenta.
+        (se recomienda preprocesarlo primero con preprocess() )
+        
+        En la misma agrupación suma cada medida de METRIC_COLUMNS que
+        tenga el dataframe y calcula su media por accidente, así que el
+        resultado tiene todas las columnas de MEASURES: 'accidents',
+        'fatals', 'fatals_per_accident', 'peds'...
+        
+        df : pd.Dataframe      -> Dataframe obtenido de CrashAPI.
+                                    Se recomienda utilizar getDataframe()
+                                    y luego preprocess().
+    """
+    
+    with RECORDER.span("aggregate", rows = len(df)):
+        accident_count = _addRates(_sumMetrics(df, ["statename"]))
+        
+        # Índice de texto aunque 'statename' sea una categoría
+        accident_count.index = accident_count.index.astype(str)
+    
+    
+    return accident_count
+
+
+def groupCountAccidentsByYear(df : pd.DataFrame) -> pd.DataFrame:
+    """
+        Cuenta los accidentes de cada estado en cada año de un dataframe
+        con varios años (por ejemplo getDataframe(..., to_year = 2021)).
+        Devuelve una tabla con los estados como índice y los años como
+        columnas.
+        (el dataframe debe estar preprocesado con preprocess() )
+        
+        df : pd.Dataframe      -> Dataframe preprocesado de CrashAPI.
+    """
+    
+    with RECORDER.span("aggregate", rows = len(df), by_year = True):
+        accident_count = df.groupby(["statename", "year"], observed = True).size().unstack(fill_value = 0)
+        
+        # Índice de texto aunque 'statename' sea una categoría
+        accident_count.index = accident_count.index.astype(str)
+        accident_count.columns.name = None
+    
+    
+    return accident_count
+
+
+def _countyCodes(countynames : pd.Index) -> np.ndarray:
+    """
+        Código del condado dentro de su estado, que CrashAPI escribe entre
+        paréntesis al final del nombre: "LOS ANGELES (37)" -> 37.
+        -1 si no lo tiene.
+    """
+    codes = pd.Series(countynames.astype(str)).str.extract(r"\((\d+)\)\s*$", expand = False)
+    return codes.fillna(-1).astype(np.int64).to_numpy()
+
+
+def groupCountAccidentsByCounty(df : pd.DataFrame, months : list[int] = None) -> pd.DataFrame:
+    """
+        Cuenta los accidentes de cada condado. El índice es el código FIPS
+        de 5 cifras del condado ("06037"), el mismo que el campo GEOID de
+        los mapas de condados del censo, y las columnas son las mismas que
+        las de groupCountAccidents(), así que se clasifica igual.
+        (el dataframe debe estar preprocesado con preprocess(df, counties = True) )
+        
+        df : pd.Dataframe      -> Dataframe preprocesado de CrashAPI.
+        months : list[int]     -> Meses que contar (1 a 12). Por defecto todos.
+    """
+    
+    with RECORDER.span("aggregate", rows = len(df), counties = True):
+        if months is not None:
+            df = df[df["month"].isin(months)]
+        
+        # Se agrupa por nombre y solo se interpreta cada nombre distinto una vez
+        grouped = _sumMetrics(df, ["statename", "countyname"])
+        states = np.array([STATE_CODES.get(name, -1) for name in grouped.index.get_level_values(0)], dtype = np.int64)
+        counties = _countyCodes(grouped.index.get_level_values(1))
+        
+        keep = (states >= 0) & (counties >= 0)
+        geoids = pd.Index([str(state).zfill(2) + str(county).zfill(3) 
+                           for state, county in zip(states[keep], counties[keep])], name = "county")
+        
+        # Un mismo código puede aparecer con nombres escritos de distinta forma
+        accident_count = grouped[keep].set_axis(geoids)
+        accident_count = _addRates(accident_count.groupby(level = 0).sum())
+    
+    
+    return accident_count
+
+
+
+#%% CUBO DE ACCIDENTES
+
+
+# Nombre y posición en STATE_CODES de cada código de estado
+_STATE_NAMES = {code: name for name, code in STATE_CODES.items()}
+_STATE_POSITION = {code: i for i, code in enumerate(STATE_CODES.values())}
+
+class AccidentCube:
+    """
+        Recuento de accidentes por estado, año, mes y día en un array
+        denso de NumPy (int32) de forma (código de estado, año, mes, día),
+        que se va llenando a medida que llegan nuevos (estado, año). Los
+        accidentes con año pero sin día o mes válidos van a un decimotercer
+        mes, "desconocido", que solo cuenta cuando se piden todos los meses;
+        los que no tienen año válido no se pueden colocar y se cuentan en
+        RECORDER como "cube_rows_without_year".
+        Las consultas por meses, estaciones o días de la semana se
+        resuelven sumando cortes del array, sin volver a agrupar el
+        dataframe. Junto a los recuentos guarda, con la misma forma, la
+        suma de cada medida de METRIC_COLUMNS ('sums'), si el dataframe
+        las tiene.
+        
+        Con 12 años, los recuentos ocupan 57 códigos x 12 años x 13 meses
+        x 31 días x 4 bytes = 1,1 MB, y las sumas, una por cada una de las
+        4 medidas, otros 4,4 MB: unos 5,5 MB en total, más los arrays
+        auxiliares (unos KB).
+    """
+    
+    def __init__(self):
+        self.counts = np.zeros((max(STATE_CODES.values()) + 1, len(YEARS), 13, 31), dtype = np.int32)
+        self.sums = np.zeros((len(METRIC_COLUMNS),) + self.counts.shape, dtype = np.int32)
+        self.loaded = np.zeros(self.counts.shape[:2], dtype = bool)
+        self._lock = threading.Lock()
+        
+        # Día de la semana (0 lunes ... 6 domingo) de cada (año, mes, día), -1 si no existe
+        dates = (np.datetime64(str(YEARS[0]) + "-01") + np.arange(len(YEARS) * 12).astype("timedelta64[M]"))
+        first = dates.astype("datetime64[D]")
+        days = first[:, None] + np.arange(31).astype("timedelta64[D]")
+        weekdays = ((days.astype(np.int64) - 4) % 7).astype(np.int8)
+        in_month = days.astype("datetime64[M]") == dates[:, None]
+        self.weekdays = np.where(in_month, weekdays, -1).reshape(len(YEARS), 12, 31)
+        
+        # El mes desconocido no tiene días de la semana
+        self.weekdays = np.concatenate([self.weekdays, np.full((len(YEARS), 1, 31), -1, dtype = np.int8)], axis = 1)
+    
+    
+    @staticmethod
+    def _stateCodes(statenames : pd.Series) -> np.ndarray:
+        """
+            Código de STATE_CODES de cada fila, -1 si no se reconoce.
+        """
+        categories = statenames.astype("category").cat
+        lookup = np.array([STATE_CODES.get(name, -1) for name in categories.categories] + [-1], dtype = np.int16)
+        return lookup[categories.codes.to_numpy()]
+    
+    
+    def update(self, df : pd.DataFrame, states : list[int], years : list[int]):
+        """
+            Añade al cubo los (estado, año) de 'states' y 'years' que aún no
+            estén. Los que ya estaban se ignoran, así que se puede llamar
+            con cada dataframe obtenido sin contar nada dos veces.
+            
+            df : pd.Dataframe      -> Dataframe preprocesado con preprocess().
+            states : list[int]     -> Estados pedidos para obtener 'df'.
+            years : list[int]      -> Años pedidos para obtener 'df'.
+        """
+        
+        with self._lock, RECORDER.span("aggregate", rows = len(df), cube = True):
+            wanted = np.zeros_like(self.loaded)
+            for code in states:
+                for year in years:
+                    if year in YEARS and not self.loaded[code, year - YEARS[0]]:
+                        wanted[code, year - YEARS[0]] = True
+            
+            if not wanted.any():
+                return
+            
+            state = self._stateCodes(df["statename"])
+            year = df["year"].to_numpy().astype(np.int64) - YEARS[0]
+            month = df["month"].to_numpy().astype(np.int64) - 1
+            day = df["day"].to_numpy().astype(np.int64) - 1
+            
+            # Sin día ni mes, al mes desconocido
+            unknown = (month < 0) | (day < 0)
+            month[unknown] = 12
+            day[unknown] = 0
+            
+            # Solo las filas con año válido de los (estado, año) nuevos
+            in_years = (year >= 0) & (year < len(YEARS))
+            RECORDER.add("cube_rows_without_year", int((~in_years & (df["year"].to_numpy() == 0)).sum()))
+            keep = (state >= 0) & in_years
+            keep[keep] = wanted[state[keep], year[keep]]
+            
+            flat = np.ravel_multi_index((state[keep], year[keep], month[keep], day[keep]), self.counts.shape)
+            self.counts += np.bincount(flat, minlength = self.counts.size).reshape(self.counts.shape).astype(np.int32)
+            
+            # Las medidas, con las mismas posiciones ya calculadas
+            for i, metric in enumerate(METRIC_COLUMNS):
+                if metric in df.columns:
+                    weights = df[metric].to_numpy()[keep]
+                    self.sums[i] += np.bincount(flat, weights = weights, 
+                                                minlength = self.counts.size).reshape(self.counts.shape).astype(np.int32)
+            
+            self.loaded |= wanted
+    
+    
+    def covers(self, states : list[int], years : list[int]) -> bool:
+        """
+            Indica si todos los (estado, año) pedidos ya están en el cubo.
+        """
+        with self._lock:
+            return all(year in YEARS and self.loaded[code, year - YEARS[0]] for code in states for year in years)
+    
+    
+    def _slice(self, states : list[int], years : list[int], months : list[int] = None, 
+               array : np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+            Corte del cubo (o de 'array', con su misma forma, como una de
+            las sumas de 'sums') para los estados, años y meses pedidos,
+            junto con los días de la semana correspondientes.
+        """
+        year_index = np.asarray(years, dtype = np.int64) - YEARS[0]
+        # Todos los meses incluyen el desconocido (índice 12)
+        month_index = np.arange(13) if months is None else np.asarray(months, dtype = np.int64) - 1
+        array = self.counts if array is None else array
+        
+        with self._lock:
+            counts = array[np.ix_(np.asarray(states, dtype = np.int64), year_index, month_index)]
+        
+        return counts, self.weekdays[np.ix_(year_index, month_index)]
+    
+    
+    @staticmethod
+    def _byState(states : list[int], values : np.ndarray, columns : list) -> pd.DataFrame:
+        """
+            Dataframe con el formato de groupCountAccidents(): índice
+            'statename' en el orden de STATE_CODES y sin estados vacíos.
+            
+            states : list[int]     -> Estados de cada fila de 'values'.
+            values : np.ndarray    -> Recuentos de forma (estados, columnas).
+            columns : list         -> Nombres de las columnas.
+        """
+        order = sorted(range(len(states)), key = lambda i: _STATE_POSITION[states[i]])
+        values = values[order] if values.dtype.kind == "f" else values[order].astype("int64")
+        
+        accident_count = pd.DataFrame(values, columns = columns,
+                                      index = pd.Index([_STATE_NAMES[states[i]] for i in order], name = "statename"))
+        return accident_count[accident_count.sum(axis = 1) > 0]
+    
+    
+    def count(self, states : list[int], years : list[int], months : list[int] = None) -> pd.DataFrame:
+        """
+            Accidentes de cada estado sumando los años y meses elegidos,
+            con el mismo formato que groupCountAccidents(): el recuento,
+            la suma de cada medida y su media por accidente.
+            
+            states : list[int]     -> Estados según STATE_CODES.
+            years : list[int]      -> Años que sumar.
+            months : list[int]     -> Meses que sumar (1 a 12). Por defecto todos.
+        """
+        states = list(dict.fromkeys(states))
+        
+        values = [self._slice(states, years, months, array)[0].sum(axis = (1, 2, 3)) 
+                  for array in (self.counts, *self.sums)]
+        
+        return _addRates(self._byState(states, np.stack(values, axis = 1), ["accidents"] + METRIC_COLUMNS))
+    
+    
+    def countByYear(self, states : list[int], years : list[int], months : list[int] = None, 
+                    column : str = "accidents") -> pd.DataFrame:
+        """
+            Accidentes de cada estado en cada año, con el mismo formato
+            que groupCountAccidentsByYear(). Con 'column' se obtiene en su
+            lugar la suma de una medida de METRIC_COLUMNS o su media por
+            accidente ("fatals_per_accident"...), como en count().
+        """
+        states = list(dict.fromkeys(states))
+        counts = self._slice(states, years, months)[0].sum(axis = (2, 3))
+        
+        if column != "accidents":
+            metric = column.removesuffix("_per_accident")
+            sums = self._slice(states, years, months, self.sums[METRIC_COLUMNS.index(metric)])[0].sum(axis = (2, 3))
+            if metric == column:
+                counts = sums
+            else:
+                counts = np.divide(sums, counts, out = np.zeros(counts.shape), where = counts > 0)
+        
+        return self._byState(states, counts, list(years))
+    
+    
+    def weekdayWeekend(self, states : list[int], years : list[int], months : list[int] = None) -> pd.DataFrame:
+        """
+            Accidentes de cada estado en días laborables (lunes a viernes)
+            y en fin de semana.
+        """
+        states = list(dict.fromkeys(states))
+        counts, weekdays = self._slice(states, years, months)
+        
+        weekday = (counts * ((weekdays >= 0) & (weekdays < 5))).sum(axis = (1, 2, 3))
+        weekend = (counts * (weekdays >= 5)).sum(axis = (1, 2, 3))
+        
+        return self._byState(states, np.stack([weekday, weekend], axis = 1), ["laborables", "fin de semana"])
@@ -0,0 +1,522 @@
+# -*- coding: utf-8 -*-
+"""
+Medición del rendimiento de cada etapa del visualizador (descarga,
+preprocesado, agrupación y dibujado) contra un servidor local que imita
+a CrashAPI con datos sintéticos, para poder comparar resultados entre
+versiones sin depender de la red.
+"""
+
+from __future__ import annotations
+
+#%% DEPENDENCIAS
+
+
+# Servidor HTTP local
+import gzip
+import hashlib
+import threading
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Medición y resultados
+import sys
+import time
+import tempfile
+import statistics
+from contextlib import contextmanager
+
+# Datos sintéticos
+import numpy as np
+import pandas as pd
+
+import crashdata
+from crashdata import STATE_CODES, YEARS, TokenBucket, CrashCache, BatchSizer
+
+
+#%% DATOS SINTÉTICOS
+
+
+# Columnas del CSV de GetCaseList, en el orden en que las devuelve CrashAPI
+CSV_COLUMNS = ["st_case", "statename", "countyname", "state", "crashdate",
+               "totalvehicles", "fatals", "peds", "persons"]
+
+_STATE_NAMES = {code: name for name, code in STATE_CODES.items()}
+
+
+def syntheticRows(state : int, year : int, rows : int, seed : int = 0) -> bytes:
+    """
+        Filas CSV (sin cabecera) de accidentes inventados de un estado y
+        un año, con el mismo formato que CrashAPI. Siempre devuelve las
+        mismas filas para los mismos argumentos.
+        
+        state : int            -> Código del estado según STATE_CODES.
+        year : int             -> Año de los accidentes.
+        rows : int             -> Número de accidentes.
+        seed : int             -> Semilla de los datos aleatorios.
+    """
+    
+    rng = np.random.default_rng([seed, state, year])
+    
+    day = rng.integers(1, 29, rows)
+    month = rng.integers(1, 13, rows)
+    hour = rng.integers(1, 13, rows)
+    minute = rng.integers(0, 60, rows)
+    county = rng.integers(1, 100, rows)
+    
+    df = pd.DataFrame({
+        "st_case": state * 10000 + np.arange(rows),
+        "statename": _STATE_NAMES[state],
+        "countyname": ["COUNTY " + str(c) + " (" + str(c) + ")" for c in county],
+        "state": state,
+        "crashdate": [str(d) + "/" + str(m) + "/" + str(year) + " " + str(h) + ":" + str(mi).zfill(2) + " " +
+                      ("AM" if h % 2 else "PM") for d, m, h, mi in zip(day, month, hour, minute)],
+        "totalvehicles": rng.integers(1, 7, rows),
+        "fatals": rng.integers(1, 4, rows),
+        "peds": rng.integers(0, 3, rows),
+        "persons": rng.integers(1, 9, rows),
+    }, columns = CSV_COLUMNS)
+    
+    return df.to_csv(index = False, header = False).encode()
+
+
+#%% SERVIDOR SUSTITUTO DE CRASHAPI
+
+
+class StandInServer:
+    """
+        Servidor HTTP local que responde como el endpoint
+        /CrashAPI/crashes/GetCaseList de CrashAPI (formato csv) con datos
+        sintéticos. Se puede usar desde getDataframe() cambiando
+        crashdata.CRASHAPI_URL por StandInServer.url. Mantiene las
+        conexiones abiertas (HTTP/1.1), comprime con gzip si se pide y
+        responde 304 a las peticiones condicionales de datos sin cambios.
+        
+        rows_per_state : int   -> Accidentes de cada estado en cada año.
+        latency : float        -> Segundos de espera antes de cada respuesta.
+        rate : float           -> Peticiones por segundo admitidas. Las que
+                                    lo superan reciben un 429, como la API
+                                    real. None para no limitar.
+        capacity : int         -> Ráfaga máxima de peticiones si hay 'rate'.
+        seed : int             -> Semilla de los datos sintéticos.
+        port : int             -> Puerto. 0 para elegir uno libre.
+        max_rows : int         -> Filas máximas por respuesta. Las respuestas
+                                    más largas se cortan sin avisar, como
+                                    hace la API real. None para no cortar.
+    """
+    
+    def __init__(self, rows_per_state : int = 700, latency : float = 0.0, rate : float = None,
+                 capacity : int = 5, seed : int = 0, port : int = 0, max_rows : int = None):
+        
+        self.rows_per_state = rows_per_state
+        self.max_rows = max_rows
+        self.latency = latency
+        self.seed = seed
+        self.limiter = None if rate is None else TokenBucket(rate, capacity)
+        
+        # Estadísticas de uso
+        self.requests = 0
+        self.throttled = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        
+        # Filas ya generadas por (estado, año), y respuestas completas ya
+        # preparadas, para no medir la generación
+        self._rows = dict()
+        self._responses = dict()
+        self._lock = threading.Lock()
+        
+        # Fecha de "modificación" de todos los datos
+        self.last_modified = formatdate(time.time(), usegmt = True)
+        
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+    
+    
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:" + str(self._httpd.server_port) + "/CrashAPI"
+    
+    
+    def _csv(self, states : list[int], from_year : int, to_year : int) -> bytes:
+        """
+            Respuesta completa, con cabecera, de una petición.
+        """
+        parts = [(",".join(CSV_COLUMNS) + "\n").encode()]
+        for year in range(from_year, to_year + 1):
+            for state in states:
+                with self._lock:
+                    if (state, year) not in self._rows:
+                        self._rows[(state, year)] = syntheticRows(state, year, self.rows_per_state, self.seed)
+                    parts.append(self._rows[(state, year)])
+        body = b"".join(parts)
+        
+        if self.max_rows is not None:
+            lines = body.split(b"\n", self.max_rows + 1)
+            body = b"\n".join(lines[:self.max_rows + 1]) + (b"\n" if len(lines) > self.max_rows + 1 else b"")
+        return body
+    
+    
+    def _response(self, states : list[int], from_year : int, to_year : int) -> tuple[str, bytes, bytes]:
+        """
+            ETag, cuerpo y cuerpo comprimido con gzip de una petición.
+        """
+        key = (tuple(states), from_year, to_year)
+        if key not in self._responses:
+            body = self._csv(states, from_year, to_year)
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            self._responses[key] = (etag, body, gzip.compress(body, compresslevel = 5))
+        return self._responses[key]
+    
+    
+    def _handler(self):
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            
+            # Conexiones persistentes
+            protocol_version = "HTTP/1.1"
+            
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+            
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                
+                with server._lock:
+                    server.requests += 1
+                
+                if server.limiter is not None and server.limiter.tryAcquire() > 0:
+                    with server._lock:
+                        server.throttled += 1
+                    self.send_error(429, "Too Many Requests")
+                    return
+                
+                try:
+                    if not url.path.endswith("/crashes/GetCaseList"):
+                        raise KeyError
+                    states = [int(state) for state in query["states"][0].split(",")]
+                    from_year = int(query["fromYear"][0])
+                    to_year = int(query["toYear"][0])
+                    if any(state not in _STATE_NAMES for state in states):
+                        raise ValueError
+                except (KeyError, ValueError):
+                    self.send_error(400, "Bad Request")
+                    return
+                
+                etag, body, compressed = server._response(states, from_year, to_year)
+                
+                if server.latency:
+                    time.sleep(server.latency)
+                
+                if self.headers.get("If-None-Match") == etag:
+                    with server._lock:
+                        server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Last-Modified", server.last_modified)
+                    self.end_headers()
+                    return
+                
+                self.send_response(200)
+                self.send_header("Content-Type", "text/csv")
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", server.last_modified)
+                if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+                    body = compressed
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                
+                with server._lock:
+                    server.bytes_sent += len(body)
+            
+            def log_message(self, format, *args):
+                # Sin una línea por petición en la consola
+                pass
+        
+        return Handler
+    
+    
+    def start(self) -> StandInServer:
+        self._thread = threading.Thread(target = self._httpd.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+    
+    
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+    
+    
+    def __enter__(self) -> StandInServer:
+        return self.start()
+    
+    
+    def __exit__(self, *exc):
+        self.stop()
+    
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "throttled": self.throttled, "not_modified": self.not_modified,
+                    "bytes": self.bytes_sent, "connections": self.connections}
+
+
+#%% MEDICIÓN POR ETAPAS
+
+
+def _measure(function, repeat : int, setup = None) -> dict:
+    """
+        Ejecuta 'function' 'repeat' veces y devuelve los tiempos en
+        milisegundos. 'setup', si se indica, se ejecuta antes de cada
+        medición sin contar en el tiempo.
+    """
+    times = list()
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        clock = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - clock) * 1000)
+    
+    return {"min_ms": round(min(times), 2),
+            "median_ms": round(statistics.median(times), 2),
+            "runs_ms": [round(t, 2) for t in times]}
+
+
+def runBenchmarks(states : list[int] = None, year : int = 2014, rows_per_state : int = 700,
+                  latency : float = 0.05, rate : float = None, repeat : int = 3,
+                  request_together : int = 5) -> dict:
+    """
+        Mide por separado cada etapa del visualizador contra un
+        StandInServer y devuelve los resultados:
+            - getDataframe() sin caché, con la caché en disco y con la
+                caché en memoria
+            - requestCrashAPI() de un paquete de request_together estados
+            - preprocess() y groupCountAccidents()
+            - plotMapAccidents() y plotMapAccidentsLeyend(), incluyendo
+                el dibujado de la figura
+        Durante la medición se usan una caché y un limitador de peticiones
+        propios, y después se restauran los de crashdata.
+        
+        states : list[int]     -> Estados según STATE_CODES. Por defecto todos.
+        year : int             -> Año que pedir.
+        rows_per_state : int   -> Accidentes sintéticos por estado.
+        latency : float        -> Segundos de espera del servidor por petición.
+        rate : float           -> Peticiones por segundo que admite el servidor.
+        repeat : int           -> Número de mediciones de cada etapa.
+        request_together : int -> Número de estados por petición.
+    """
+    
+    # Dibujado sin ventana
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    
+    from aggregation import preprocess, groupCountAccidents
+    from rendering import STATE_GEOMETRY, SmallMultiples, plotMapAccidents, plotMapAccidentsLeyend
+    
+    if states is None:
+        states = list(STATE_CODES.values())
+    
+    saved = crashdata.CRASHAPI_URL, crashdata.CACHE, crashdata.RATE_LIMITER, crashdata.BATCH_SIZER
+    stages = dict()
+    
+    with StandInServer(rows_per_state, latency, rate) as server, tempfile.TemporaryDirectory() as directory:
+        try:
+            crashdata.CRASHAPI_URL = server.url
+            crashdata.RATE_LIMITER = TokenBucket(1000, 1000)
+            # Sin aprender ni guardar límites de los paquetes del servidor local
+            crashdata.BATCH_SIZER = BatchSizer(None)
+            
+            def emptyCache():
+                crashdata.CACHE.flush()
+                crashdata.CACHE = CrashCache(directory)
+                crashdata.CACHE.clear()
+            
+            def diskCache():
+                # Misma carpeta, pero sin nada en memoria
+                crashdata.CACHE.flush()
+                crashdata.CACHE = CrashCache(directory)
+            
+            fetch = lambda: crashdata.getDataframe(states, year, request_together)
+            
+            # Generar antes los datos del servidor para no medirlo a él
+            for i in range(0, len(states), request_together):
+                server._response(states[i:i + request_together], year, year)
+            
+            stages["getDataframe (sin caché)"] = _measure(fetch, repeat, emptyCache)
+            stages["getDataframe (caché en disco)"] = _measure(fetch, repeat, diskCache)
+            stages["getDataframe (caché en memoria)"] = _measure(fetch, repeat)
+            
+            batch = ",".join(str(state) for state in states[:request_together])
+            stages["requestCrashAPI"] = _measure(lambda: crashdata.requestCrashAPI(batch, year), repeat, emptyCache)
+            
+            df = fetch()
+            stages["preprocess"] = _measure(lambda: preprocess(df), repeat)
+            
+            df = preprocess(df)
+            stages["groupCountAccidents"] = _measure(lambda: groupCountAccidents(df), repeat)
+            
+            accident_count = groupCountAccidents(df)
+            
+            # Los contornos proyectados se preparan una vez, como en la interfaz
+            STATE_GEOMETRY.paths()
+            
+            def draw(fig : plt.Figure):
+                fig.canvas.draw()
+                plt.close(fig)
+            
+            stages["plotMapAccidents"] = _measure(lambda: draw(plotMapAccidents(accident_count, year)), repeat)
+            stages["plotMapAccidentsLeyend"] = _measure(
+                lambda: draw(plotMapAccidentsLeyend(accident_count, extra_info = False)), repeat)
+            
+            # Todos los años con los recuentos del año medido, para compararlo con un solo mapa
+            grid = SmallMultiples()
+            year_count = pd.DataFrame({each_year: accident_count["accidents"] for each_year in YEARS})
+            stages["SmallMultiples (todos los años)"] = _measure(lambda: grid.update(year_count), repeat)
+        
+        finally:
+            # Guardar el índice antes de borrar la carpeta temporal
+            crashdata.CACHE.flush()
+            crashdata.CRASHAPI_URL, crashdata.CACHE, crashdata.RATE_LIMITER, crashdata.BATCH_SIZER = saved
+        
+        server_stats = server.stats()
+    
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "config": {"states": len(states), "year": year, "rows_per_state": rows_per_state,
+                       "latency": latency, "rate": rate, "repeat": repeat,
+                       "request_together": request_together},
+            "rows": len(df),
+            "server": server_stats,
+            "stages": stages}
+
+
+
+#%% COMPROBACIONES
+
+
+@contextmanager
+def _isolated(server : StandInServer, directory : str):
+    """
+        Dirige crashdata a 'server' con una caché en 'directory', sin límite
+        de peticiones y sin límites de paquetes aprendidos, y al salir
+        restaura los de crashdata.
+    """
+    saved = crashdata.CRASHAPI_URL, crashdata.CACHE, crashdata.RATE_LIMITER, crashdata.BATCH_SIZER
+    try:
+        crashdata.CRASHAPI_URL = server.url
+        crashdata.RATE_LIMITER = TokenBucket(1000, 1000)
+        crashdata.BATCH_SIZER = BatchSizer(None)
+        crashdata.CACHE = CrashCache(directory)
+        yield
+    finally:
+        crashdata.CACHE.flush()
+        crashdata.CRASHAPI_URL, crashdata.CACHE, crashdata.RATE_LIMITER, crashdata.BATCH_SIZER = saved
+
+
+def checkTruncatedBatches(states : list[int] = (1, 2, 4, 5, 6), rows_per_state : int = 400, 
+                          max_rows : int = 730) -> dict:
+    """
+        Comprueba que un paquete cortado por el límite de filas de la API
+        se recupera entero, aunque alguna de sus mitades también se corte
+        dentro de su último estado.
+        
+        states : list[int]     -> Estados del paquete.
+        rows_per_state : int   -> Accidentes sintéticos por estado.
+        max_rows : int         -> Filas máximas por respuesta del servidor.
+    """
+    with StandInServer(rows_per_state, max_rows = max_rows) as server, \
+         tempfile.TemporaryDirectory() as directory, _isolated(server, directory):
+        
+        df = crashdata.getDataframe(list(states), 2014, workers = 1)
+        
+        return {"expected": len(states) * rows_per_state,
+                "got": len(df),
+                "ok": len(df) == len(states) * rows_per_state}
+
+
+def checkRevalidation(years : range = range(2014, 2018), rows_per_state : int = 50) -> dict:
+    """
+        Comprueba que, cuando caducan las entradas de la caché, se vuelven
+        a pedir en los mismos paquetes con que se guardaron y el servidor
+        responde 304 a todas, aunque BATCH_SIZER haya crecido entre medias.
+        Antes, countAccidentsStreaming() de un solo estado debe contar solo
+        ese estado, aunque se guardara en un paquete con otros.
+        
+        years : range          -> Años que pedir uno a uno mientras crece.
+        rows_per_state : int   -> Accidentes sintéticos por estado.
+    """
+    states = list(STATE_CODES.values())
+    
+    with StandInServer(rows_per_state) as server, \
+         tempfile.TemporaryDirectory() as directory, _isolated(server, directory):
+        
+        # Todos los años caducan enseguida
+        crashdata.CACHE = CrashCache(directory, ttl = 0.5, revisable_from = min(years))
+        for year in years:
+            crashdata.getDataframe(states, year, workers = 1)
+        
+        time.sleep(0.6)
+        streamed = crashdata.countAccidentsStreaming([states[0]], min(years))
+        
+        before = server.stats()
+        crashdata.getDataframe(states, min(years), workers = 1, to_year = max(years))
+        after = server.stats()
+        
+        requests = after["requests"] - before["requests"]
+        not_modified = after["not_modified"] - before["not_modified"]
+        return {"requests": requests,
+                "not_modified": not_modified,
+                "streamed": streamed["accidents"].to_dict(),
+                "ok": (requests > 0 and not_modified == requests 
+                       and streamed["accidents"].to_dict() == {list(STATE_CODES)[0]: rows_per_state})}
+
+
+def checkSingleDraw(extension : str = "png") -> dict:
+    """
+        Comprueba que rendering.renderImages(), que dibuja las imágenes
+        del servicio HTTP, dibuja cada figura una sola vez, al guardarla.
+        
+        extension : str        -> Formato de las imágenes.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    
+    import rendering
+    
+    states = list(STATE_CODES)
+    accident_count = pd.DataFrame({"accidents": np.arange(1, len(states) + 1)}, 
+                                  index = pd.Index(states, name = "statename"))
+    
+    # Crear antes el mapa del proceso para contar sus dibujos
+    view = rendering._workerView(accident_count, YEARS[0], "mediana", "accidentes")
+    draws = list()
+    for fig in (view.fig, view.legend_fig):
+        fig.canvas.mpl_connect("draw_event", lambda event: draws.append(event))
+    
+    images = rendering.renderImages((accident_count, YEARS[-1], extension, 50, "mediana", "accidentes"))
+    
+    return {"images": len(images),
+            "draws": len(draws),
+            "ok": len(draws) == len(images)}
+
+
+# Comprobaciones que ejecuta 'python main.py check'
+CHECKS = {"paquetes cortados": checkTruncatedBatches,
+          "revalidación tras crecer": checkRevalidation,
+          "un dibujo por imagen": checkSingleDraw}
+
+def runChecks() -> dict:
+    """
+        Ejecuta todas las comprobaciones de CHECKS y devuelve sus resultados.
+    """
+    return {name: check() for name, check in CHECKS.items()}
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Clasificación del número de accidentes de cada estado en los rangos de
+colores del mapa. El mapa y la leyenda usan el mismo clasificador, que
+calcula los límites una sola vez para cada vector de recuentos. numpy
+solo se importa al usarse, para que la interfaz pueda leer SCHEMES sin
+esperarlo.
+"""
+
+from __future__ import annotations
+
+#%% DEPENDENCIAS
+
+
+# Memoización de los límites calculados
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Medición del cálculo de los límites
+from instrumentation import RECORDER
+
+# numpy se importa dentro de cada función que lo usa
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import numpy as np
+
+
+#%% ESQUEMAS DE CLASIFICACIÓN
+
+
+def _medianBounds(values : np.ndarray, classes : int) -> np.ndarray:
+    """
+        Esquema original del visualizador:
+            - En tercios entre el mínimo y la mediana
+            - En sextos entre la mediana y el máximo saltándose
+                tercer sexto ya que no suele contener observaciones
+        Solo está definido para 8 rangos.
+    """
+    import numpy as np
+    
+    # Maximo, minimo y mediana de la distribucion de accientes
+    accidents_max = values[-1]
+    accidents_min = values[0]
+    median = np.median(values)
+    
+    return np.array([0,
+                     accidents_min + (median - accidents_min) * 1/3,
+                     accidents_min + (median - accidents_min) * 2/3,
+                     median,
+                     median + (accidents_max - median) * 1/6,
+                     median + (accidents_max - median) * 2/6,
+                     median + (accidents_max - median) * 4/6,
+                     median + (accidents_max - median) * 5/6,
+                     accidents_max])
+
+
+def _quantileBounds(values : np.ndarray, classes : int) -> np.ndarray:
+    """
+        Rangos con el mismo número de estados en cada uno.
+    """
+    import numpy as np
+    
+    return np.concatenate([[0], np.quantile(values, np.arange(1, classes + 1) / classes)])
+
+
+def _equalIntervalBounds(values : np.ndarray, classes : int) -> np.ndarray:
+    """
+        Rangos de la misma anchura entre el mínimo y el máximo.
+    """
+    import numpy as np
+    
+    return np.concatenate([[0], values[0] + (values[-1] - values[0]) * np.arange(1, classes + 1) / classes])
+
+
+def _jenksBounds(values : np.ndarray, classes : int) -> np.ndarray:
+    """
+        Cortes naturales de Jenks: los rangos que minimizan la suma de las
+        varianzas dentro de cada rango, por programación dinámica
+        (Fisher, 1958). Para cada número de rangos y cada último valor se
+        prueban a la vez todos los inicios posibles del último rango con
+        sumas acumuladas, en O(rangos * n) operaciones vectorizadas de
+        tamaño n.
+    """
+    import numpy as np
+    
+    # Los valores repetidos van siempre al mismo rango: se trabaja con los
+    # valores distintos, cada uno con el peso de sus repeticiones
+    values, weights = np.unique(values, return_counts = True)
+    
+    n = len(values)
+    classes = min(classes, n)
+    
+    # Sumas acumuladas para calcular la suma de cuadrados de cualquier tramo
+    counts = np.concatenate([[0], np.cumsum(weights)])
+    sums = np.concatenate([[0], np.cumsum(values * weights, dtype = np.float64)])
+    squares = np.concatenate([[0], np.cumsum(values.astype(np.float64) ** 2 * weights)])
+    
+    # cost[j, i]: menor error de los valores 0..i en j+1 rangos
+    # start[j, i]: primer valor del último de esos rangos
+    cost = np.full((classes, n), np.inf)
+    start = np.zeros((classes, n), dtype = np.int64)
+    
+    cost[0] = squares[1:] - sums[1:] ** 2 / counts[1:]
+    
+    for j in range(1, classes):
+        for i in range(j, n):
+            # Último rango de m a i, para todos los m posibles a la vez
+            m = np.arange(j, i + 1)
+            segment = squares[i + 1] - squares[m] - (sums[i + 1] - sums[m]) ** 2 / (counts[i + 1] - counts[m])
+            total = cost[j - 1, m - 1] + segment
+            best = total.argmin()
+            cost[j, i] = total[best]
+            start[j, i] = m[best]
+    
+    # Recorrer los cortes hacia atrás desde el último valor
+    bounds = [values[-1]]
+    last = n - 1
+    for j in range(classes - 1, 0, -1):
+        last = start[j, last] - 1
+        bounds.append(values[last])
+    
+    return np.array([0] + bounds[::-1], dtype = np.float64)
+
+
+# Esquemas disponibles: {nombre: función(valores ordenados, rangos) -> límites}
+SCHEMES = {"mediana": _medianBounds,
+           "cuantiles": _quantileBounds,
+           "intervalos iguales": _equalIntervalBounds,
+           "jenks": _jenksBounds}
+
+
+#%% CLASIFICADOR
+
+
+class Classifier:
+    """
+        Calcula los límites de los rangos de colores del mapa según un
+        esquema de SCHEMES y asigna a cada estado su rango. Los límites
+        se guardan según un hash del vector de recuentos, así que dibujar
+        de nuevo los mismos datos o su leyenda no los vuelve a calcular.
+        
+        Los límites son [0, l1, l2, ..., máximo], de forma que el rango i
+        va de bounds[i-1] a bounds[i], y el rango 0 es el de los estados
+        sin accidentes.
+        
+        scheme : str           -> Esquema de SCHEMES.
+        classes : int          -> Número de rangos con accidentes.
+        cache_size : int       -> Número de vectores de recuentos cuyos
+                                    límites se recuerdan.
+    """
+    
+    def __init__(self, scheme : str = "mediana", classes : int = 8, cache_size : int = 256):
+        
+        if scheme not in SCHEMES:
+            raise ValueError("El esquema de clasificación debe ser uno de: " + ", ".join(SCHEMES))
+        if scheme == "mediana" and classes != 8:
+            raise ValueError("El esquema 'mediana' solo admite 8 rangos")
+        
+        self.scheme = scheme
+        self.classes = classes
+        self.cache_size = cache_size
+        
+        # Estadísticas de uso
+        self.hits = 0
+        self.misses = 0
+        
+        self._bounds = OrderedDict()
+        self._lock = threading.Lock()
+    
+    
+    @staticmethod
+    def _values(accident_count) -> np.ndarray:
+        """
+            Vector de recuentos de un dataframe como el de
+            groupCountAccidents() (su columna 'accidents'), de una de sus
+            columnas o de un array. Las medias por accidente se mantienen
+            como decimales.
+        """
+        import numpy as np
+        if hasattr(accident_count, "columns"):
+            accident_count = accident_count["accidents"]
+        values = np.asarray(accident_count)
+        return values.astype(np.float64 if values.dtype.kind == "f" else np.int64)
+    
+    
+    def bounds(self, accident_count) -> np.ndarray:
+        """
+            Límites de los rangos para unos recuentos.
+            
+            accident_count : pd.Dataframe -> Observaciones contadas por estado.
+                                                Se recomienda utilizar groupCountAccidents().
+                                                También admite una de sus columnas
+                                                o un array de recuentos.
+        """
+        import numpy as np
+        
+        # Los límites solo dependen de los valores, no del orden de los estados
+        values = np.sort(self._values(accident_count))
+        key = values.dtype.str + hashlib.sha1(values.tobytes()).hexdigest()
+        
+        with self._lock:
+            if key in self._bounds:
+                self.hits += 1
+                self._bounds.move_to_end(key)
+                return self._bounds[key]
+            self.misses += 1
+        
+        with RECORDER.span("classify", scheme = self.scheme, values = len(values)):
+            if len(values) == 0:
+                bounds = np.zeros(self.classes + 1)
+            else:
+                bounds = SCHEMES[self.scheme](values, self.classes)
+                
+                # Siempre classes + 1 límites, aunque haya menos valores distintos
+                bounds = np.concatenate([bounds, np.repeat(bounds[-1], self.classes + 1 - len(bounds))])
+            bounds.setflags(write = False)
+        
+        with self._lock:
+            self._bounds[key] = bounds
+            while len(self._bounds) > self.cache_size:
+                self._bounds.popitem(last = False)
+        
+        return bounds
+    
+    
+    def classify(self, values : np.ndarray, bounds : np.ndarray) -> np.ndarray:
+        """
+            Rango de cada valor: 1 hasta bounds[1] incluido, 2 hasta
+            bounds[2] incluido... y 0 para los valores sin accidentes.
+            
+            values : np.ndarray    -> Recuentos que clasificar.
+            bounds : np.ndarray    -> Límites según bounds().
+        """
+        import numpy as np
+        classes = np.digitize(values, bounds[1:-1], right = True) + 1
+        classes[values == 0] = 0
+        return classes
+    
+    
+    def labels(self, bounds : np.ndarray, unit : str = "accidentes", decimals : int = 0) -> list[str]:
+        """
+            Texto de cada rango de la leyenda, empezando por el de los
+            estados sin accidentes.
+            
+            bounds : np.ndarray    -> Límites según bounds().
+            unit : str             -> Lo que se cuenta, al final de cada texto.
+            decimals : int         -> Decimales de los límites, para las medias
+                                        por accidente.
+        """
+        
+        def number(value : float) -> str:
+            return str(int(value)) if decimals == 0 else format(value, "." + str(decimals) + "f")
+        
+        labels = ["Sin datos de accidentes"]
+        
+        for i in range(1, self.classes + 1):
+            label = "Entre " + number(bounds[i - 1]) + " y " + number(bounds[i])
+            if self.scheme == "mediana" and i == 3:
+                label += " (la mediana)"
+            labels.append(label + " " + unit)
+        
+        return labels
+    
+    
+    def stats(self) -> dict:
+        """
+            Aciertos y fallos de la memoria de límites.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._bounds)}
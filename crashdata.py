@@ -0,0 +1,1627 @@
+# -*- coding: utf-8 -*-
+"""
+Obtención de la base de datos de accidentes de CrashAPI: caché en disco,
+limitación de peticiones, planificación por (estado, año) y descarga
+anticipada. pandas y numpy solo se importan al usarse por primera vez,
+para que importar este módulo sea inmediato.
+"""
+
+from __future__ import annotations
+
+#%% DEPENDENCIAS
+
+
+# Control del tiempo de ejecución
+import time
+
+# Caché persistente en disco de las peticiones a la API
+import os
+import json
+import atexit
+from collections import OrderedDict
+
+# Peticiones concurrentes y limitadas a la API
+import threading
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit, parse_qs
+from http.client import HTTPException
+import io
+import gzip
+
+# Conexiones persistentes, gzip y peticiones condicionales
+from httpclient import ConnectionPool
+
+# Medición de cada petición y lectura
+from instrumentation import RECORDER
+
+# pandas y numpy se importan dentro de cada función que los usa
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+#%% CODIGO DE CADA ESTADO EN LA API DE CRASHAPI
+
+
+STATE_CODES = {
+    "Alabama":1,
+    "Alaska":2,
+    "Arizona":4,
+    "Arkansas":5,
+    "California":6,
+    "Colorado":8,
+    "Connecticut":9,
+    "Delaware":10,
+    "District of Columbia":11,
+    "Florida":12,
+    "Georgia":13,
+    "Hawaii":15,
+    "Idaho":16,
+    "Illinois":17,
+    "Indiana":18,
+    "Iowa":19,
+    "Kansas":20,
+    "Kentucky":21,
+    "Louisiana":22,
+    "Maine":23,
+    "Maryland":24,
+    "Massachusetts":25,
+    "Michigan":26,
+    "Minnesota":27,
+    "Mississippi":28,
+    "Missouri":29,
+    "Montana":30,
+    "Nebraska":31,
+    "Nevada":32,
+    "New Hampshire":33,
+    "New Jersey":34,
+    "New Mexico":35,
+    "New York":36,
+    "North Carolina":37,
+    "North Dakota":38,
+    "Ohio":39,
+    "Oklahoma":40,
+    "Oregon":41,
+    "Pennsylvania":42,
+    "Puerto Rico":43,
+    "Rhode Island":44,
+    "South Carolina":45,
+    "South Dakota":46,
+    "Tennessee":47,
+    "Texas":48,
+    "Utah":49,
+    "Vermont":50,
+    "Virginia":51,
+    "Virgin Islands":52,
+    "Washington":53,
+    "West Virginia":54,
+    "Wisconsin":55,
+    "Wyoming":56
+}
+
+
+#%% CACHÉ PERSISTENTE DE PETICIONES
+
+
+# Carpeta por defecto de la caché, junto al propio script
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+
+class CrashCache:
+    """
+        Caché persistente en disco de las respuestas de CrashAPI.
+        Cada entrada (estados, año) se guarda como un fichero .npz
+        comprimido con un array por columna, de forma que un arranque en
+        caliente no necesita volver a pedir nada a la API. Las columnas de
+        texto se guardan, como en Snapshot, como códigos enteros y la lista
+        de sus valores distintos (-1 para los que faltan). Las entradas
+        usadas recientemente se mantienen además en memoria, y ambas
+        devuelven los mismos tipos que pd.read_csv().
+        
+        directory : str        -> Carpeta donde se guardan los ficheros
+                                    de la caché y su índice.
+        max_bytes : int        -> Tamaño máximo en disco. Al superarlo se
+                                    eliminan las entradas usadas hace más
+                                    tiempo (LRU).
+        ttl : float            -> Segundos de validez de las entradas de
+                                    años que aún pueden ser revisados.
+        revisable_from : int   -> Primer año cuyos datos pueden cambiar
+                                    todavía. Los años anteriores no caducan.
+        memory_bytes : int     -> Tamaño máximo de las entradas mantenidas
+                                    en memoria.
+    """
+    
+    INDEX_NAME = "index.json"
+    
+    # Versión del formato de los ficheros. Las entradas de otra versión no se usan
+    FORMAT = 2
+    
+    # Prefijo de los arrays con los valores distintos de cada columna de texto
+    CATEGORIES = "categories:"
+    
+    def __init__(self, directory : str = CACHE_DIR, max_bytes : int = 256 * 1024**2,
+                 ttl : float = 7 * 24 * 3600, revisable_from : int = 2020, 
+                 memory_bytes : int = 64 * 1024**2):
+        
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.ttl = ttl
+        self.revisable_from = revisable_from
+        
+        # Estadísticas de uso
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        
+        # La caché se comparte entre los hilos que descargan los paquetes
+        self._lock = threading.RLock()
+        self._index = self._loadIndex()
+        self._dirty = False
+        atexit.register(self.flush)
+        
+        # Entradas en memoria, de la menos a la más usada recientemente
+        self._memory = OrderedDict()
+        self._memory_used = 0
+    
+    
+    def _loadIndex(self) -> dict:
+        """
+            Lee el índice de la caché, o devuelve uno vacío si no existe
+            o está corrupto.
+        """
+        try:
+            with open(os.path.join(self.directory, self.INDEX_NAME), encoding = "utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+    
+    
+    def flush(self):
+        """
+            Guarda el índice en disco de forma atómica si ha cambiado.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            
+            os.makedirs(self.directory, exist_ok = True)
+            path = os.path.join(self.directory, self.INDEX_NAME)
+            with open(path + ".tmp", "w", encoding = "utf-8") as f:
+                json.dump(self._index, f)
+            os.replace(path + ".tmp", path)
+            self._dirty = False
+    
+    
+    @staticmethod
+    def _key(states : str, year : int) -> str:
+        return states.replace(",", "-") + "_" + str(year)
+    
+    
+    def _remove(self, key : str):
+        self._forget(key)
+        entry = self._index.pop(key)
+        try:
+            os.remove(os.path.join(self.directory, entry["file"]))
+        except OSError:
+            pass
+        self._dirty = True
+    
+    
+    def _remember(self, key : str, df : pd.DataFrame):
+        """
+            Guarda el dataframe en memoria respetando memory_bytes.
+        """
+        self._forget(key)
+        size = int(df.memory_usage(deep = True).sum())
+        if size > self.memory_bytes:
+            return
+        
+        self._memory[key] = (df, size)
+        self._memory_used += size
+        
+        while self._memory_used > self.memory_bytes:
+            _, (_, old_size) = self._memory.popitem(last = False)
+            self._memory_used -= old_size
+    
+    
+    def _forget(self, key : str):
+        if key in self._memory:
+            self._memory_used -= self._memory.pop(key)[1]
+    
+    
+    def _expired(self, entry : dict) -> bool:
+        return entry["year"] >= self.revisable_from and time.time() - entry["created"] > self.ttl
+    
+    
+    def get(self, states : str, year : int, columns : list[str] = None, 
+            stale : bool = False) -> pd.DataFrame:
+        """
+            Devuelve el dataframe guardado para (states, year) o None si
+            no está en la caché o ha caducado.
+            
+            columns : list[str]    -> Columnas que cargar. Por defecto todas.
+                                        Las columnas no pedidas no se
+                                        leen del disco.
+            stale : bool           -> Devolverlo aunque haya caducado.
+        """
+        import numpy as np
+        import pandas as pd
+        
+        key = self._key(states, year)
+        
+        with self._lock:
+            entry = self._index.get(key)
+            
+            # Ficheros de una versión anterior del formato
+            if entry is not None and entry.get("format") != self.FORMAT:
+                self._remove(key)
+                entry = None
+            
+            # Las entradas caducadas se conservan para revalidarlas con validators()
+            if entry is not None and not stale and self._expired(entry):
+                self.expirations += 1
+                entry = None
+            
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                df = self._memory[key][0]
+                if columns is not None:
+                    df = df[[column for column in columns if column in df.columns]]
+            else:
+                try:
+                    # np.load solo lee del fichero los arrays a los que se accede
+                    with np.load(os.path.join(self.directory, entry["file"]), allow_pickle = False) as data:
+                        df = pd.DataFrame({column: self._decode(data, column) for column in data.files 
+                                           if not column.startswith(self.CATEGORIES) 
+                                           and (columns is None or column in columns)})
+                except (OSError, ValueError):
+                    # Fichero perdido o dañado, se trata como un fallo
+                    self._remove(key)
+                    self.misses += 1
+                    return None
+                
+                # En memoria solo se guardan las entradas completas
+                if columns is None:
+                    self._remember(key, df)
+            
+            entry["last_access"] = time.time()
+            self._dirty = True
+            self.hits += 1
+        
+        return df
+    
+    
+    @classmethod
+    def _encode(cls, df : pd.DataFrame) -> dict:
+        """
+            Arrays que guardar de cada columna del dataframe. Las columnas
+            de texto pasan a códigos enteros y sus valores distintos.
+        """
+        import numpy as np
+        import pandas as pd
+        
+        arrays = dict()
+        for column in df.columns:
+            values = df[column].to_numpy()
+            if values.dtype.kind in "iufb":
+                arrays[str(column)] = values
+                continue
+            
+            codes, categories = pd.factorize(df[column])
+            arrays[str(column)] = codes.astype(np.int8 if len(categories) < 128 else 
+                                               np.int16 if len(categories) < 32768 else np.int32)
+            arrays[cls.CATEGORIES + str(column)] = np.array([str(value) for value in categories], dtype = str)
+        
+        return arrays
+    
+    
+    @classmethod
+    def _decode(cls, data, column : str):
+        """
+            Columna 'column' del fichero cargado, con el texto como objetos
+            de Python y los valores que faltaban como NaN, igual que los
+            lee pd.read_csv().
+        """
+        import numpy as np
+        
+        values = data[column]
+        if cls.CATEGORIES + column not in data.files:
+            return values
+        
+        categories = data[cls.CATEGORIES + column].astype(object)
+        decoded = np.full(len(values), np.nan, dtype = object)
+        present = values >= 0
+        decoded[present] = categories[values[present]]
+        return decoded
+    
+    
+    def put(self, states : str, year : int, df : pd.DataFrame, source : dict = None):
+        """
+            Guarda el dataframe en disco, columna a columna, y aplica
+            el límite de tamaño de la caché. El índice no se escribe en
+            cada entrada: quien guarda varias llama a flush() al terminar,
+            y en cualquier caso se guarda al salir del programa.
+            
+            source : dict          -> Dirección de la descarga de la que viene
+                                        y sus validadores, {"url", "etag",
+                                        "last_modified"}, para revalidarla
+                                        cuando caduque.
+        """
+        import numpy as np
+        
+        key = self._key(states, year)
+        filename = key + ".npz"
+        path = os.path.join(self.directory, filename)
+        
+        # Sin objetos de Python, que obligarían a usar pickle
+        columns = self._encode(df)
+        
+        with self._lock:
+            os.makedirs(self.directory, exist_ok = True)
+            with open(path + ".tmp", "wb") as f:
+                np.savez_compressed(f, **columns)
+            os.replace(path + ".tmp", path)
+            
+            now = time.time()
+            self._index[key] = {"file": filename, 
+                                "format": self.FORMAT, 
+                                "year": year, 
+                                "bytes": os.path.getsize(path),
+                                "created": now, 
+                                "last_access": now}
+            if source is not None:
+                self._index[key]["source"] = source
+            self._dirty = True
+            self._remember(key, df)
+            
+            self._evict()
+    
+    
+    def _evict(self):
+        """
+            Elimina las entradas menos usadas recientemente hasta
+            respetar max_bytes.
+        """
+        total = sum(entry["bytes"] for entry in self._index.values())
+        for key in sorted(self._index, key = lambda k: self._index[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            total -= self._index[key]["bytes"]
+            self._remove(key)
+            self.evictions += 1
+    
+    
+    def validators(self, url : str, states : list[str], years : list[int]) -> dict:
+        """
+            Validadores (ETag, Last-Modified) de la descarga 'url' si todas
+            las entradas de 'states' y 'years' siguen en la caché y vienen
+            de ella, o None si hay que descargarla de nuevo sin condiciones.
+        """
+        with self._lock:
+            entries = [self._index.get(self._key(state, year)) for state in states for year in years]
+            if not entries or any(entry is None or entry.get("source", {}).get("url") != url 
+                                  for entry in entries):
+                return None
+            
+            source = entries[0]["source"]
+            if not source.get("etag") and not source.get("last_modified"):
+                return None
+            return {"etag": source.get("etag"), "last_modified": source.get("last_modified")}
+    
+    
+    def source(self, states : str, year : int) -> dict:
+        """
+            Origen {url, etag, last_modified} con el que se guardó
+            (states, year), haya caducado o no, o None si no está en la
+            caché o no se puede revalidar.
+        """
+        with self._lock:
+            entry = self._index.get(self._key(states, year))
+            source = None if entry is None or entry.get("format") != self.FORMAT else entry.get("source")
+            if not source or not source.get("url") or not (source.get("etag") or source.get("last_modified")):
+                return None
+            return dict(source)
+    
+    
+    def refresh(self, states : str, year : int):
+        """
+            Renueva la validez de una entrada tras comprobar con el servidor
+            que sus datos no han cambiado.
+        """
+        with self._lock:
+            entry = self._index.get(self._key(states, year))
+            if entry is not None:
+                entry["created"] = time.time()
+                self._dirty = True
+    
+    
+    def contains(self, states : str, year : int) -> bool:
+        """
+            Indica si (states, year) está en la caché y no ha caducado,
+            sin cargarlo ni contar un acierto o un fallo.
+        """
+        with self._lock:
+            entry = self._index.get(self._key(states, year))
+            return entry is not None and entry.get("format") == self.FORMAT and not self._expired(entry)
+    
+    
+    def size(self) -> int:
+        """
+            Bytes ocupados en disco por las entradas de la caché.
+        """
+        # Otros hilos pueden añadir entradas mientras se recorre el índice
+        with self._lock:
+            return sum(entry["bytes"] for entry in self._index.values())
+    
+    
+    def stats(self) -> dict:
+        """
+            Estadísticas de uso de la caché desde que se creó el objeto.
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_ratio": self.hits / requests if requests else 0.0,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations,
+                    "entries": len(self._index),
+                    "bytes": self.size()}
+    
+    
+    def clear(self):
+        """
+            Elimina todas las entradas de la caché.
+        """
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+            self.flush()
+
+
+# Caché compartida por todas las peticiones a CrashAPI
+CACHE = CrashCache()
+RECORDER.watch("cache", lambda: CACHE.stats())
+
+
+#%% LIMITACIÓN DE PETICIONES A LA API
+
+
+class TokenBucket:
+    """
+        Limitador de peticiones por cubo de fichas. Cada petición
+        consume una ficha y las fichas se recargan a ritmo constante,
+        permitiendo ráfagas de hasta 'capacity' peticiones.
+        
+        rate : float           -> Fichas recargadas por segundo.
+        capacity : int         -> Número máximo de fichas acumuladas.
+    """
+    
+    def __init__(self, rate : float = 2.0, capacity : int = 5):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    
+    def tryAcquire(self) -> float:
+        """
+            Consume una ficha si hay alguna disponible. Devuelve 0 si la
+            ha consumido o, si no, los segundos que faltan para la siguiente.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            
+            return (1 - self._tokens) / self.rate
+    
+    
+    def acquire(self):
+        """
+            Espera hasta que haya una ficha disponible y la consume.
+        """
+        wait = self.tryAcquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.tryAcquire()
+
+
+# Límite compartido por todos los hilos que piden datos a CrashAPI
+RATE_LIMITER = TokenBucket()
+
+# Dirección base de CrashAPI. La variable de entorno CRASHAPI_URL permite
+# usar otro servidor, como el de benchmark.py
+CRASHAPI_URL = os.environ.get("CRASHAPI_URL", "https://crashviewer.nhtsa.dot.gov/CrashAPI")
+
+# Códigos HTTP que indican un fallo pasajero que merece reintentarse
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Conexiones con CrashAPI, reutilizadas entre peticiones y hilos
+HTTP_POOL = ConnectionPool(connect_timeout = 10, read_timeout = 60)
+RECORDER.watch("http", lambda: HTTP_POOL.stats())
+
+
+# Tipos explícitos de las columnas numéricas de CrashAPI, para no
+# reservar int64 en columnas con valores pequeños
+CSV_DTYPES = {
+    "st_case": "int32",
+    "state": "int8",
+    "totalvehicles": "int16",
+    "fatals": "int16",
+    "peds": "int16",
+    "persons": "int16"
+}
+
+# Medidas de cada accidente que se conservan al preprocesar y se suman al agrupar
+METRIC_COLUMNS = ["fatals", "peds", "persons", "totalvehicles"]
+
+# Lo que se puede representar en el mapa: {nombre: (columna del recuento, decimales)}.
+# Está aquí y no en aggregation para que la interfaz lo lea sin cargar pandas
+MEASURES = {"accidentes": ("accidents", 0),
+            "fallecidos": ("fatals", 0),
+            "fallecidos por accidente": ("fatals_per_accident", 2),
+            "peatones": ("peds", 0),
+            "peatones por accidente": ("peds_per_accident", 2),
+            "personas": ("persons", 0),
+            "personas por accidente": ("persons_per_accident", 2),
+            "vehículos": ("totalvehicles", 0),
+            "vehículos por accidente": ("totalvehicles_per_accident", 2)}
+
+# Columnas de CrashAPI que necesita cada consumidor
+PREPROCESS_COLUMNS = ["statename", "crashdate"] + METRIC_COLUMNS
+COUNTY_COLUMNS = ["statename", "countyname", "crashdate"] + METRIC_COLUMNS
+COUNT_COLUMNS = ["statename"]
+
+
+def _downloadCSV(url : str, retries : int = 4, backoff : float = 1.0, 
+                 usecols : list[str] = None, chunksize : int = None, 
+                 validators : dict = None) -> pd.DataFrame:
+    """
+        Descarga un CSV respetando RATE_LIMITER y reintentando los fallos
+        pasajeros con espera exponencial (backoff, 2*backoff, 4*backoff...)
+        La respuesta se lee de HTTP_POOL como un flujo directamente por
+        pd.read_csv(), sin guardarla entera en memoria antes. En RECORDER,
+        la etapa "http" mide hasta recibir las cabeceras y "parse" la
+        lectura del cuerpo a medida que llega.
+        
+        url : str              -> Dirección del CSV.
+        retries : int          -> Número máximo de reintentos.
+        backoff : float        -> Segundos de espera antes del primer reintento.
+        usecols : list[str]    -> Columnas que leer. Por defecto todas.
+        chunksize : int        -> Si se indica, devuelve un iterador de
+                                    dataframes de ese número de filas en
+                                    lugar de leer el CSV completo.
+        validators : dict      -> {"etag", "last_modified"} de una descarga
+                                    anterior de la misma dirección. Si se
+                                    indican y los datos no han cambiado,
+                                    devuelve None sin descargar nada. Se
+                                    actualiza con los de la nueva respuesta.
+    """
+    import pandas as pd
+    
+    attempt = 0
+    
+    # Las columnas no pedidas se descartan durante la lectura, sin llegar a crearse
+    if usecols is not None:
+        selected = set(usecols)
+        usecols = lambda column: column in selected
+    
+    while True:
+        RATE_LIMITER.acquire()
+        response = None
+        streaming = False
+        try:
+            with RECORDER.span("http", url = url, attempt = attempt) as info:
+                response = HTTP_POOL.request(url, validators = validators)
+                info["status"] = response.status
+            
+            # Datos sin cambios desde la descarga anterior
+            if response.status == 304:
+                response.close()
+                RECORDER.add("http_not_modified")
+                return None
+            
+            if validators is not None:
+                validators.update(response.validators())
+            
+            if chunksize:
+                reader = pd.read_csv(io.BufferedReader(response), usecols = usecols, dtype = CSV_DTYPES, 
+                                     chunksize = chunksize)
+                streaming = True
+                return _parseChunks(reader, response)
+            
+            with RECORDER.span("parse", url = url) as info:
+                df = pd.read_csv(io.BufferedReader(response), usecols = usecols, dtype = CSV_DTYPES)
+                info["rows"] = len(df)
+            RECORDER.add("rows_parsed", len(df))
+            return df
+        
+        except pd.errors.EmptyDataError:
+            # Respuesta sin ninguna línea: no hay accidentes que devolver
+            return iter(()) if chunksize else pd.DataFrame()
+        except HTTPError as error:
+            RECORDER.add("http_errors")
+            if error.code not in RETRY_STATUS or attempt >= retries:
+                raise
+        except (URLError, ConnectionError, TimeoutError, HTTPException, EOFError, gzip.BadGzipFile):
+            # También los cortes a mitad de la lectura del cuerpo (IncompleteRead,
+            # o EOFError y BadGzipFile si llega comprimido)
+            RECORDER.add("http_errors")
+            if attempt >= retries:
+                raise
+        finally:
+            # La lectura por bloques cierra la respuesta al terminar
+            if response is not None and not streaming:
+                response.close()
+        
+        # Espera exponencial con algo de aleatoriedad para no sincronizar los hilos
+        RECORDER.add("http_retries")
+        time.sleep(backoff * 2**attempt * (1 + random.random() / 2))
+        attempt += 1
+
+
+def _parseChunks(reader, response):
+    """
+        Recorre los bloques de un lector de pd.read_csv() midiendo la
+        lectura de cada uno en RECORDER, y cierra la respuesta al terminar.
+    """
+    try:
+        while True:
+            with RECORDER.span("parse", chunked = True) as info:
+                chunk = next(reader, None)
+                info["rows"] = 0 if chunk is None else len(chunk)
+            if chunk is None:
+                return
+            RECORDER.add("rows_parsed", len(chunk))
+            yield chunk
+    finally:
+        response.close()
+
+
+#%% TAMAÑO DE LOS PAQUETES
+
+
+class BatchSizer:
+    """
+        Decide cuántos (estado, año) se piden juntos en cada petición a
+        CrashAPI, que corta sin avisar las respuestas demasiado grandes.
+        Empieza en 'size' y lo duplica con cada paquete completo hasta que
+        uno llega incompleto; desde entonces crece de uno en uno sin llegar
+        al tamaño que falló, y ante otro paquete incompleto se reduce a la
+        mitad. Lo aprendido se guarda en 'path' para los siguientes arranques.
+        
+        Un paquete se considera incompleto si le falta algún (estado, año)
+        pedido que no se sepa vacío, o si tiene tantas filas como el máximo
+        por respuesta ya observado ('row_cap'). Los paquetes incompletos se
+        parten en dos y se vuelven a pedir (ver _fetchBatch()).
+        
+        path : str             -> Fichero JSON con los límites aprendidos.
+                                    None para no guardarlos.
+        size : int             -> Tamaño inicial, en (estado, año) por petición.
+        max_size : int         -> Tamaño máximo.
+    """
+    
+    def __init__(self, path : str = os.path.join(CACHE_DIR, "batch_limits.json"), size : int = 5, 
+                 max_size : int = 64):
+        self.path = path
+        self.size = size
+        self.max_size = max_size
+        
+        # Menor tamaño con el que se ha perdido información, filas a las que
+        # se ha visto cortar una respuesta y (estado, año) vacíos en la API
+        self.ceiling = None
+        self.row_cap = None
+        self.empty = set()
+        
+        # Estadísticas de uso
+        self.splits = 0
+        
+        self._lock = threading.Lock()
+        self._load()
+    
+    
+    def _load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, encoding = "utf-8") as f:
+                limits = json.load(f)
+            self.size = min(int(limits["size"]), self.max_size)
+            self.ceiling = limits.get("ceiling")
+            self.row_cap = limits.get("row_cap")
+            self.empty = {tuple(pair) for pair in limits.get("empty", [])}
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    
+    
+    def _save(self):
+        """
+            Guarda los límites. Se llama con el cerrojo tomado.
+        """
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            with open(self.path + ".tmp", "w", encoding = "utf-8") as f:
+                json.dump({"size": self.size, "ceiling": self.ceiling, "row_cap": self.row_cap,
+                           "empty": sorted(self.empty)}, f)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as error:
+            print("No se han podido guardar los límites de los paquetes:", error)
+    
+    
+    def statesPerBatch(self, years : int) -> int:
+        """
+            Número de estados por petición para pedir 'years' años de cada uno.
+        """
+        with self._lock:
+            return max(1, self.size // max(1, years))
+    
+    
+    def truncated(self, rows : int, split : dict) -> bool:
+        """
+            Indica si la respuesta de un paquete parece incompleta.
+            
+            rows : int             -> Filas de la respuesta.
+            split : dict           -> Respuesta separada con _splitByStateYear().
+        """
+        with self._lock:
+            if self.row_cap is not None and rows >= self.row_cap:
+                return True
+            return any(len(df) == 0 and key not in self.empty for key, df in split.items())
+    
+    
+    def complete(self, units : int, split : dict):
+        """
+            Registra un paquete de 'units' (estado, año) que ha llegado
+            completo, y hace crecer el tamaño si el paquete lo alcanzaba.
+        """
+        with self._lock:
+            changed = False
+            
+            # Un (estado, año) pedido solo y vacío lo está de verdad
+            if units == 1:
+                for key, df in split.items():
+                    if len(df) == 0 and key not in self.empty:
+                        self.empty.add(key)
+                        changed = True
+            
+            # Solo un paquete del tamaño previsto demuestra que este se admite
+            years = len({each_year for _, each_year in split})
+            if units >= max(1, self.size // years) * years:
+                grown = self.size * 2 if self.ceiling is None else min(self.size + 1, self.ceiling - 1)
+                grown = max(1, min(grown, self.max_size))
+                changed = changed or grown != self.size
+                self.size = grown
+            
+            if changed:
+                self._save()
+    
+    
+    def split(self, units : int, rows : int, complete_rows : int):
+        """
+            Registra un paquete de 'units' (estado, año) que parecía
+            incompleto y se ha pedido en partes.
+            
+            units : int            -> Tamaño del paquete.
+            rows : int             -> Filas de su respuesta.
+            complete_rows : int    -> Filas de las partes pedidas por separado.
+        """
+        with self._lock:
+            self.splits += 1
+            
+            if complete_rows > rows:
+                # Se había perdido información: el paquete era demasiado grande
+                self.ceiling = units if self.ceiling is None else min(self.ceiling, units)
+                self.size = max(1, min(self.size, units // 2))
+                if rows > 0:
+                    self.row_cap = rows if self.row_cap is None else min(self.row_cap, rows)
+            elif self.row_cap is not None and rows >= self.row_cap:
+                # Estaba completo pero llegaba al máximo de filas, que no se
+                # sube para seguir detectando cortes: no repetir ese tamaño
+                self.ceiling = units if self.ceiling is None else min(self.ceiling, units)
+                self.size = max(1, min(self.size, units - 1))
+            
+            self._save()
+    
+    
+    def reset(self):
+        """
+            Olvida los límites aprendidos, por ejemplo si cambia la API.
+        """
+        with self._lock:
+            self.size, self.ceiling, self.row_cap, self.empty = 5, None, None, set()
+            self._save()
+    
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": self.size, "ceiling": self.ceiling, "row_cap": self.row_cap, "splits": self.splits}
+
+
+# Tamaño de los paquetes compartido por todas las peticiones
+BATCH_SIZER = BatchSizer()
+RECORDER.watch("batches", lambda: BATCH_SIZER.stats())
+
+
+#%% OBTENCION DE LA BASE DE DATOS
+
+
+def getDataframe(states: list[int], year : int = 2014, request_together : int = None, 
+                 workers : int = 4, columns : list[str] = None, 
+                 progress = None, cancel : threading.Event = None, 
+                 to_year : int = None) -> pd.DataFrame:
+    """
+        Obtiene la base de datos de accidentes de CrashAPI
+        a partir de una lista de estados (siguiendo el código
+        especificado en STATE_CODES)
+        
+        states : list[int]     -> Lista de estados de los que obtener 
+                                    información. Los enteros deben
+                                    estar en STATE_CODES
+        year : int             -> Año del que obtener información.
+                                    Debe estar entre 2010 y 2021
+                                    ambos inclusive.
+        request_together : int -> Número de estados que pedir juntos
+                                    a CrashAPI para reducir tiempo
+                                    de espera. Por defecto lo decide
+                                    BATCH_SIZER según lo aprendido. Los
+                                    paquetes que llegan incompletos por
+                                    el límite de la API se parten y se
+                                    vuelven a pedir.
+        workers : int          -> Número de paquetes que se piden a la vez.
+                                    El ritmo total sigue limitado por
+                                    RATE_LIMITER.
+        columns : list[str]    -> Columnas que devolver. Por defecto todas.
+                                    Por ejemplo PREPROCESS_COLUMNS para
+                                    usar después preprocess().
+        progress : callable    -> Función progress(hechos, total) a la que
+                                    se llama al terminar cada paquete.
+        cancel : threading.Event -> Si se activa, los paquetes pendientes
+                                    no se piden y el resultado queda
+                                    incompleto.
+        to_year : int          -> Último año del rango, si se quieren
+                                    varios años (de year a to_year
+                                    ambos inclusive). Cada paquete pide
+                                    todo el rango en una sola petición.
+    """
+    import pandas as pd
+    
+    df = pd.DataFrame()
+    
+    if to_year is None:
+        to_year = year
+    
+    #Comprobar si los datos son del tipo correcto y sus valores con adecuados
+    try:
+        for i in states:
+            if not isinstance(i, int) or i not in list(STATE_CODES.values()):
+                raise TypeError
+        if not isinstance(year, int) or not isinstance(to_year, int):
+            raise TypeError
+        if (year > 2021 or year < 2010 or to_year > 2021 or to_year < year):
+            raise ValueError
+        if (request_together is not None and not isinstance(request_together, int)) or not isinstance(workers, int):
+            raise TypeError
+    
+    except TypeError:
+        print("Los argumentos de la función get_dataframe deben ser una lista de enteros para 'states' y un entero solo para 'year y 'request_together'")
+    except ValueError:
+        print("El argumento year de la función get_dataframe debe ser un entero entre 2011 y 2022 ambos inclusive")        
+    else:
+        
+        # Separar los (estado, año) que ya están en la caché de los que hay que pedir
+        held, batches = planRequests(states, year, request_together, columns, to_year)
+        
+        def fetch(batch : tuple[str, int, int]) -> dict:
+            if cancel is not None and cancel.is_set():
+                return dict()
+            return _fetchBatch(*batch)
+        
+        # Llamadas simultáneas a la API, solo para los estados y años que faltan
+        with ThreadPoolExecutor(max_workers = max(1, workers)) as executor:
+            futures = [executor.submit(fetch, batch) for batch in batches]
+            
+            for done, future in enumerate(as_completed(futures), start = 1):
+                for key, state_df in future.result().items():
+                    held[key] = state_df if columns is None else state_df[[column for column in columns if column in state_df.columns]]
+                
+                if progress is not None:
+                    progress(done, len(batches))
+        
+        # El índice de la caché se escribe una sola vez por llamada
+        CACHE.flush()
+        
+        # Una única concatenación, por años y en el orden en que se pidieron los estados
+        frames = [held[(code, each_year)] for each_year in range(year, to_year + 1) 
+                  for code in states if (code, each_year) in held]
+        if frames:
+            df = pd.concat(frames)
+    
+    return df
+
+
+def planRequests(states : list[int], year : int, request_together : int = None, 
+                 columns : list[str] = None, to_year : int = None, 
+                 revalidate : bool = True) -> tuple[dict, list[tuple[str, int, int]]]:
+    """
+        Planifica las peticiones necesarias para obtener 'states' entre
+        'year' y 'to_year'. Devuelve un diccionario 
+        {(código de estado, año): dataframe} con lo que ya está en la caché
+        y la lista de paquetes (estados, primer año, último año) que faltan,
+        con los estados como string del tipo "1,2,4".
+        
+        Los años que le faltan a cada estado se agrupan en tramos seguidos,
+        y los estados con el mismo tramo se piden juntos, de request_together
+        en request_together, usando el rango de años de la API en una sola
+        petición. Los que han caducado se vuelven a pedir en el mismo paquete
+        con el que se guardaron, para que el servidor pueda responder 304
+        aunque hayan cambiado los estados elegidos o el tamaño de los paquetes.
+        
+        states : list[int]     -> Lista de estados según STATE_CODES.
+        year : int             -> Primer año del que obtener información.
+        request_together : int -> Número máximo de estados por paquete. Por
+                                    defecto, los que BATCH_SIZER admite para
+                                    el número de años de cada tramo.
+        columns : list[str]    -> Columnas que cargar de la caché.
+        to_year : int          -> Último año. Por defecto, solo 'year'.
+        revalidate : bool      -> Volver a pedir los paquetes guardados de lo
+                                    que ha caducado. Los paquetes incluyen
+                                    entonces estados y años no pedidos. False
+                                    para pedir solo 'states' de 'year' a 'to_year'.
+    """
+    
+    if to_year is None:
+        to_year = year
+    
+    # Sin conexión: todo sale de la instantánea y no se pide nada
+    if SNAPSHOT is not None:
+        held = {(code, each_year): SNAPSHOT.get(code, each_year, columns) 
+                for code in dict.fromkeys(states) for each_year in range(year, to_year + 1)}
+        return held, list()
+    
+    held = dict()
+    missing = dict()
+    # Paquetes caducados que se vuelven a pedir igual, sin repetir
+    replays = dict()
+    
+    for code in dict.fromkeys(states):
+        
+        # Tramos de años seguidos que faltan en la caché para este estado
+        spans = list()
+        for each_year in range(year, to_year + 1):
+            df = CACHE.get(str(code), each_year, columns)
+            stored = None if df is not None or not revalidate else _storedBatch(code, each_year)
+            if df is not None:
+                held[(code, each_year)] = df
+            elif stored is not None:
+                replays[stored] = None
+            elif spans and spans[-1][1] == each_year - 1:
+                spans[-1][1] = each_year
+            else:
+                spans.append([each_year, each_year])
+        
+        for first, last in spans:
+            missing.setdefault((first, last), list()).append(code)
+    
+    # Conversión de cada paquete a string sin espacios ni corchetes
+    batches = list(replays)
+    for (first, last), codes in missing.items():
+        together = BATCH_SIZER.statesPerBatch(last - first + 1) if request_together is None else max(1, request_together)
+        for i in range(0, len(codes), together):
+            batches.append((",".join(str(code) for code in codes[i:i + together]), first, last))
+    
+    return held, batches
+
+
+def _splitByStateYear(df : pd.DataFrame, codes : list[int], years : range) -> dict:
+    """
+        Separa la respuesta de un paquete en un dataframe por (estado, año)
+        usando las columnas 'statename' y 'crashdate'. Los pares pedidos sin
+        ningún accidente reciben un dataframe vacío para que también
+        queden en la caché.
+        
+        df : pd.DataFrame      -> Respuesta de CrashAPI para varios estados.
+        codes : list[int]      -> Estados que se pidieron en el paquete.
+        years : range          -> Años que se pidieron en el paquete.
+    """
+    import pandas as pd
+    
+    split = {(code, year): df.iloc[0:0] for code in codes for year in years}
+    if df.empty:
+        return split
+    
+    # Código de cada fila según su nombre, o la columna 'state' si no se reconoce
+    row_codes = df["statename"].map(STATE_CODES)
+    if "state" in df.columns:
+        row_codes = row_codes.fillna(df["state"])
+    
+    # Año de cada fila, el único grupo de cuatro cifras tras una barra de "dd/mm/yyyy"
+    if len(years) == 1:
+        row_years = pd.Series(years[0], index = df.index)
+    else:
+        row_years = pd.to_numeric(df["crashdate"].str.extract(r"/(\d{4})", expand = False))
+    
+    for (code, year), group in df.groupby([row_codes.to_numpy(), row_years.to_numpy()], sort = False):
+        split[(int(code), int(year))] = group
+    
+    return split
+
+
+def _crashAPIUrl(states : str, year : int, to_year : int = None) -> str:
+    """
+        Dirección de CrashAPI para un paquete de estados y un año o rango de años.
+    """
+    return (CRASHAPI_URL + "/crashes/GetCaseList?states=" + states + 
+            "&fromYear=" + str(year) + "&toYear=" + str(year if to_year is None else to_year) + 
+            "&minNumOfVehicles=1&maxNumOfVehicles=6&format=csv")
+
+
+def _storedBatch(code : int, year : int) -> tuple[str, int, int]:
+    """
+        Paquete (estados, primer año, último año) con el que se descargó
+        (code, year), si está en la caché y se puede revalidar pidiendo
+        la misma dirección a la API actual. Si no, None.
+        
+        Revalidar un paquete lo pide entero, con todos sus estados y años.
+        Por eso solo se devuelve si todas sus entradas siguen en la caché
+        con esos validadores: si no, la respuesta sería una descarga completa
+        del paquete, más cara que pedir solo lo que falta.
+    """
+    source = CACHE.source(str(code), year)
+    if source is None:
+        return None
+    
+    query = parse_qs(urlsplit(source["url"]).query)
+    try:
+        batch = (query["states"][0], int(query["fromYear"][0]), int(query["toYear"][0]))
+    except (KeyError, ValueError):
+        return None
+    
+    # Otra API u otros parámetros: no sirve para revalidar
+    if _crashAPIUrl(*batch) != source["url"]:
+        return None
+    
+    # Alguna entrada del paquete ya no está o viene de otra descarga
+    if CACHE.validators(source["url"], batch[0].split(","), range(batch[1], batch[2] + 1)) is None:
+        return None
+    return batch
+
+
+def _fetchBatch(states : str, year : int, to_year : int = None, cut : int = None) -> dict:
+    """
+        Pide un paquete de estados a CrashAPI, lo separa por estado y año
+        y guarda cada parte en CACHE. Devuelve {(estado, año): dataframe}.
+        
+        states : str           -> Estados separados por comas ("1,2,4").
+        year : int             -> Año del que obtener información.
+        to_year : int          -> Último año del rango. Por defecto, solo 'year'.
+        cut : int              -> Filas del paquete cortado del que sale este,
+                                    si lo hay. Una parte que llega a tantas
+                                    filas también está cortada.
+    """
+    
+    if to_year is None:
+        to_year = year
+    
+    url = _crashAPIUrl(states, year, to_year)
+    codes = [int(code) for code in states.split(",")]
+    years = range(year, to_year + 1)
+    
+    # Si el paquete ya se descargó entero y ha caducado, se pide de forma condicional
+    validators = CACHE.validators(url, states.split(","), years) or dict()
+    
+    # Petición a la API según parámetros
+    df = _downloadCSV(url, validators = validators)
+    
+    if df is None:
+        # Sin cambios (304): renovar las entradas de la caché y usarlas
+        split = dict()
+        for code in codes:
+            for each_year in years:
+                CACHE.refresh(str(code), each_year)
+                split[(code, each_year)] = CACHE.get(str(code), each_year)
+        
+        if all(state_df is not None for state_df in split.values()):
+            return split
+        
+        # Alguna entrada se ha perdido mientras tanto: descargar el paquete completo
+        validators = dict()
+        df = _downloadCSV(url, validators = validators)
+    
+    split = _splitByStateYear(df, codes, years)
+    units = len(codes) * len(years)
+    
+    # Paquete cortado por el límite de la API: pedirlo en dos mitades. El
+    # límite aún no se conoce hasta que vuelven las partes, así que estas se
+    # comparan con las filas del paquete del que salen
+    if units > 1 and (BATCH_SIZER.truncated(len(df), split) or (cut is not None and len(df) >= cut)):
+        RECORDER.add("batch_splits")
+        
+        if len(codes) > 1:
+            half = len(codes) // 2
+            parts = [(codes[:half], year, to_year), (codes[half:], year, to_year)]
+        else:
+            half = year + len(years) // 2
+            parts = [(codes, year, half - 1), (codes, half, to_year)]
+        
+        part_cut = len(df) if cut is None else min(cut, len(df))
+        complete = dict()
+        for part_codes, first, last in parts:
+            complete.update(_fetchBatch(",".join(str(code) for code in part_codes), first, last, part_cut or None))
+        
+        BATCH_SIZER.split(units, len(df), sum(len(state_df) for state_df in complete.values()))
+        return complete
+    
+    BATCH_SIZER.complete(units, split)
+    
+    for (code, each_year), state_df in split.items():
+        CACHE.put(str(code), each_year, state_df, dict(validators, url = url))
+    
+    return split
+
+
+def requestCrashAPI(states: str, year : int = 2014) -> pd.DataFrame:
+    """
+        Obtiene la base de datos de accidentes de CrashAPI
+        a para un único estado estados (siguiendo el código
+        especificado en STATE_CODES). La base de datos queda
+        en la caché persistente CACHE separada por (estado, año),
+        y solo se piden a la API los estados que no estén ya en ella.
+        
+        states : str           -> Estados del que obtener información.
+                                    Debe ser una string con un entero
+                                    elegido según STATE_CODES
+        year : int             -> Año del que obtener información.
+                                    Debe estar entre 2010 y 2021
+                                    ambos inclusive.
+    """
+    import pandas as pd
+    
+    try:
+        if not isinstance(states, str):
+            raise TypeError
+        if year > 2021 or year < 2010:
+            raise ValueError
+    
+    except TypeError:
+        print("El argumento states de la función get_dataframe debe contener solo int")
+    except ValueError:
+        print("El argumento year de la función get_dataframe debe ser un entero entre 2011 y 2022 ambos inclusive")
+    else:
+        
+        # Buscar primero en la caché y pedir el resto en un único paquete
+        codes = [int(code) for code in states.split(",")]
+        held, batches = planRequests(codes, year, len(codes))
+        for batch in batches:
+            held.update(_fetchBatch(*batch))
+        CACHE.flush()
+        
+        return pd.concat([held[(code, year)] for code in codes])
+
+
+def countAccidentsStreaming(states : list[int], year : int = 2014, request_together : int = 5, 
+                            workers : int = 4, chunksize : int = 10000) -> pd.DataFrame:
+    """
+        Cuenta los accidentes por estado sin llegar a guardar la base de
+        datos completa en memoria. Los estados que están en la caché se
+        cuentan leyendo solo su columna 'statename'; el resto se descargan
+        leyendo únicamente esa columna, en bloques de 'chunksize' filas
+        que se suman a los totales según llegan. Las descargas de este modo
+        no se guardan en la caché.
+        
+        Devuelve el mismo resultado que groupCountAccidents(preprocess(df)).
+        
+        states : list[int]     -> Lista de estados según STATE_CODES.
+        year : int             -> Año del que obtener información.
+        request_together : int -> Número de estados que pedir juntos.
+        workers : int          -> Número de paquetes que se piden a la vez.
+        chunksize : int        -> Filas leídas en cada bloque.
+    """
+    import pandas as pd
+    
+    # Lo descargado aquí no se guarda en la caché: no hay nada que revalidar,
+    # y los paquetes deben traer solo los estados y el año pedidos
+    held, batches = planRequests(states, year, request_together, COUNT_COLUMNS, revalidate = False)
+    
+    totals = dict()
+    lock = threading.Lock()
+    
+    def add(counts : pd.Series):
+        with lock:
+            for name, count in counts.items():
+                totals[name] = totals.get(name, 0) + int(count)
+    
+    for state_df in held.values():
+        if len(state_df):
+            add(state_df["statename"].value_counts(sort = False))
+    
+    def stream(batch : tuple[str, int, int]):
+        for chunk in _downloadCSV(_crashAPIUrl(*batch), usecols = COUNT_COLUMNS, chunksize = chunksize):
+            add(chunk["statename"].value_counts(sort = False))
+    
+    with ThreadPoolExecutor(max_workers = max(1, workers)) as executor:
+        list(executor.map(stream, batches))
+    
+    # Mismo formato que groupCountAccidents()
+    accident_count = pd.DataFrame({"accidents": pd.Series(totals, dtype = "int64")})
+    accident_count = accident_count[accident_count["accidents"] > 0].sort_index()
+    accident_count.index = accident_count.index.astype(str)
+    accident_count.index.name = "statename"
+    
+    return accident_count
+
+
+#%% DESCARGA ANTICIPADA DE AÑOS
+
+
+# Años disponibles en CrashAPI
+YEARS = range(2010, 2022)
+
+
+class Prefetcher:
+    """
+        Descarga en segundo plano, mientras el usuario no hace nada, los
+        años vecinos al año elegido y después el resto de YEARS, para los
+        estados elegidos. Las descargas pasan por la caché y por
+        RATE_LIMITER como cualquier otra petición, de una en una, y se
+        detienen en cuanto el usuario vuelve a interactuar.
+        
+        Tras un fallo espera idle_seconds, y el doble tras cada fallo
+        seguido, hasta max_backoff. Los (estado, año) que fallan
+        max_failures veces no se vuelven a intentar en esta sesión.
+        
+        idle_seconds : float   -> Segundos sin actividad del usuario antes
+                                    de empezar a descargar.
+        request_together : int -> Número de estados por paquete. Por defecto,
+                                    según BATCH_SIZER.
+        max_failures : int     -> Fallos de un (estado, año) antes de dejarlo.
+        max_backoff : float    -> Segundos máximos de espera tras los fallos.
+    """
+    
+    def __init__(self, idle_seconds : float = 2.0, request_together : int = None, 
+                 max_failures : int = 3, max_backoff : float = 300.0):
+        self.idle_seconds = idle_seconds
+        self.request_together = request_together
+        self.max_failures = max_failures
+        self.max_backoff = max_backoff
+        
+        # Fallos seguidos, fallos de cada (estado, año) y los ya descartados
+        self._consecutive_failures = 0
+        self._failures = dict()
+        self._given_up = set()
+        
+        self._year = None
+        self._states = list()
+        self._last_activity = time.monotonic()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+    
+    
+    def touch(self):
+        """
+            Registra actividad del usuario, lo que pausa las descargas.
+        """
+        self._last_activity = time.monotonic()
+    
+    
+    def request(self, year : int, states : list[int]):
+        """
+            Centra las descargas en 'year' para la lista de estados 'states'.
+        """
+        with self._lock:
+            self._year = year
+            self._states = list(states)
+        self._wake.set()
+    
+    
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+    
+    
+    def _idle(self) -> bool:
+        return time.monotonic() - self._last_activity >= self.idle_seconds
+    
+    
+    def _nextBatch(self) -> tuple[str, int, int]:
+        """
+            Siguiente paquete (estados, primer año, último año) que
+            descargar, empezando por los años más cercanos al elegido. Los
+            que han caducado se piden en el paquete con el que se guardaron,
+            como en planRequests(). Devuelve None si ya está todo en la caché.
+        """
+        with self._lock:
+            year, states = self._year, self._states
+        
+        # Con una instantánea no hay nada que descargar
+        if year is None or SNAPSHOT is not None:
+            return None
+        
+        for each_year in sorted(YEARS, key = lambda y: (abs(y - year), y)):
+            missing = [code for code in states 
+                       if (code, each_year) not in self._given_up and not CACHE.contains(str(code), each_year)]
+            for code in missing:
+                stored = _storedBatch(code, each_year)
+                if stored is not None:
+                    return stored
+            if missing:
+                together = BATCH_SIZER.statesPerBatch(1) if self.request_together is None else self.request_together
+                return ",".join(str(code) for code in missing[:together]), each_year, each_year
+        
+        return None
+    
+    
+    def _run(self):
+        while not self._stop.is_set():
+            
+            # Esperar a que el usuario deje de interactuar
+            if not self._idle():
+                self._wake.wait(self.idle_seconds)
+                self._wake.clear()
+                continue
+            
+            batch = self._nextBatch()
+            if batch is None:
+                # Todo descargado, esperar a una nueva petición
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            
+            try:
+                _fetchBatch(*batch)
+                CACHE.flush()
+                self._consecutive_failures = 0
+            except Exception:
+                # Un fallo de la descarga anticipada no debe afectar a la interfaz,
+                # ni repetirse sin fin contra la API (sin conexión, errores 400...)
+                self._failed(batch)
+                self._stop.wait(min(self.idle_seconds * 2 ** (self._consecutive_failures - 1), self.max_backoff))
+    
+    
+    def _failed(self, batch : tuple[str, int, int]):
+        """
+            Cuenta un fallo de cada (estado, año) del paquete y descarta
+            los que llegan a max_failures.
+        """
+        self._consecutive_failures += 1
+        states, year, to_year = batch
+        for code in states.split(","):
+            for each_year in range(year, to_year + 1):
+                key = (int(code), each_year)
+                self._failures[key] = self._failures.get(key, 0) + 1
+                if self._failures[key] >= self.max_failures:
+                    self._given_up.add(key)
+
+
+#%% INSTANTÁNEA SIN CONEXIÓN
+
+
+class Snapshot:
+    """
+        Instantánea de la base de datos en un único fichero por columnas,
+        para usar el visualizador sin conexión. Las filas están ordenadas
+        por año y estado, de forma que cada (estado, año) es un tramo
+        seguido de cada columna, y un pequeño índice en la cabecera indica
+        dónde empieza y acaba.
+        
+        Al abrirla solo se lee la cabecera. Cada columna se proyecta en
+        memoria (np.memmap) la primera vez que se usa, y get() devuelve
+        vistas de los tramos pedidos sin copiarlos, así que solo se leen
+        del disco las páginas que se llegan a usar.
+        
+        Formato: MAGIC, longitud de la cabecera (8 bytes), cabecera JSON y
+        cada columna alineada a ALIGN bytes. Las columnas de texto con
+        pocos valores distintos (statename, countyname) se guardan como
+        códigos enteros y una lista de categorías en la cabecera; el resto
+        del texto como bytes de ancho fijo.
+        
+        path : str             -> Fichero de la instantánea.
+    """
+    
+    MAGIC = b"CRASHSNAP1\n"
+    ALIGN = 64
+    
+    # Columnas de texto guardadas como categorías
+    CATEGORICAL = ("statename", "countyname")
+    
+    def __init__(self, path : str):
+        self.path = path
+        
+        with open(path, "rb") as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(path + " no es una instantánea de la base de datos")
+            length = int.from_bytes(f.read(8), "little")
+            self.header = json.loads(f.read(length).decode("utf-8"))
+        
+        self.index = {tuple(int(part) for part in key.split("_")): span 
+                      for key, span in self.header["index"].items()}
+        self._columns = dict()
+        self._lock = threading.Lock()
+    
+    
+    def _column(self, name : str):
+        """
+            Proyección en memoria de una columna completa, sin leerla.
+        """
+        import numpy as np
+        
+        with self._lock:
+            if name not in self._columns:
+                column = self.header["columns"][name]
+                self._columns[name] = np.memmap(self.path, dtype = np.dtype(column["dtype"]), mode = "r", 
+                                                offset = column["offset"], shape = (self.header["rows"],))
+            return self._columns[name]
+    
+    
+    def contains(self, state : int, year : int) -> bool:
+        return (state, year) in self.index
+    
+    
+    def get(self, state : int, year : int, columns : list[str] = None) -> pd.DataFrame:
+        """
+            Dataframe de un estado y un año, vacío si no está en la
+            instantánea. Las columnas numéricas y los códigos de las
+            categorías son vistas del fichero proyectado en memoria.
+            
+            state : int            -> Código del estado según STATE_CODES.
+            year : int             -> Año.
+            columns : list[str]    -> Columnas que devolver. Por defecto todas.
+        """
+        import pandas as pd
+        
+        start, stop = self.index.get((state, year), (0, 0))
+        
+        data = dict()
+        for name, column in self.header["columns"].items():
+            if columns is not None and name not in columns:
+                continue
+            
+            values = self._column(name)[start:stop]
+            if "categories" in column:
+                data[name] = pd.Categorical.from_codes(values, categories = column["categories"])
+            elif values.dtype.kind == "S":
+                # El texto de ancho fijo se convierte solo en el tramo pedido
+                data[name] = values.astype(str).astype(object)
+            else:
+                data[name] = values
+        
+        return pd.DataFrame(data, copy = False)
+    
+    
+    @classmethod
+    def write(cls, path : str, slices : dict):
+        """
+            Escribe una instantánea a partir de {(estado, año): dataframe},
+            con los dataframes tal como los devuelve getDataframe().
+            
+            path : str             -> Fichero que crear.
+            slices : dict          -> Datos de cada (estado, año).
+        """
+        import numpy as np
+        import pandas as pd
+        
+        # Filas ordenadas por año y estado, y dónde empieza cada (estado, año)
+        keys = sorted(slices, key = lambda key: (key[1], key[0]))
+        frames = [slices[key] for key in keys]
+        df = pd.concat(frames, ignore_index = True) if frames else pd.DataFrame()
+        
+        index = dict()
+        start = 0
+        for key, frame in zip(keys, frames):
+            index[str(key[0]) + "_" + str(key[1])] = [start, start + len(frame)]
+            start += len(frame)
+        
+        # Cada columna como un array de tipo fijo
+        arrays = dict()
+        header = {"version": 1, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "rows": len(df), 
+                  "columns": dict(), "index": index}
+        
+        for name in df.columns:
+            column = df[name]
+            
+            if name in cls.CATEGORICAL:
+                categorical = pd.Categorical(column.astype(str))
+                codes = categorical.codes
+                arrays[name] = codes.astype(np.int8 if len(categorical.categories) < 128 else np.int32)
+                header["columns"][name] = {"categories": [str(c) for c in categorical.categories]}
+            elif column.dtype.kind in "iufb":
+                arrays[name] = column.to_numpy()
+                header["columns"][name] = dict()
+            else:
+                arrays[name] = column.astype(str).to_numpy().astype("S")
+                header["columns"][name] = dict()
+            
+            header["columns"][name]["dtype"] = arrays[name].dtype.str
+        
+        # Posición de cada columna, alineada, tras la cabecera
+        def align(position : int) -> int:
+            return -(-position // cls.ALIGN) * cls.ALIGN
+        
+        # La longitud de la cabecera depende de las posiciones; se repite hasta que no cambia
+        offset = 0
+        while True:
+            position = align(len(cls.MAGIC) + 8 + offset)
+            for name, array in arrays.items():
+                header["columns"][name]["offset"] = position
+                position = align(position + array.nbytes)
+            encoded = json.dumps(header).encode("utf-8")
+            if len(encoded) == offset:
+                break
+            offset = len(encoded)
+        
+        with open(path + ".tmp", "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(len(encoded).to_bytes(8, "little"))
+            f.write(encoded)
+            for name, array in arrays.items():
+                f.write(b"\0" * (header["columns"][name]["offset"] - f.tell()))
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(path + ".tmp", path)
+
+
+# Instantánea activa. Si se indica, getDataframe() y el resto de funciones
+# de obtención leen de ella y no piden nada a CrashAPI. La variable de
+# entorno CRASHDATA_SNAPSHOT permite arrancar directamente sin conexión
+SNAPSHOT = Snapshot(os.environ["CRASHDATA_SNAPSHOT"]) if os.environ.get("CRASHDATA_SNAPSHOT") else None
+
+
+def useSnapshot(path : str = None):
+    """
+        Pasa a leer los datos de la instantánea 'path', o vuelve a
+        pedirlos a CrashAPI si 'path' es None.
+    """
+    global SNAPSHOT
+    SNAPSHOT = None if path is None else Snapshot(path)
+
+
+def exportSnapshot(path : str, states : list[int] = None, years : range = YEARS, 
+                   request_together : int = None, workers : int = 4, progress = None) -> int:
+    """
+        Descarga (o toma de la caché) todos los estados y años y los guarda
+        en una instantánea para usar el visualizador sin conexión.
+        Devuelve el número de filas guardadas.
+        
+        path : str             -> Fichero de la instantánea.
+        states : list[int]     -> Estados según STATE_CODES. Por defecto todos.
+        years : range          -> Años seguidos. Por defecto YEARS.
+        request_together : int -> Número de estados por petición. Por defecto,
+                                    según BATCH_SIZER.
+        workers : int          -> Número de peticiones a la vez.
+        progress : callable    -> Función progress(hechos, total) por paquete.
+    """
+    
+    if states is None:
+        states = list(STATE_CODES.values())
+    
+    # Todos los años de cada paquete en una sola petición
+    held, batches = planRequests(states, years[0], request_together, to_year = years[-1])
+    
+    with ThreadPoolExecutor(max_workers = max(1, workers)) as executor:
+        futures = [executor.submit(_fetchBatch, *batch) for batch in batches]
+        for done, future in enumerate(as_completed(futures), start = 1):
+            held.update(future.result())
+            if progress is not None:
+                progress(done, len(batches))
+    CACHE.flush()
+    
+    Snapshot.write(path, held)
+    
+    return sum(len(df) for df in held.values())
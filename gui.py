@@ -0,0 +1,729 @@
+# -*- coding: utf-8 -*-
+"""
+Interfaz gráfica del visualizador de accidentes. La ventana se muestra
+antes de cargar pandas, matplotlib y cartopy, que se importan en segundo
+plano mientras tanto.
+"""
+
+from __future__ import annotations
+
+#%% DEPENDENCIAS
+
+
+# Interfaz gráfica
+import PySimpleGUI as sg
+
+# Trabajo en segundo plano
+import threading
+import time
+
+from crashdata import (STATE_CODES, YEARS, CACHE, PREPROCESS_COLUMNS, COUNTY_COLUMNS, MEASURES, 
+                       getDataframe, Prefetcher)
+from classification import SCHEMES, Classifier
+from instrumentation import RECORDER
+
+
+#%% DEFINICIÓN DE LA INTERFAZ GRÁFICA
+
+
+# Periodos que se pueden elegir en la interfaz y sus meses
+PERIODS = {'Todo el año': None,
+           'Enero': [1], 'Febrero': [2], 'Marzo': [3], 'Abril': [4], 
+           'Mayo': [5], 'Junio': [6], 'Julio': [7], 'Agosto': [8], 
+           'Septiembre': [9], 'Octubre': [10], 'Noviembre': [11], 'Diciembre': [12],
+           'Invierno (dic-feb)': [12, 1, 2], 'Primavera (mar-may)': [3, 4, 5],
+           'Verano (jun-ago)': [6, 7, 8], 'Otoño (sep-nov)': [9, 10, 11]}
+
+
+def make_window(theme : sg.theme) -> sg.Window:
+    """
+        Define y genera la interaz gráfica de PySimpleGUI.
+        
+        theme : sg.theme       -> Tema elegido para la interfaz. Se define como
+                                    sg.theme("green mono") por defecto
+    """
+    
+    # Establece el tema elegido
+    sg.theme(theme)
+    
+    # Define las pestañas principales de la ventana
+    menu_def = [['&Menú', ['&Salir']],
+                ['&Ayuda', ['&¿Cómo usar el visualizador?']] ]
+    
+    # Define lo que aparece al hacer click derecho
+    right_click_menu_def = [[], ['&Salir']]
+    
+    # Define la colocación de los elementos y widgets de la aplicación en la primera pestaña de la aplicación
+    main_layout =  [
+        [sg.Text('Observa la distribucion de accidentes de trafico en Estados Unidos')], 
+        [sg.Slider(orientation = 'h', 
+                      key = '-SLIDER-', 
+                      range = (2010,2021),
+                      pad = 30,
+                      s = (42,20),
+                      enable_events = True),
+         sg.Button('Dibujar', 
+                      key = '-BUTTON-')
+         ], 
+        [sg.Checkbox('Redibujar al mover la barra', 
+                      default = False, 
+                      key = '-SCRUB-'),
+         sg.Button('Reproducir', 
+                      key = '-PLAY-')
+         ],
+        [sg.Checkbox('Hasta el año', 
+                      default = False, 
+                      key = '-RANGE-'),
+         sg.Slider(orientation = 'h', 
+                      key = '-SLIDER TO-', 
+                      range = (2010,2021),
+                      default_value = 2021,
+                      s = (30,20)),
+         sg.Checkbox('Desglose por año', 
+                      default = False, 
+                      key = '-BY YEAR-')
+         ],
+        [sg.Text('Periodo:'),
+         sg.Combo(list(PERIODS), 
+                      default_value = 'Todo el año', 
+                      readonly = True, 
+                      enable_events = True, 
+                      key = '-PERIOD-'),
+         sg.Text('Colores:'),
+         sg.Combo(list(SCHEMES), 
+                      default_value = 'mediana', 
+                      readonly = True, 
+                      enable_events = True, 
+                      key = '-SCHEME-'),
+         sg.Checkbox('Por condados', 
+                      default = False, 
+                      enable_events = True, 
+                      key = '-COUNTIES-')
+         ],
+        [sg.Text('Mostrar:'),
+         sg.Combo(list(MEASURES), 
+                      default_value = 'accidentes', 
+                      readonly = True, 
+                      enable_events = True, 
+                      key = '-MEASURE-')
+         ],
+        [sg.ProgressBar(max_value = 1, 
+                      orientation = 'h', 
+                      size = (30, 10), 
+                      key = '-PROGRESS BAR-'),
+         sg.Text('', 
+                      size = (30, 1), 
+                      key = '-STATUS-')
+         ],
+        [sg.Frame ( 
+            title = "Zona de dibujado",
+            layout = [[
+            sg.Canvas(size = (425,285), 
+                      key = 'plot-canvas', 
+                      border_width = 2, 
+                      background_color = "#11875d"),
+            sg.Canvas(size = (252,151), 
+                      key = 'plot-canvas2', 
+                      border_width = 2, 
+                      background_color = "#11875d")
+            ]]
+        )],
+    ]
+    
+    
+    # Mapas de todos los años a la vez, con los colores, periodo y medida de la primera pestaña
+    years_layout = [
+        [sg.Text('Compara todos los años con los mismos rangos de colores'),
+         sg.Button('Dibujar todos los años', 
+                      key = '-GRID-'),
+         sg.Text('', 
+                      size = (30, 1), 
+                      key = '-GRID STATUS-')
+         ],
+        [sg.Canvas(size = (800,500), 
+                      key = 'grid-canvas', 
+                      border_width = 2, 
+                      background_color = "#11875d")
+         ],
+    ]
+    
+    
+    # Define la colocación de los elementos y widgets de la aplicación en la segunda pestaña de la aplicación
+    # Genera una conjunto de columnas para los seleccionables de los estados
+    # Coloca automáticamente los estados en orden alfabético en columnas de
+    # STATE_PER_COLUMN número de estados
+    STATES_PER_COLUMN = 14
+    
+    states_layout = list()
+    state_columns = list()
+    names = list(STATE_CODES.keys())
+    
+    # Reparte la lista alfabética de estados en las diferentes columnas
+    for column in range(0, int(len(names) / STATES_PER_COLUMN + 1) ):
+        for row in range(0, STATES_PER_COLUMN):
+            if column * STATES_PER_COLUMN + row < len(names):
+                state_columns.append([
+                    sg.Checkbox(str(names[column * STATES_PER_COLUMN + row]), 
+                                default = True, 
+                                key = str(names[column * STATES_PER_COLUMN + row]))
+                        ])
+        
+        states_layout.append(sg.Column(state_columns.copy()))
+        state_columns.clear()
+    
+    states_layout = [states_layout]
+    
+    # Define la colocación de los elementos y widgets de la aplicación en la última pestaña de la aplicación
+    logging_layout = [
+        [sg.Text("Información adicional sobre la base de datos")],
+        [sg.Multiline(size = (60,15), 
+                       font = 'Courier 8', 
+                       expand_x = True, 
+                       expand_y = True, 
+                       write_only = True,
+                       reroute_stdout = True, 
+                       reroute_stderr = True, 
+                       echo_stdout_stderr = True, 
+                       autoscroll = True, 
+                       auto_refresh = True
+                       )],
+        [sg.Text("Tiempo de cada etapa del último dibujo")],
+        [sg.Table(values = [], 
+                       headings = ["Etapa", "Veces", "Total ms", "Media ms", "Máx. ms"], 
+                       key = '-METRICS-', 
+                       num_rows = 7, 
+                       auto_size_columns = False, 
+                       col_widths = [12, 7, 10, 10, 10], 
+                       justification = 'right', 
+                       expand_x = True)],
+        [sg.Text('', 
+                       size = (90, 2), 
+                       key = '-COUNTERS-')],
+        [sg.Checkbox('Medir memoria (más lento)', 
+                       default = False, 
+                       enable_events = True, 
+                       key = '-TRACK MEMORY-'),
+         sg.Button('Exportar JSON lines', 
+                       key = '-EXPORT JSONL-'),
+         sg.Button('Exportar traza de Chrome', 
+                       key = '-EXPORT TRACE-')]
+        ]
+    
+    
+    # Coloca el resto de definiciones en orden y define el menú
+    layout = [ [sg.MenubarCustom(menu_def, 
+                       key = '-MENU-', 
+                       font = 'Courier 15', 
+                       tearoff = True)],
+                [sg.Text('Visualizador de los datos de accidentes en Estados Unidos', 
+                       size = (50, 1), 
+                       justification = 'center', 
+                       font = ("Helvetica", 16), 
+                       relief = sg.RELIEF_RIDGE, 
+                       key = '-TEXT HEADING-', 
+                       enable_events = True)]]
+    
+    
+    layout +=[[sg.TabGroup([
+                       [sg.Tab('Gráfico de Accidentes', main_layout),
+                       sg.Tab('Todos los años', years_layout),
+                       sg.Tab('Estados de Interés', states_layout),
+                       sg.Tab('Información adicional', logging_layout)]
+                       ], 
+                       
+                       key = '-TAB GROUP-', 
+                       expand_x = True, 
+                       expand_y = True),
+               
+               ]]
+    
+    layout[-1].append(sg.Sizegrip())
+    
+    # Define el comportamiento de la ventana de la aplicación
+    window = sg.Window('Accidentes de EEUU', 
+                       layout, 
+                       right_click_menu = right_click_menu_def, 
+                       right_click_menu_tearoff = True, 
+                       grab_anywhere = False, 
+                       resizable = True, 
+                       margins = (0,0), 
+                       use_custom_titlebar = True, 
+                       finalize = True, 
+                       keep_on_top = False,
+                       element_justification = "c"
+                       )
+    
+    window.set_min_size((700,500))
+    
+    # Expande las columnas de la segunda pestaña para que ocupen el tamaño nuevo de la ventana
+    for i in states_layout[0]:
+        i.expand(True, True)
+    
+    return window
+
+def _preload():
+    """
+        Importa en segundo plano los módulos pesados (pandas, matplotlib,
+        cartopy) y prepara los contornos de los estados, para que el primer
+        dibujo no tenga que esperarlos.
+    """
+    # rendering importa a su vez aggregation, y con ella pandas
+    from rendering import STATE_GEOMETRY
+    STATE_GEOMETRY.paths()
+
+
+def _drawWorker(window : sg.Window, job : int, state_codes : list[int], year : int, 
+                cancel : threading.Event, cube, to_year : int = None, counties : bool = False, 
+                months : list[int] = None, prefix : str = '-FETCH'):
+    """
+        Obtiene y procesa los datos de un dibujo fuera del hilo de la interfaz
+        y los añade al cubo de accidentes, del que se cuentan después.
+        Avisa a la ventana del progreso de cada paquete con el evento
+        '-FETCH PROGRESS-' y del resultado con '-FETCH DONE-' o '-FETCH ERROR-',
+        o con los mismos eventos con otro 'prefix'.
+        Si 'cancel' se activa porque ha llegado una petición más nueva,
+        termina sin avisar.
+        
+        window : sg.Window      -> Ventana a la que enviar los eventos.
+        job : int               -> Número de la petición, para descartar
+                                    resultados de peticiones antiguas.
+        state_codes : list[int] -> Estados que pedir a CrashAPI.
+        year : int              -> Año que pedir a CrashAPI.
+        cancel : threading.Event -> Cancelación de la petición.
+        cube : AccidentCube     -> Cubo de accidentes compartido con la ventana.
+        to_year : int           -> Último año si se pide un rango de años.
+                                    El mapa muestra el total del rango.
+        counties : bool         -> Contar también los accidentes por condado,
+                                    que se envían con '-FETCH DONE-'.
+        months : list[int]      -> Meses del periodo elegido, para los condados.
+        prefix : str            -> Comienzo de los eventos: '-FETCH' para el
+                                    mapa o '-GRID' para todos los años.
+    """
+    
+    # pandas se importa aquí, fuera del hilo de la interfaz
+    from aggregation import preprocess, bytesPerRow, groupCountAccidentsByCounty
+    
+    # Comprobar el tiempo de ejecución
+    clock = time.time()
+    
+    try:
+        # Realizar la petición a CrashaPI
+        df = getDataframe(state_codes, year, columns = COUNTY_COLUMNS if counties else PREPROCESS_COLUMNS, 
+                          cancel = cancel, to_year = to_year,
+                          progress = lambda done, total: window.write_event_value(prefix + ' PROGRESS-', (job, done, total)))
+        if cancel.is_set():
+            return
+        
+        df = preprocess(df, counties)
+        cube.update(df, state_codes, range(year, (to_year or year) + 1))
+        
+        # Los condados no caben en el cubo: se cuentan en cada dibujo
+        county_count = groupCountAccidentsByCounty(df, months) if counties else None
+    
+    except Exception as error:
+        if not cancel.is_set():
+            window.write_event_value(prefix + ' ERROR-', (job, repr(error)))
+        return
+    
+    if not cancel.is_set():
+        window.write_event_value(prefix + ' DONE-', (job, bytesPerRow(df), time.time() - clock, county_count))
+
+
+# Milisegundos entre años en el modo de reproducción
+PLAY_INTERVAL = 600
+
+# Milisegundos entre actualizaciones de la tabla de tiempos mientras se dibuja
+METRICS_INTERVAL = 500
+
+
+def _updateMetrics(window : sg.Window, since : float):
+    """
+        Actualiza la tabla de tiempos de la pestaña de información con los
+        intervalos medidos desde 'since', y la línea de contadores con los
+        totales de la sesión.
+        
+        window : sg.Window     -> Ventana principal.
+        since : float          -> Inicio del dibujo según RECORDER.now().
+    """
+    
+    summary = RECORDER.summary()
+    counters = summary["counters"]
+    cache = summary["sources"].get("cache", {})
+    
+    text = ("Descargado: " + str(round(counters.get("bytes_downloaded", 0) / 1024**2, 1)) + " MB   " +
+            "Filas leídas: " + str(counters.get("rows_parsed", 0)) + "   " +
+            "Reintentos: " + str(counters.get("http_retries", 0)) + "   " +
+            "Aciertos de la caché: " + str(round(100 * cache.get("hit_ratio", 0))) + " %")
+    if "memory_peak_bytes" in summary:
+        text += "   Memoria máx.: " + str(round(summary["memory_peak_bytes"] / 1024**2, 1)) + " MB"
+    
+    window['-METRICS-'].update(values = RECORDER.table(since))
+    window['-COUNTERS-'].update(text)
+
+
+def _periodLabel(year : int, to_year : int = None, period : str = 'Todo el año') -> str:
+    """
+        Texto del año o del rango de años ("2010-2014"), junto con el
+        periodo elegido si no es el año completo, para el título del mapa.
+    """
+    label = str(year)
+    if to_year is not None and to_year != year:
+        label += "-" + str(to_year)
+    if PERIODS.get(period) is not None:
+        label += " (" + period.split(" (")[0] + ")"
+    return label
+
+
+def _selectedStates(values : dict) -> list[int]:
+    """
+        Lista de los estados marcados en la pestaña 'Estados de Interés'.
+        
+        values : dict          -> Valores de la ventana según window.read().
+    """
+    
+    state_codes = list(STATE_CODES.values())
+    for state_name in list(STATE_CODES.keys()):
+        try:
+            if not (values[state_name]):
+                state_codes.remove(STATE_CODES[state_name])
+        except KeyError:
+            pass
+    
+    return state_codes
+
+
+def _classifier(classifiers : dict, scheme : str) -> Classifier:
+    """
+        Clasificador de 'scheme', creado la primera vez que se usa y
+        compartido por el mapa y la pestaña 'Todos los años'.
+        
+        classifiers : dict     -> {esquema: Classifier} ya creados.
+        scheme : str           -> Esquema según SCHEMES.
+    """
+    if scheme not in classifiers:
+        classifiers[scheme] = Classifier(scheme)
+        RECORDER.watch("classifier " + scheme, classifiers[scheme].stats)
+    return classifiers[scheme]
+
+
+def main():
+    
+    # Genera la ventana
+    window = make_window(sg.theme())
+    
+    # Cargar el resto de dependencias con la ventana ya visible
+    threading.Thread(target = _preload, daemon = True).start()
+    
+    # Mapa y leyenda persistentes, creados en el primer dibujo
+    map_view = None
+    
+    # Petición en curso en segundo plano y su cancelación
+    job = 0
+    busy = False
+    cancel = threading.Event()
+    
+    # Accidentes por estado, año, mes y día de todo lo ya obtenido, creado
+    # en el primer dibujo. Redibujar datos que ya están en él no espera a nada
+    cube = None
+    
+    # Año, rango, periodo, esquema de colores y estados del dibujo en curso
+    drawing = None
+    
+    # Un clasificador por esquema, que recuerda los límites ya calculados
+    classifiers = dict()
+    
+    # Recuentos por estado y por condado y título del último dibujo, con
+    # todas las medidas, para cambiar de medida sin volver a agrupar
+    shown = None
+    
+    # Mapas de todos los años, creados la primera vez, y estados que muestran.
+    # Su petición va aparte de la del mapa, para que no se cancelen entre sí
+    grid_view = None
+    grid_states = None
+    grid_job = 0
+    grid_busy = False
+    grid_cancel = threading.Event()
+    
+    # Descarga de otros años mientras el usuario no hace nada
+    prefetcher = Prefetcher()
+    
+    # Modo de reproducción año a año
+    playing = False
+    
+    # Inicio del dibujo en curso, para la tabla de tiempos, y si falta
+    # actualizarla con el dibujado, que ocurre después de '-FETCH DONE-'
+    draw_started = RECORDER.now()
+    metrics_pending = False
+    
+    
+    # Bucle principal de la interfaz gráfica
+    while True:
+        
+        # Esperar a que el usuario o el hilo de fondo hagan algo.
+        # Solo se despierta periódicamente en el modo de reproducción
+        if playing:
+            timeout = PLAY_INTERVAL
+        elif busy or grid_busy or metrics_pending:
+            timeout = METRICS_INTERVAL
+        else:
+            timeout = None
+        event, values = window.read(timeout = timeout)
+        
+        # Si elige salir, salir del bucle principal
+        if event in (None, 'Salir', sg.WIN_CLOSED):
+            break
+        
+        # Cualquier acción del usuario pausa la descarga anticipada
+        if event not in (sg.TIMEOUT_EVENT, '-FETCH PROGRESS-', '-FETCH DONE-', '-FETCH ERROR-', 
+                         '-GRID PROGRESS-', '-GRID DONE-', '-GRID ERROR-'):
+            prefetcher.touch()
+        
+        # Si decide leer la ayuda, crear un popup con información
+        if event == '¿Cómo usar el visualizador?':
+            sg.popup('Visualizador de accidentes en EEUU.',
+                     '---Pagina "Gráfico de Accidentes"---',
+                     'Puedes mover la barra deslizante de izquierda a derecha.',
+                     'De esa forma se puede elegir el año del que obtener información sobre accidentes.',
+                     'Se generará un gráfico con los datos de ese año al presionar el botón "Dibujar".',
+                     'Si marcas "Redibujar al mover la barra", el mapa cambia según mueves la barra.',
+                     'El botón "Reproducir" recorre los años uno tras otro.',
+                     'Si marcas "Hasta el año", se suman todos los años entre las dos barras.',
+                     'Con "Desglose por año" se muestran además los accidentes de cada año en la pestaña de información.',
+                     'En "Periodo" puedes elegir un mes o una estación del año.',
+                     'En "Colores" puedes elegir cómo se reparten los rangos de colores: según la mediana, por cuantiles, en intervalos iguales o con los cortes naturales de Jenks.',
+                     'Con "Por condados" se colorea cada condado en lugar de cada estado.',
+                     'En "Mostrar" puedes elegir entre accidentes, fallecidos, peatones, personas o vehículos, en total o por accidente.',
+                     'Con la rueda del ratón se acerca y aleja el mapa, arrastrando se mueve y con doble click vuelve a la vista completa.',
+                     '---Pagina "Todos los años"---',
+                     'El botón "Dibujar todos los años" muestra un mapa por año con los mismos rangos de colores, para compararlos.',
+                     'Usa el periodo, los colores y lo que se muestra elegidos en la primera página.',
+                     '---Pagina "Estados de Interés"---',
+                     'Puedes elegir los estados que se contabilizarán en el dibujado del mapa.', 
+                     'Los rangos de los colores son dinámicos, y dependen de los datos máximo, mínimo y mediana.', 
+                     'Se recomienda eliminar estados con valores muy elevados o sin apenas accidentes',
+                     'Estos repercuten en el resultado final al aumentar los rangos de cada color, opacando diferencias menores entre otros estados',
+                     '---Pagina "Información Adicional"---',
+                     'Puedes observar algunos datos cuantitativos de la base de datos que se haya elegido',
+                     keep_on_top=True)
+        
+        # Año que hay que dibujar tras este evento, si hay alguno
+        draw_year = None
+        
+        # Si pulsa el botón "Dibujar" o mueve la barra en modo de redibujado
+        if event in ('-BUTTON-', '-PERIOD-', '-SCHEME-', '-COUNTIES-') or (event == '-SLIDER-' and values['-SCRUB-']):
+            draw_year = int(values['-SLIDER-'])
+        
+        # Empezar o parar la reproducción
+        if event == '-PLAY-':
+            playing = not playing
+            window['-PLAY-'].update('Parar' if playing else 'Reproducir')
+            if playing and int(values['-SLIDER-']) == YEARS[-1]:
+                window['-SLIDER-'].update(YEARS[0])
+                draw_year = YEARS[0]
+        
+        # En reproducción, avanzar un año cuando el anterior ya está dibujado
+        if event == sg.TIMEOUT_EVENT and playing and not busy:
+            if int(values['-SLIDER-']) >= YEARS[-1]:
+                playing = False
+                window['-PLAY-'].update('Reproducir')
+            else:
+                draw_year = int(values['-SLIDER-']) + 1
+                window['-SLIDER-'].update(draw_year)
+        
+        if draw_year is not None:
+            state_codes = _selectedStates(values)
+            draw_started = RECORDER.now()
+            
+            # Último año del rango, salvo en reproducción, que va año a año
+            to_year = None
+            if values['-RANGE-'] and not playing and int(values['-SLIDER TO-']) > draw_year:
+                to_year = int(values['-SLIDER TO-'])
+            
+            counties = values['-COUNTIES-']
+            drawing = (draw_year, to_year, values['-PERIOD-'], values['-SCHEME-'], state_codes)
+            
+            if cube is None:
+                from aggregation import AccidentCube
+                cube = AccidentCube()
+            
+            # Cancelar la petición anterior si sigue en curso
+            cancel.set()
+            cancel = threading.Event()
+            job += 1
+            
+            if not counties and cube.covers(state_codes, range(draw_year, (to_year or draw_year) + 1)):
+                # Datos ya en el cubo: redibujar directamente
+                busy = False
+                window.write_event_value('-FETCH DONE-', (job, None, 0.0, None))
+            else:
+                busy = True
+                window['-PROGRESS BAR-'].update(current_count = 0, max = 1)
+                window['-STATUS-'].update('Obteniendo datos de ' + _periodLabel(draw_year, to_year) + '...')
+                
+                threading.Thread(target = _drawWorker, 
+                                 args = (window, job, state_codes, draw_year, cancel, cube, to_year, 
+                                         counties, PERIODS[values['-PERIOD-']]),
+                                 daemon = True).start()
+        
+        # Mapas de todos los años: pedir los que falten al cubo
+        if event == '-GRID-':
+            grid_states = _selectedStates(values)
+            draw_started = RECORDER.now()
+            
+            if cube is None:
+                from aggregation import AccidentCube
+                cube = AccidentCube()
+            
+            grid_cancel.set()
+            grid_cancel = threading.Event()
+            grid_job += 1
+            
+            if cube.covers(grid_states, YEARS):
+                grid_busy = False
+                window.write_event_value('-GRID DONE-', (grid_job, None, 0.0, None))
+            else:
+                grid_busy = True
+                window['-GRID STATUS-'].update('Obteniendo datos de todos los años...')
+                
+                threading.Thread(target = _drawWorker, 
+                                 args = (window, grid_job, grid_states, YEARS[0], grid_cancel, cube, YEARS[-1]),
+                                 kwargs = {"prefix": '-GRID'},
+                                 daemon = True).start()
+        
+        # Con otro periodo, esquema o medida se recolorean también los mapas
+        # de todos los años, si ya están en el cubo (sin número de petición)
+        if (event in ('-PERIOD-', '-SCHEME-', '-MEASURE-') and grid_view is not None 
+                and cube.covers(grid_states, YEARS)):
+            window.write_event_value('-GRID DONE-', (None, None, 0.0, None))
+        
+        # Cambiar lo que se muestra solo recolorea con los recuentos ya calculados
+        if event == '-MEASURE-' and shown is not None and map_view is not None:
+            draw_started = RECORDER.now()
+            map_view.update(*shown, measure = values['-MEASURE-'])
+            _updateMetrics(window, draw_started)
+            metrics_pending = True
+        
+        # Tabla de tiempos, durante la descarga y una vez más tras dibujar
+        if event in (sg.TIMEOUT_EVENT, '-FETCH PROGRESS-', '-GRID PROGRESS-') and (busy or grid_busy or metrics_pending):
+            _updateMetrics(window, draw_started)
+            metrics_pending = busy or grid_busy
+        
+        if event == '-TRACK MEMORY-':
+            RECORDER.trackMemory(values['-TRACK MEMORY-'])
+        
+        if event in ('-EXPORT JSONL-', '-EXPORT TRACE-'):
+            jsonl = event == '-EXPORT JSONL-'
+            path = sg.popup_get_file('Guardar las mediciones en', 
+                                     save_as = True, 
+                                     default_extension = '.jsonl' if jsonl else '.json',
+                                     file_types = (('JSON lines', '*.jsonl'),) if jsonl else (('JSON', '*.json'),))
+            if path:
+                if jsonl:
+                    RECORDER.exportJSONL(path)
+                else:
+                    RECORDER.exportChromeTrace(path)
+                print("Mediciones guardadas en", path)
+        
+        # Progreso de la descarga de la petición actual
+        if event == '-FETCH PROGRESS-' and values[event][0] == job:
+            _, done, total = values[event]
+            window['-PROGRESS BAR-'].update(current_count = done, max = total)
+        
+        if event == '-FETCH ERROR-' and values[event][0] == job:
+            busy = False
+            playing = False
+            window['-PLAY-'].update('Reproducir')
+            window['-STATUS-'].update('Error al obtener los datos')
+            print("Error al obtener la base de datos:", values[event][1])
+        
+        # Lo mismo para la petición de todos los años
+        if event == '-GRID PROGRESS-' and values[event][0] == grid_job:
+            _, done, total = values[event]
+            window['-GRID STATUS-'].update('Obteniendo datos de todos los años... (' + str(done) + ' de ' + str(total) + ')')
+        
+        if event == '-GRID ERROR-' and values[event][0] == grid_job:
+            grid_busy = False
+            window['-GRID STATUS-'].update('Error al obtener los datos')
+            print("Error al obtener la base de datos:", values[event][1])
+        
+        # Datos de la petición actual listos, dibujarlos
+        if event == '-FETCH DONE-' and values[event][0] == job:
+            _, bytes_per_row, clock, county_count = values[event]
+            busy = False
+            
+            # Contar los accidentes del periodo elegido a partir del cubo
+            year, to_year, period, scheme, state_codes = drawing
+            years = range(year, (to_year or year) + 1)
+            accident_count = cube.count(state_codes, years, PERIODS[period])
+            
+            # Normalmente ya cargados por _preload()
+            from aggregation import TARGET_BYTES_PER_ROW
+            from rendering import MapView
+            
+            #Comprobar el tiempo utilizado en la petición
+            if bytes_per_row is not None:
+                print("Memoria por fila:", round(bytes_per_row, 1), "bytes (objetivo:", TARGET_BYTES_PER_ROW, "bytes)")
+                print("Tiempo utilizado para obtener la base de datos:", round(clock,1), "segundos.")
+                print("Caché de peticiones:", CACHE.stats())
+            
+            # El mapa se construye una sola vez, los siguientes dibujos solo lo recolorean
+            if map_view is None:
+                map_view = MapView(window['plot-canvas'].TKCanvas, window['plot-canvas2'].TKCanvas)
+            
+            # Dibujar el mapa con la información obtenida
+            map_view.classifier = _classifier(classifiers, scheme)
+            shown = (accident_count, _periodLabel(year, to_year, period), county_count)
+            try:
+                map_view.update(*shown, measure = values['-MEASURE-'])
+            except (OSError, ValueError) as error:
+                # Normalmente, porque no está el mapa de condados (USA_COUNTIES_SHP)
+                print("No se ha podido dibujar por condados:", error)
+                shown = shown[:2] + (None,)
+                map_view.update(*shown, measure = values['-MEASURE-'])
+            
+            # Mostrar información adicional de la base de datos
+            if not playing:
+                print(accident_count.describe() if county_count is None else county_count.describe())
+                print(cube.weekdayWeekend(state_codes, years, PERIODS[period]).describe())
+                if to_year is not None and values['-BY YEAR-']:
+                    print(cube.countByYear(state_codes, years, PERIODS[period]).to_string())
+            
+            window['-STATUS-'].update('')
+            
+            # La tabla se completa con el dibujado en la siguiente espera
+            _updateMetrics(window, draw_started)
+            metrics_pending = True
+            
+            # Descargar el resto de años en los ratos libres
+            prefetcher.request(year, state_codes)
+        
+        # Todos los años en el cubo: una matriz estados x años para toda la cuadrícula
+        if event == '-GRID DONE-' and values[event][0] in (grid_job, None):
+            if values[event][0] == grid_job:
+                grid_busy = False
+            
+            from rendering import SmallMultiples
+            if grid_view is None:
+                grid_view = SmallMultiples(window['grid-canvas'].TKCanvas)
+            
+            period, measure = values['-PERIOD-'], values['-MEASURE-']
+            year_count = cube.countByYear(grid_states, YEARS, PERIODS[period], MEASURES[measure][0])
+            
+            grid_view.classifier = _classifier(classifiers, values['-SCHEME-'])
+            grid_view.update(year_count, measure, None if PERIODS[period] is None else period.split(" (")[0])
+            
+            window['-GRID STATUS-'].update('')
+            _updateMetrics(window, draw_started)
+            metrics_pending = True
+    
+    
+    # Al salir, cancelar las peticiones en curso y la descarga anticipada
+    cancel.set()
+    grid_cancel.set()
+    prefetcher.stop()
+    
+    # Al salir, eliminar los dibujos y cerrar la ventana
+    if not map_view == None:
+        map_view.close()
+    
+    window.close()
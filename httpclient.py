@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Cliente HTTP de CrashAPI: conexiones persistentes (keep-alive) reutilizadas
+entre peticiones, respuestas comprimidas con gzip, tiempos máximos de
+conexión y de lectura, y peticiones condicionales (ETag, Last-Modified).
+El cuerpo de cada respuesta se lee como un flujo, sin descargarlo entero
+en memoria antes de procesarlo.
+"""
+
+from __future__ import annotations
+
+#%% DEPENDENCIAS
+
+
+# Conexiones HTTP
+import io
+import gzip
+import http.client
+import threading
+from urllib.parse import urlsplit, urljoin
+from urllib.error import HTTPError
+
+# Medición de los bytes transferidos
+from instrumentation import RECORDER
+
+
+#%% RESPUESTAS
+
+
+class _CountingReader:
+    """
+        Envuelve el cuerpo de una respuesta contando los bytes leídos
+        tal como llegan por la red, antes de descomprimirlos. Si la
+        conexión se cierra antes de recibir los bytes de Content-Length,
+        lanza http.client.IncompleteRead, como lo haría read() sin tamaño.
+        Las respuestas por bloques (chunked) ya lo lanzan al no llegar el
+        bloque final.
+    """
+    
+    def __init__(self, raw : http.client.HTTPResponse):
+        self.raw = raw
+        self.bytes = 0
+        self.truncated = False
+    
+    
+    def read(self, size : int = -1) -> bytes:
+        data = self.raw.read(size)
+        self.bytes += len(data)
+        
+        # read(size) devuelve b"" al cerrarse la conexión aunque falten bytes
+        if not data and size != 0 and not self.raw.chunked and self.raw.length:
+            self.truncated = True
+            raise http.client.IncompleteRead(b"", self.raw.length)
+        return data
+
+
+class Response(io.RawIOBase):
+    """
+        Respuesta de ConnectionPool.request(). Se lee como un fichero
+        binario (descomprimido si llega con gzip) y, al cerrarla, devuelve
+        la conexión al grupo si se ha leído entera.
+        
+        status : int           -> Código HTTP de la respuesta.
+        headers                -> Cabeceras de la respuesta.
+        url : str              -> Dirección final, tras las redirecciones.
+    """
+    
+    def __init__(self, pool : ConnectionPool, key : tuple, connection : http.client.HTTPConnection,
+                 raw : http.client.HTTPResponse, url : str):
+        super().__init__()
+        self.status = raw.status
+        self.headers = raw.headers
+        self.url = url
+        
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._raw = raw
+        self._counter = _CountingReader(raw)
+        
+        if (raw.getheader("Content-Encoding") or "").lower() == "gzip":
+            self._stream = gzip.GzipFile(fileobj = self._counter)
+        else:
+            self._stream = self._counter
+    
+    
+    def readable(self) -> bool:
+        return True
+    
+    
+    def readinto(self, buffer) -> int:
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+    
+    
+    def validators(self) -> dict:
+        """
+            ETag y Last-Modified de la respuesta, para pedir después los
+            mismos datos de forma condicional.
+        """
+        return {"etag": self.headers.get("ETag"), "last_modified": self.headers.get("Last-Modified")}
+    
+    
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        
+        RECORDER.add("bytes_downloaded", self._counter.bytes)
+        
+        # Respuestas sin cuerpo (304) o con el cuerpo ya leído hasta el final
+        if not self._raw.isclosed() and self._raw.length == 0:
+            self._raw.read()
+        
+        # La conexión solo se puede reutilizar si el cuerpo se ha leído entero
+        if self._raw.isclosed() and not self._raw.will_close and not self._counter.truncated:
+            self._pool._release(self._key, self._connection)
+        else:
+            self._raw.close()
+            self._connection.close()
+
+
+#%% GRUPO DE CONEXIONES
+
+
+class ConnectionPool:
+    """
+        Grupo de conexiones persistentes por servidor. Cada petición toma
+        una conexión libre (o abre una nueva) y la devuelve al cerrar la
+        respuesta, de forma que las peticiones siguientes al mismo
+        servidor no vuelven a establecer la conexión ni a negociar TLS.
+        
+        max_idle : int         -> Conexiones libres que se guardan por servidor.
+        connect_timeout : float -> Segundos máximos para establecer la conexión.
+        read_timeout : float   -> Segundos máximos de espera de cada lectura.
+        compress : bool        -> Pedir las respuestas comprimidas con gzip.
+        max_redirects : int    -> Redirecciones que se siguen como máximo.
+    """
+    
+    def __init__(self, max_idle : int = 8, connect_timeout : float = 10, read_timeout : float = 60,
+                 compress : bool = True, max_redirects : int = 5):
+        self.max_idle = max_idle
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.compress = compress
+        self.max_redirects = max_redirects
+        
+        # Estadísticas de uso
+        self.opened = 0
+        self.reused = 0
+        
+        self._idle = dict()
+        self._lock = threading.Lock()
+    
+    
+    def _acquire(self, key : tuple) -> tuple[http.client.HTTPConnection, bool]:
+        """
+            Conexión libre con el servidor 'key' = (esquema, host, puerto),
+            y si es reutilizada o nueva.
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.opened += 1
+        
+        scheme, host, port = key
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        connection = connection_class(host, port, timeout = self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        
+        return connection, False
+    
+    
+    def _release(self, key : tuple, connection : http.client.HTTPConnection):
+        with self._lock:
+            idle = self._idle.setdefault(key, list())
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+    
+    
+    def request(self, url : str, headers : dict = None, validators : dict = None) -> Response:
+        """
+            Hace una petición GET y devuelve la respuesta sin leer su cuerpo.
+            Los códigos 2xx y 304 se devuelven; el resto lanzan HTTPError,
+            como urllib, para poder reintentarlos igual.
+            
+            url : str              -> Dirección pedida.
+            headers : dict         -> Cabeceras adicionales.
+            validators : dict      -> {"etag", "last_modified"} de una respuesta
+                                        anterior (Response.validators()). Si se
+                                        indican y los datos no han cambiado,
+                                        el servidor responde 304 sin cuerpo.
+        """
+        
+        headers = dict(headers or {})
+        if self.compress:
+            headers.setdefault("Accept-Encoding", "gzip")
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+        
+        for _ in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+            path = parts.path + ("?" + parts.query if parts.query else "")
+            
+            connection, reused = self._acquire(key)
+            try:
+                connection.request("GET", path, headers = headers)
+                raw = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if not reused:
+                    raise
+                # El servidor había cerrado la conexión guardada: repetir con una nueva
+                connection, _ = self._acquire(key)
+                try:
+                    connection.request("GET", path, headers = headers)
+                    raw = connection.getresponse()
+                except Exception:
+                    connection.close()
+                    raise
+            except Exception:
+                connection.close()
+                raise
+            
+            response = Response(self, key, connection, raw, url)
+            
+            if raw.status in (301, 302, 303, 307, 308) and raw.getheader("Location"):
+                response.read()
+                response.close()
+                url = urljoin(url, raw.getheader("Location"))
+                continue
+            
+            if raw.status >= 400:
+                body = response.read()
+                response.close()
+                raise HTTPError(url, raw.status, raw.reason, raw.headers, io.BytesIO(body))
+            
+            return response
+        
+        raise HTTPError(url, 310, "Too many redirects", None, None)
+    
+    
+    def close(self):
+        """
+            Cierra todas las conexiones libres.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, dict()
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+    
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {"opened": self.opened, "reused": self.reused,
+                    "idle": sum(len(connections) for connections in self._idle.values())}
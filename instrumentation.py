@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Medición de lo que ocurre en cada dibujo: intervalos de tiempo de cada
+etapa (peticiones HTTP, lectura del CSV, preprocesado, agregación,
+clasificación y dibujado), contadores como los bytes descargados o las
+filas leídas, estadísticas de las cachés y memoria máxima (tracemalloc).
+Los resultados se pueden ver como tabla o exportar como JSON lines o
+como traza de Chrome (chrome://tracing, Perfetto).
+"""
+
+from __future__ import annotations
+
+#%% DEPENDENCIAS
+
+
+# Medición de tiempos y memoria
+import os
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Exportación de resultados
+import json
+
+
+#%% REGISTRO DE MEDICIONES
+
+
+class Recorder:
+    """
+        Registro de intervalos de tiempo y contadores, compartido por todos
+        los hilos. Cada intervalo guarda su etapa, su inicio y duración en
+        milisegundos desde la creación del registro, el hilo que lo midió
+        y los datos adicionales que se indiquen.
+        
+        max_spans : int        -> Número máximo de intervalos guardados.
+                                    Al superarlo se descartan los más antiguos.
+    """
+    
+    def __init__(self, max_spans : int = 100000):
+        self.max_spans = max_spans
+        
+        self._origin = time.perf_counter()
+        self._spans = list()
+        self._counters = dict()
+        self._sources = dict()
+        self._lock = threading.Lock()
+    
+    
+    def now(self) -> float:
+        """
+            Milisegundos desde la creación del registro.
+        """
+        return (time.perf_counter() - self._origin) * 1000
+    
+    
+    def record(self, stage : str, start : float, end : float = None, **args):
+        """
+            Guarda un intervalo ya medido con now().
+            
+            stage : str            -> Etapa, por ejemplo "http" o "preprocess".
+            start : float          -> Inicio según now().
+            end : float            -> Fin según now(). Por defecto, ahora.
+            args                   -> Datos adicionales del intervalo.
+        """
+        end = self.now() if end is None else end
+        span = {"stage": stage, "start_ms": start, "duration_ms": end - start,
+                "thread": threading.get_ident(), "args": args}
+        
+        with self._lock:
+            self._spans.append(span)
+            if len(self._spans) > self.max_spans:
+                del self._spans[:len(self._spans) - self.max_spans]
+    
+    
+    @contextmanager
+    def span(self, stage : str, **args):
+        """
+            Mide el tiempo del bloque 'with' como un intervalo de 'stage'.
+            Los datos adicionales se pueden completar dentro del bloque
+            modificando el diccionario que devuelve.
+            
+                with RECORDER.span("parse", url = url) as info:
+                    df = pd.read_csv(...)
+                    info["rows"] = len(df)
+        """
+        start = self.now()
+        try:
+            yield args
+        finally:
+            self.record(stage, start, **args)
+    
+    
+    def add(self, counter : str, value : float = 1):
+        """
+            Suma 'value' a un contador, por ejemplo de bytes descargados.
+        """
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+    
+    
+    def watch(self, name : str, stats):
+        """
+            Añade una fuente de estadísticas, una función sin argumentos que
+            devuelve un diccionario (por ejemplo CrashCache.stats), que se
+            consulta en cada resumen.
+        """
+        with self._lock:
+            self._sources[name] = stats
+    
+    
+    @staticmethod
+    def trackMemory(enabled : bool = True):
+        """
+            Activa o desactiva la medición de memoria con tracemalloc. Hace
+            más lento todo el programa, por lo que está desactivada por defecto.
+        """
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if not enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+    
+    
+    def reset(self):
+        """
+            Borra los intervalos, los contadores y la memoria máxima.
+        """
+        with self._lock:
+            self._spans.clear()
+            self._counters.clear()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+    
+    
+    def spans(self) -> list[dict]:
+        with self._lock:
+            return list(self._spans)
+    
+    
+    def summary(self, since : float = None) -> dict:
+        """
+            Resumen de todo lo medido: por etapa el número de intervalos y
+            su duración total, media y máxima; los contadores; las fuentes
+            de watch() y la memoria máxima en bytes si se mide.
+            
+            since : float          -> Si se indica, solo cuenta los intervalos
+                                        que empiezan después, según now().
+        """
+        
+        stages = dict()
+        for span in self.spans():
+            if since is not None and span["start_ms"] < since:
+                continue
+            stage = stages.setdefault(span["stage"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stage["count"] += 1
+            stage["total_ms"] += span["duration_ms"]
+            stage["max_ms"] = max(stage["max_ms"], span["duration_ms"])
+        
+        for stage in stages.values():
+            stage["mean_ms"] = stage["total_ms"] / stage["count"]
+        
+        with self._lock:
+            counters = dict(self._counters)
+            sources = dict(self._sources)
+        
+        summary = {"stages": stages, "counters": counters,
+                   "sources": {name: stats() for name, stats in sources.items()}}
+        
+        if tracemalloc.is_tracing():
+            summary["memory_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        
+        return summary
+    
+    
+    def table(self, since : float = None) -> list[list]:
+        """
+            Filas [etapa, veces, total ms, media ms, máximo ms] del resumen,
+            de la etapa más lenta en total a la más rápida.
+        """
+        stages = self.summary(since)["stages"]
+        return [[name, stage["count"], round(stage["total_ms"], 1), round(stage["mean_ms"], 1),
+                 round(stage["max_ms"], 1)]
+                for name, stage in sorted(stages.items(), key = lambda item: -item[1]["total_ms"])]
+    
+    
+    def exportJSONL(self, path : str):
+        """
+            Añade a 'path' una línea JSON por intervalo y una última línea
+            con el resumen.
+        """
+        with open(path, "a", encoding = "utf-8") as f:
+            for span in self.spans():
+                f.write(json.dumps(span, default = str) + "\n")
+            f.write(json.dumps({"summary": self.summary(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+                               default = str) + "\n")
+    
+    
+    def exportChromeTrace(self, path : str):
+        """
+            Guarda los intervalos en el formato de trazas de Chrome, que se
+            puede abrir en chrome://tracing o en ui.perfetto.dev, con un
+            carril por hilo.
+        """
+        events = [{"name": span["stage"], "cat": span["stage"], "ph": "X",
+                   "ts": span["start_ms"] * 1000, "dur": span["duration_ms"] * 1000,
+                   "pid": os.getpid(), "tid": span["thread"], "args": span["args"]}
+                  for span in self.spans()]
+        
+        with open(path, "w", encoding = "utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default = str)
+
+
+# Registro compartido por todo el visualizador
+RECORDER = Recorder()
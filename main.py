@@ -5,635 +5,334 @@ Created on Tue Sep 12 11:23:47 2023
 @author: kairo
 """
 
-#%% DEPENDENCIAS
-
-
-# Dibujado de funciones
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.patches as mpatches
-
-# Interfaz gráfica
-import PySimpleGUI as sg
+from __future__ import annotations
 
-# Dibujado de mapas cartográficos
-from cartopy import crs as ccrs
-import cartopy.io.shapereader as shpreader
+#%% DEPENDENCIAS
 
-# Manejo de bases de datos
-import pandas as pd
 
-# Control del tiempo de ejecución
+# El visualizador está repartido en varios módulos que se cargan solo al usarse:
+#   instrumentation -> medición de tiempos, contadores y memoria
+#   httpclient  -> conexiones con CrashAPI (keep-alive, gzip, revalidación)
+#   crashdata   -> obtención de los datos de CrashAPI (sin dependencias pesadas)
+#   aggregation -> preprocesado y agrupación (pandas)
+#   classification -> rangos de colores del mapa (numpy)
+#   rendering   -> dibujado del mapa y la leyenda (matplotlib, cartopy)
+#   gui         -> interfaz gráfica (PySimpleGUI)
+#   service     -> servicio HTTP para varios usuarios (asyncio)
+import importlib
+
+# Modo por línea de comandos
+import sys
+import os
+import json
 import time
+import argparse
+import subprocess
 
-# Agilidad para evitar repetir peticiones a la API
-from functools import lru_cache
-
+from crashdata import STATE_CODES, YEARS, MEASURES
+from classification import SCHEMES
 
-#%% CODIGO DE CADA ESTADO EN LA API DE CRASHAPI
 
+#%% ACCESO A LOS MÓDULOS
 
-STATE_CODES = {
-    "Alabama":1,
-    "Alaska":2,
-    "Arizona":4,
-    "Arkansas":5,
-    "California":6,
-    "Colorado":8,
-    "Connecticut":9,
-    "Delaware":10,
-    "District of Columbia":11,
-    "Florida":12,
-    "Georgia":13,
-    "Hawaii":15,
-    "Idaho":16,
-    "Illinois":17,
-    "Indiana":18,
-    "Iowa":19,
-    "Kansas":20,
-    "Kentucky":21,
-    "Louisiana":22,
-    "Maine":23,
-    "Maryland":24,
-    "Massachusetts":25,
-    "Michigan":26,
-    "Minnesota":27,
-    "Mississippi":28,
-    "Missouri":29,
-    "Montana":30,
-    "Nebraska":31,
-    "Nevada":32,
-    "New Hampshire":33,
-    "New Jersey":34,
-    "New Mexico":35,
-    "New York":36,
-    "North Carolina":37,
-    "North Dakota":38,
-    "Ohio":39,
-    "Oklahoma":40,
-    "Oregon":41,
-    "Pennsylvania":42,
-    "Puerto Rico":43,
-    "Rhode Island":44,
-    "South Carolina":45,
-    "South Dakota":46,
-    "Tennessee":47,
-    "Texas":48,
-    "Utah":49,
-    "Vermont":50,
-    "Virginia":51,
-    "Virgin Islands":52,
-    "Washington":53,
-    "West Virginia":54,
-    "Wisconsin":55,
-    "Wyoming":56
-}
 
+_MODULES = ("instrumentation", "httpclient", "crashdata", "aggregation", "classification", "rendering", "gui", "service")
 
-#%% OBTENCION DE LA BASE DE DATOS
 
-
-def getDataframe(states: list[int], year : int = 2014, request_together : int = 5) -> pd.DataFrame:
+def __getattr__(name : str):
     """
-        Obtiene la base de datos de accidentes de CrashAPI
-        a partir de una lista de estados (siguiendo el código
-        especificado en STATE_CODES)
-        
-        states : list[int]     -> Lista de estados de los que obtener 
-                                    información. Los enteros deben
-                                    estar en STATE_CODES
-        year : int             -> Año del que obtener información.
-                                    Debe estar entre 2010 y 2021
-                                    ambos inclusive.
-        request_together : int -> Número de estados que pedir juntos
-                                    a CrashAPI para reducir tiempo
-                                    de espera. Números mayores de
-                                    5 pueden provocar pérdida de
-                                    información por el límite de
-                                    peticiones de la API.
+        Permite seguir usando main.getDataframe, main.plotMapAccidents, etc.
+        importando solo el módulo que contiene cada nombre.
     """
+    for module_name in _MODULES:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        if hasattr(module, name):
+            return getattr(module, name)
     
-    df = pd.DataFrame()
-    
-    #Comprobar si los datos son del tipo correcto y sus valores con adecuados
-    try:
-        for i in states:
-            if not isinstance(i, int) or i not in list(STATE_CODES.values()):
-                raise TypeError
-        if not isinstance(year, int):
-            raise TypeError
-        if (year > 2021 or year < 2010):
-            raise ValueError
-        if not isinstance(request_together, int):
-            raise TypeError
-            
-    except TypeError:
-        print("Los argumentos de la función get_dataframe deben ser una lista de enteros para 'states' y un entero solo para 'year y 'request_together'")
-    except ValueError:
-        print("El argumento year de la función get_dataframe debe ser un entero entre 2011 y 2022 ambos inclusive")        
-    else:
-        
-        # Procesar la lista de estados en paquetes de tamaño request_together
-        processed_str = str()
-        
-        while states:
-            
-            # Conversión de lista a string sin espacios ni corchetes
-            processed_str = str( states[0:request_together] ).replace(" ", "").removeprefix("[").removesuffix("]")
-            states = states[request_together:]
-            
-            # Llamada a la API y concatenación de los paquetes
-            df = pd.concat( [df, requestCrashAPI(processed_str, year)] )
-
-    return df
-
-
-@lru_cache(maxsize = 60)
-def requestCrashAPI(states: str, year : int = 2014) -> pd.DataFrame:
-    """
-        Obtiene la base de datos de accidentes de CrashAPI
-        a para un único estado estados (siguiendo el código
-        especificado en STATE_CODES). La base de datos queda
-        en caché usando los parámetros como 'key'
-        
-        states : str           -> Estados del que obtener información.
-                                    Debe ser una string con un entero
-                                    elegido según STATE_CODES
-        year : int             -> Año del que obtener información.
-                                    Debe estar entre 2010 y 2021
-                                    ambos inclusive.
-    """
-    try:
-        if not isinstance(states, str):
-            raise TypeError
-        if year > 2021 or year < 2010:
-            raise ValueError
-            
-    except TypeError:
-        print("El argumento states de la función get_dataframe debe contener solo int")
-    except ValueError:
-        print("El argumento year de la función get_dataframe debe ser un entero entre 2011 y 2022 ambos inclusive")
-    else:
-        
-        # Petición a la API según parámetros
-        return pd.read_csv("https://crashviewer.nhtsa.dot.gov/CrashAPI/crashes/GetCaseList?states=" + states + 
-                           "&fromYear=" + str(year) + "&toYear=" + str(year) + 
-                           "&minNumOfVehicles=1&maxNumOfVehicles=6&format=csv"
-                           )
+    raise AttributeError("module 'main' has no attribute '" + name + "'")
 
 
-#%% PREPROCESADO DE LA BASE DE DATOS
+#%% TIEMPO DE ARRANQUE
 
 
-def preprocess(df : pd.DataFrame) -> pd.DataFrame:
+def measureStartup(repeat : int = 5) -> dict:
     """
-        Transforma un dataframe de pandas obtenido de CrashAPI 
-        que contiene una fecha tipo "dd/mm/yyyy hh:mm AM" en un nuevo dataframe
-        con la fecha en formato iso y eliminando datos irrelevantes
+        Mide el tiempo de importar cada módulo del visualizador en un
+        intérprete nuevo, quedándose con el mejor de 'repeat' intentos.
+        Devuelve {módulo: milisegundos}.
         
-        df : pd.Dataframe      -> Dataframe obtenido de CrashAPI.
-                                    Se recomienda utilizar get_dataframe().
+        repeat : int           -> Número de mediciones por módulo.
     """
     
-    # Transformar fechas y horas de string a columnas (year, month, day) como enteros
-    df["crashdate"] = df["crashdate"].apply(lambda x: x.split(" ")[0])
-    df["year"] = df["crashdate"].apply(lambda x: x.split("/")[2])
-    df["month"] = df["crashdate"].apply(lambda x: x.split("/")[1])
-    df["day"] = df["crashdate"].apply(lambda x: x.split("/")[0])
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = dict()
     
-    # Eliminar datos sin relevancia
-    df.pop("st_case")
-    df.pop("countyname")
-    df.pop("state")
-    df.pop("crashdate")
+    for module_name in _MODULES:
+        code = ("import time; clock = time.perf_counter(); import " + module_name + 
+                "; print((time.perf_counter() - clock) * 1000)")
+        times = list()
+        for _ in range(repeat):
+            try:
+                output = subprocess.run([sys.executable, "-c", code], cwd = directory, 
+                                        capture_output = True, text = True, check = True).stdout
+                times.append(float(output.split()[-1]))
+            except (subprocess.CalledProcessError, ValueError, IndexError):
+                # Módulo no disponible, por ejemplo sin PySimpleGUI
+                break
+        results[module_name] = round(min(times), 1) if times else None
     
-    # De momento, eliminar datos relevantes que no se van a utilizar
-    df.pop("totalvehicles")
-    df.pop("fatals")
-    df.pop("peds")
-    df.pop("persons")
+    return results
+
 
-    return df
+#%% MODO POR LÍNEA DE COMANDOS
 
 
-#%% DIBUJADO DEL MAPA
+def _parseYears(text : str) -> list[int]:
+    """
+        Convierte "2010-2021" o "2014,2016" en una lista de años.
+    """
+    years = list()
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            years.extend(range(int(first), int(last) + 1))
+        else:
+            years.append(int(part))
+    return years
 
 
-def groupCountAccidents(df : pd.DataFrame) -> pd.DataFrame:
+def _parseStates(text : str) -> tuple[str, list[int]]:
     """
-        Transforma un dataframe de pandas obtenido de CrashAPI en
-        otro dataframe que agrupa las observaciones por estado y
-        las cuenta.
-        (se recomienda preprocesarlo primero con preprocess() )
-        
-        df : pd.Dataframe      -> Dataframe obtenido de CrashAPI.
-                                    Se recomienda utilizar getDataframe()
-                                    y luego preprocess().
+        Convierte "todos" o "1,2,4" (códigos o nombres de STATE_CODES) en un
+        nombre para los ficheros y la lista de estados. Admite "nombre=1,2,4".
     """
+    name, _, states = text.rpartition("=")
     
-    df["accidents"] = 1 
-    grouped_df = df.groupby("statename")
-    accident_count = pd.DataFrame(grouped_df["accidents"].count())
-    
+    if states in ("todos", "all"):
+        return name or "todos", list(STATE_CODES.values())
     
-    return accident_count
+    codes = [int(state) if state.strip().isdigit() else STATE_CODES[state.strip()] 
+             for state in states.split(",")]
+    return name or "estados_" + "-".join(str(code) for code in codes), codes
 
 
-def plotMapAccidents(accident_count : pd.DataFrame, year : int = None) -> plt.Figure():
+def cli(argv : list[str]) -> int:
     """
-        Dibuja el mapa de estados unidos y colorea cada estado
-        según rangos de datos:
-            - En tercios entre el mínimo y la mediana
-            - En sextos entre la mediana y el máximo saltándose
-                tercer sexto ya que no suele contener observaciones
-        Para obtener la leyenda de los datos, utilizar plotMapAccidentsLeyend()
+        Modo por línea de comandos, sin interfaz gráfica:
+            
+            python main.py render --years 2010-2021 --states todos --out imagenes
+            python main.py render --years 2014 --states costa_oeste=6,41,53 --format png svg
+            python main.py render --years 2014 --measure "fallecidos por accidente"
+            python main.py startup --output startup_times.jsonl
+            python main.py benchmark --rows 700 --latency 0.05 --output benchmarks.jsonl
+            python main.py serve --port 8000
+            python main.py snapshot --out crashes.snap
+            python main.py render --years 2014 --snapshot crashes.snap
+            python main.py service --port 8080 --stand-in
+            python main.py check
         
-        accident_count : pd.Dataframe -> Dataframe obtenido de CrashAPI, preprocesado, agrupado
-                                            por estados y con las observaciones contadas.
-                                            Se recomienda utilizar groupCountAccidents().
+        argv : list[str]       -> Argumentos sin el nombre del programa.
     """
-
-    # Generación de la imagen vacía    
-    fig = plt.figure()
-    
-    # Elección de ejes cartesianos para el mapa de la Tierra (en vez de un mapa curvado)
-    ax = fig.add_axes([0, 0, 1, 1], 
-                      projection = ccrs.LambertConformal(),
-                      frameon = False)
-    
-    # Ocultar los ejes 
-    ax.patch.set_visible(False)
-    
-    # Centrar el mapa en Estados Unidos
-    ax.set_extent([-125, -66.5, 20, 50], ccrs.Geodetic())
     
-    # Obtención de la geografía de cada estado
-    shapename = 'admin_1_states_provinces_lakes' 
-    states_shp = shpreader.natural_earth(resolution='110m',
-                                         category='cultural', name=shapename)
-    
-    # Título de la imagen
-    if year == None:
-        ax.set_title('Accidentes de Estados Unidos')
-    else:
-        ax.set_title('Accidentes de Estados Unidos en ' + str(year))
-    
-    # Maximo, minimo y mediana de la distribucion de accientes
-    accidents_max = accident_count.loc[
-        accident_count.index == accident_count.idxmax()["accidents"]
-        ]["accidents"].iloc[0]
-    
-    accidents_min = accident_count.loc[
-        accident_count.index == accident_count.idxmin()["accidents"]
-        ]["accidents"].iloc[0]
-    
-    median = accident_count.median()["accidents"]
-    
-    
-    #Coloreado de cada estado segun el numero de accidentes
-    for each_state in shpreader.Reader(states_shp).records():
+    parser = argparse.ArgumentParser(prog = "main.py", 
+                                     description = "Visualizador de los datos de accidentes en Estados Unidos")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    
+    render = commands.add_parser("render", help = "Genera las imágenes del mapa y la leyenda sin interfaz gráfica")
+    render.add_argument("--years", type = _parseYears, default = list(YEARS), 
+                        help = "Años, por ejemplo 2010-2021 o 2014,2016")
+    render.add_argument("--states", type = _parseStates, action = "append", 
+                        help = "Estados: 'todos', '1,2,4' o 'nombre=1,2,4'. Se puede repetir")
+    render.add_argument("--out", default = "imagenes", help = "Carpeta de salida")
+    render.add_argument("--format", nargs = "+", default = ["png"], choices = ["png", "svg", "pdf"])
+    render.add_argument("--jobs", type = int, default = None, help = "Número de procesos")
+    render.add_argument("--dpi", type = int, default = 100)
+    render.add_argument("--scheme", default = "mediana", choices = list(SCHEMES), 
+                        help = "Esquema de clasificación de los colores")
+    render.add_argument("--measure", default = "accidentes", choices = list(MEASURES), 
+                        help = "Qué representar en el mapa")
+    render.add_argument("--snapshot", default = None, 
+                        help = "Leer los datos de una instantánea de 'snapshot' en lugar de CrashAPI")
+    
+    snapshot = commands.add_parser("snapshot", 
+                                   help = "Descarga todos los estados y años en una instantánea para usar sin conexión")
+    snapshot.add_argument("--out", default = "crashes.snap", help = "Fichero de la instantánea")
+    snapshot.add_argument("--years", type = _parseYears, default = list(YEARS), 
+                          help = "Años seguidos, por ejemplo 2010-2021")
+    snapshot.add_argument("--states", type = _parseStates, default = _parseStates("todos"), 
+                          help = "Estados: 'todos' o '1,2,4'")
+    snapshot.add_argument("--workers", type = int, default = 4, help = "Número de peticiones a la vez")
+    
+    startup = commands.add_parser("startup", help = "Mide el tiempo de importar cada módulo")
+    startup.add_argument("--repeat", type = int, default = 5)
+    startup.add_argument("--output", default = None, 
+                         help = "Fichero JSON lines al que añadir la medición, para seguirla en el tiempo")
+    
+    benchmark = commands.add_parser("benchmark", 
+                                    help = "Mide cada etapa contra un servidor local que imita a CrashAPI")
+    benchmark.add_argument("--states", type = _parseStates, default = _parseStates("todos"), 
+                           help = "Estados: 'todos' o '1,2,4'")
+    benchmark.add_argument("--year", type = int, default = 2014)
+    benchmark.add_argument("--rows", type = int, default = 700, help = "Accidentes sintéticos por estado")
+    benchmark.add_argument("--latency", type = float, default = 0.05, help = "Segundos de espera por petición")
+    benchmark.add_argument("--rate", type = float, default = None, 
+                           help = "Peticiones por segundo que admite el servidor. Sin límite por defecto")
+    benchmark.add_argument("--repeat", type = int, default = 3)
+    benchmark.add_argument("--output", default = None, 
+                           help = "Fichero JSON lines al que añadir los resultados, para compararlos entre versiones")
+    
+    serve = commands.add_parser("serve", 
+                                help = "Arranca el servidor local que imita a CrashAPI, para usarlo con CRASHAPI_URL")
+    serve.add_argument("--port", type = int, default = 8000)
+    serve.add_argument("--rows", type = int, default = 700, help = "Accidentes sintéticos por estado")
+    serve.add_argument("--latency", type = float, default = 0.0, help = "Segundos de espera por petición")
+    serve.add_argument("--rate", type = float, default = None, help = "Peticiones por segundo admitidas")
+    serve.add_argument("--max-rows", type = int, default = None, 
+                       help = "Filas máximas por respuesta, para imitar el corte de la API")
+    
+    service = commands.add_parser("service", 
+                                  help = "Servicio HTTP local con los conteos, mapas y leyendas para varios usuarios")
+    service.add_argument("--host", default = "127.0.0.1")
+    service.add_argument("--port", type = int, default = 8080)
+    service.add_argument("--jobs", type = int, default = None, help = "Procesos de dibujado")
+    service.add_argument("--dpi", type = int, default = 100)
+    service.add_argument("--stand-in", action = "store_true", 
+                         help = "Usar datos sintéticos de un servidor local en lugar de CrashAPI")
+    service.add_argument("--rows", type = int, default = 700, help = "Accidentes sintéticos por estado con --stand-in")
+    service.add_argument("--snapshot", default = None, 
+                         help = "Leer los datos de una instantánea de 'snapshot' en lugar de CrashAPI")
+    
+    commands.add_parser("check", help = "Comprueba contra el servidor local casos de CrashAPI que ya fallaron")
+    
+    args = parser.parse_args(argv)
+    
+    if args.command == "render":
+        from rendering import renderBatch
         
-        # Bordes de cada estado
-        edgecolor = 'black'
+        # Por la variable de entorno también la usan los procesos de dibujado
+        if args.snapshot is not None:
+            os.environ["CRASHDATA_SNAPSHOT"] = os.path.abspath(args.snapshot)
+            import crashdata
+            crashdata.useSnapshot(args.snapshot)
         
-        # Comprobar que el estado existe y tiene datos
-        try:
-            state_accidents = accident_count.loc[accident_count.index == each_state.attributes['name']]["accidents"].iloc[0]
-        except:
-            state_accidents = 0
-    
-        # Colorear el interior segun rangos dependientes del máximo, el mínimo y la mediana de los datos
-        if state_accidents == 0:
-            facecolor = "white"
-        elif state_accidents <= accidents_min + (median - accidents_min) * 1/3:
-            facecolor = "lightyellow"
-        elif state_accidents <= accidents_min + (median - accidents_min) * 2/3:
-            facecolor = "yellow"
-        elif state_accidents <= median:
-            facecolor = "gold"
-        elif state_accidents <= median + (accidents_max - median) * 1/6:
-            facecolor = "orange"
-        elif state_accidents <= median + (accidents_max - median) * 2/6:
-            facecolor = "xkcd:pumpkin"
-        elif state_accidents <= median + (accidents_max - median) * 4/6:
-            facecolor = "xkcd:vermillion"
-        elif state_accidents <= median + (accidents_max - median) * 5/6:
-            facecolor = "xkcd:brownish red"
-        else:
-            facecolor = "xkcd:dried blood"
-
+        state_sets = dict(args.states or [_parseStates("todos")])
         
-        # coloreado
-        ax.add_geometries([each_state.geometry], 
-                          ccrs.PlateCarree(),
-                          facecolor = facecolor, 
-                          edgecolor = edgecolor)
+        clock = time.time()
+        written = renderBatch(args.years, state_sets, args.out, args.format, args.jobs, args.dpi, 
+                              scheme = args.scheme, measure = args.measure)
+        print(len(written), "imágenes generadas en", round(time.time() - clock, 1), "segundos.")
     
+    if args.command == "snapshot":
+        from crashdata import exportSnapshot
         
-    return fig
-
-
-def plotMapAccidentsLeyend(count_of_accidents : pd.DataFrame, extra_info : bool = True):
-    """
-        Dibuja la leyenda del mapa generado por plotMapAccidents(),
-        generada aparte para no tapar el propio mapa.
+        years = range(min(args.years), max(args.years) + 1)
         
-        accident_count : pd.Dataframe -> Dataframe obtenido de CrashAPI, preprocesado, agrupado
-                                            por estados y con las observaciones contadas.
-                                            Se recomienda utilizar groupCountAccidents().
-        extra_info : bool             -> Por defecto True. Muestra información adicional sobre
-                                            los datos por la línea de comandos.
-    """
-    
-
-    # Maximo, minimo y mediana de la distribucion de accientes
-    accidents_max = count_of_accidents.loc[
-        count_of_accidents.index == count_of_accidents.idxmax()["accidents"]
-        ]["accidents"].iloc[0]
-    
-    accidents_min = count_of_accidents.loc[
-        count_of_accidents.index == count_of_accidents.idxmin()["accidents"]
-        ]["accidents"].iloc[0]
-    
-    median = count_of_accidents.median()["accidents"]
-    
-    
-    # Generación de la imagen vacía  
-    fig = plt.figure(figsize = (3.5, 2.1))
-    ax = fig.add_axes([0, 0, 1, 1],
-                      frameon = True)
-    
-    # Ocultar los ejes
-    ax.patch.set_visible(False)
-    
-    # Lista de rangos de datos con sus correspondientes colores
-    legend_info = [
-        mpatches.Patch(color = "white", 
-                       label = "Sin datos de accidentes", linestyle = "-"),
-        mpatches.Patch(color = "lightyellow", 
-                       label = "Entre 0 y " + str(int(accidents_min + (median - accidents_min) * 1/3)) + " accidentes"),
-        mpatches.Patch(color = "yellow", 
-                       label = "Entre " + str(int(accidents_min + (median - accidents_min) * 1/3))
-                              + " y " + str(int(accidents_min + (median - accidents_min) * 2/3)) + " accidentes"),
-        mpatches.Patch(color = "gold", 
-                       label = "Entre " + str(int(accidents_min + (median - accidents_min) * 2/3))
-                              + " y " + str(int(median)) + " (la mediana) accidentes"),
-        mpatches.Patch(color = "orange", 
-                       label = "Entre " + str(int(median))
-                              + " y " + str(int(median + (accidents_max - median) * 1/6)) + " accidentes"),
-        mpatches.Patch(color = "xkcd:pumpkin", 
-                       label = "Entre " + str(int(median + (accidents_max - median) * 1/6))
-                              + " y " + str(int(median + (accidents_max - median) * 2/6)) + " accidentes"),
-        mpatches.Patch(color = "xkcd:vermillion", 
-                       label = "Entre " + str(int(median + (accidents_max - median) * 2/6))
-                              + " y " + str(int(median + (accidents_max - median) * 4/6)) + " accidentes"),
-        mpatches.Patch(color = "xkcd:brownish red", 
-                       label = "Entre " + str(int(median + (accidents_max - median) * 4/6))
-                              + " y " + str(int(median + (accidents_max - median) * 5/6)) + " accidentes"),
-        mpatches.Patch(color = "xkcd:dried blood", 
-                       label = "Entre " + str(int(median + (accidents_max - median) * 5/6))
-                              + " y " + str(int(accidents_max)) + " accidentes")
-    ]
-    
-    # Generar la leyenda
-    plt.legend(handles = legend_info)
-    
-    # Mostrar información adicional de la base de datos
-    if extra_info:
-        print(count_of_accidents.describe())
+        def progress(done : int, total : int):
+            print("Paquete", done, "de", total, end = "\r", flush = True)
         
-    return fig
-
-
-#%% DEFINICIÓN DE LA INTERFAZ GRÁFICA
-
-
-def make_window(theme : sg.theme) -> sg.Window:
-    """
-        Define y genera la interaz gráfica de PySimpleGUI.
+        clock = time.time()
+        rows = exportSnapshot(args.out, args.states[1], years, workers = args.workers, progress = progress)
+        print()
+        print(rows, "accidentes guardados en", args.out, "en", round(time.time() - clock, 1), "segundos.")
+        print("Para usarla: CRASHDATA_SNAPSHOT=" + os.path.abspath(args.out) + " python main.py")
+    
+    if args.command == "startup":
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "python": sys.version.split()[0],
+                  "import_ms": measureStartup(args.repeat)}
+        print(json.dumps(record))
         
-        theme : sg.theme       -> Tema elegido para la interfaz. Se define como
-                                    sg.theme("green mono") por defecto
-    """
-    
-    # Establece el tema elegido
-    sg.theme(theme)
-    
-    # Define las pestañas principales de la ventana
-    menu_def = [['&Menú', ['&Salir']],
-                ['&Ayuda', ['&¿Cómo usar el visualizador?']] ]
-    
-    # Define lo que aparece al hacer click derecho
-    right_click_menu_def = [[], ['&Salir']]
-
-    # Define la colocación de los elementos y widgets de la aplicación en la primera pestaña de la aplicación
-    main_layout =  [
-        [sg.Text('Observa la distribucion de accidentes de trafico en Estados Unidos')], 
-        [sg.Slider(orientation = 'h', 
-                      key = '-SLIDER-', 
-                      range = (2010,2021),
-                      pad = 30,
-                      s = (42,20)),
-         sg.Button('Dibujar', 
-                      key = '-BUTTON-')
-         ], 
-        [sg.Frame ( 
-            title = "Zona de dibujado",
-            layout = [[
-            sg.Canvas(size = (425,285), 
-                      key = 'plot-canvas', 
-                      border_width = 2, 
-                      background_color = "#11875d"),
-            sg.Canvas(size = (252,151), 
-                      key = 'plot-canvas2', 
-                      border_width = 2, 
-                      background_color = "#11875d")
-            ]]
-        )],
-    ]
-    
+        if args.output is not None:
+            with open(args.output, "a", encoding = "utf-8") as f:
+                f.write(json.dumps(record) + "\n")
     
-    # Define la colocación de los elementos y widgets de la aplicación en la segunda pestaña de la aplicación
-    # Genera una conjunto de columnas para los seleccionables de los estados
-    # Coloca automáticamente los estados en orden alfabético en columnas de
-    # STATE_PER_COLUMN número de estados
-    STATES_PER_COLUMN = 14
-    
-    states_layout = list()
-    state_columns = list()
-    names = list(STATE_CODES.keys())
-    
-    # Reparte la lista alfabética de estados en las diferentes columnas
-    for column in range(0, int(len(names) / STATES_PER_COLUMN + 1) ):
-        for row in range(0, STATES_PER_COLUMN):
-            if column * STATES_PER_COLUMN + row < len(names):
-                state_columns.append([
-                    sg.Checkbox(str(names[column * STATES_PER_COLUMN + row]), 
-                                default = True, 
-                                key = str(names[column * STATES_PER_COLUMN + row]))
-                        ])
+    if args.command == "benchmark":
+        from benchmark import runBenchmarks
         
-        states_layout.append(sg.Column(state_columns.copy()))
-        state_columns.clear()
-    
-    states_layout = [states_layout]
-    
-    # Define la colocación de los elementos y widgets de la aplicación en la última pestaña de la aplicación
-    logging_layout = [
-        [sg.Text("Información adicional sobre la base de datos")],
-        [sg.Multiline(size = (60,15), 
-                       font = 'Courier 8', 
-                       expand_x = True, 
-                       expand_y = True, 
-                       write_only = True,
-                       reroute_stdout = True, 
-                       reroute_stderr = True, 
-                       echo_stdout_stderr = True, 
-                       autoscroll = True, 
-                       auto_refresh = True
-                       )]
-        ]
-    
-    
-    # Coloca el resto de definiciones en orden y define el menú
-    layout = [ [sg.MenubarCustom(menu_def, 
-                       key = '-MENU-', 
-                       font = 'Courier 15', 
-                       tearoff = True)],
-                [sg.Text('Visualizador de los datos de accidentes en Estados Unidos', 
-                       size = (50, 1), 
-                       justification = 'center', 
-                       font = ("Helvetica", 16), 
-                       relief = sg.RELIEF_RIDGE, 
-                       key = '-TEXT HEADING-', 
-                       enable_events = True)]]
-    
-    
-    layout +=[[sg.TabGroup([
-                       [sg.Tab('Gráfico de Accidentes', main_layout),
-                       sg.Tab('Estados de Interés', states_layout),
-                       sg.Tab('Información adicional', logging_layout)]
-                       ], 
-                           
-                       key = '-TAB GROUP-', 
-                       expand_x = True, 
-                       expand_y = True),
-
-               ]]
-    
-    layout[-1].append(sg.Sizegrip())
-    
-    # Define el comportamiento de la ventana de la aplicación
-    window = sg.Window('Accidentes de EEUU', 
-                       layout, 
-                       right_click_menu = right_click_menu_def, 
-                       right_click_menu_tearoff = True, 
-                       grab_anywhere = False, 
-                       resizable = True, 
-                       margins = (0,0), 
-                       use_custom_titlebar = True, 
-                       finalize = True, 
-                       keep_on_top = False,
-                       element_justification = "c"
-                       )
-    
-    window.set_min_size((700,500))
-    
-    # Expande las columnas de la segunda pestaña para que ocupen el tamaño nuevo de la ventana
-    for i in states_layout[0]:
-        i.expand(True, True)
+        record = runBenchmarks(args.states[1], args.year, args.rows, args.latency, args.rate, args.repeat)
         
-    return window
-
-def main():
-    
-    # Genera la ventana
-    window = make_window(sg.theme())
-    
-    # Define variables para los handlers de pyplot que permiten embedding
-    figure_canvas_agg = None 
-    figure_canvas_agg2 = None 
-    
+        for stage, result in record["stages"].items():
+            print(stage.ljust(34), str(result["median_ms"]).rjust(10), "ms")
+        
+        if args.output is not None:
+            with open(args.output, "a", encoding = "utf-8") as f:
+                f.write(json.dumps(record) + "\n")
     
-    # Bucle principal de la interfaz gráfica
-    while True:
+    if args.command == "serve":
+        from benchmark import StandInServer
         
-        # Comprobar si el usuario hace algo
-        event, values = window.read(timeout = 100)
-               
-        # Si elige salir, salir del bucle principal
-        if event in (None, 'Salir', sg.WIN_CLOSED):
-            break
-
-        # Si decide leer la ayuda, crear un popup con información
-        if event == '¿Cómo usar el visualizador?':
-            sg.popup('Visualizador de accidentes en EEUU.',
-                     '---Pagina "Gráfico de Accidentes"---',
-                     'Puedes mover la barra deslizante de izquierda a derecha.',
-                     'De esa forma se puede elegir el año del que obtener información sobre accidentes.',
-                     'Se generará un gráfico con los datos de ese año al presionar el botón "Dibujar".',
-                     '---Pagina "Estados de Interés"---',
-                     'Puedes elegir los estados que se contabilizarán en el dibujado del mapa.', 
-                     'Los rangos de los colores son dinámicos, y dependen de los datos máximo, mínimo y mediana.', 
-                     'Se recomienda eliminar estados con valores muy elevados o sin apenas accidentes',
-                     'Estos repercuten en el resultado final al aumentar los rangos de cada color, opacando diferencias menores entre otros estados',
-                     '---Pagina "Información Adicional"---',
-                     'Puedes observar algunos datos cuantitativos de la base de datos que se haya elegido',
-                     keep_on_top=True)
+        server = StandInServer(args.rows, args.latency, args.rate, port = args.port, max_rows = args.max_rows)
+        print("Sirviendo datos sintéticos en", server.url)
+        print("Para usarlo: CRASHAPI_URL=" + server.url + " python main.py")
         
-        # Si pulsa el botón "Dibujar",
-        if event  == '-BUTTON-':
-            
-            # Eliminar dibujos anteriores para que no se acumulen
-            if not figure_canvas_agg == None:
-                figure_canvas_agg.get_tk_widget().forget()
-                figure_canvas_agg2.get_tk_widget().forget()
-                plt.close('all')
-            
-            # Comprobar el tiempo de ejecución
-            clock = time.time()
-            
-            # Generar una lista de los estados que se van a pedir a CrashAPI
-            state_codes = list(STATE_CODES.values())
-            for state_name in list(STATE_CODES.keys()):
-                try:
-                    if not (values[state_name]):
-                        state_codes.remove(STATE_CODES[state_name])
-                except KeyError:
-                    pass
-            
-            # Realizar la petición a CrashaPI
-            df = getDataframe(state_codes, int(values['-SLIDER-']))       
-            df = preprocess(df)
-            accident_count = groupCountAccidents(df)
-            
-            #Comprobar el tiempo utilizado en la petición
-            clock = time.time() - clock
-            print("Tiempo utilizado para obtener la base de datos:", round(clock,1), "segundos.")
+        with server:
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                pass
+    
+    if args.command == "service":
+        import asyncio
+        import tempfile
+        import crashdata
+        from service import MapService
+        
+        stand_in = None
+        if args.stand_in:
+            from benchmark import StandInServer
+            stand_in = StandInServer(args.rows).start()
+            crashdata.CRASHAPI_URL = stand_in.url
+            crashdata.RATE_LIMITER = crashdata.TokenBucket(1000, 1000)
+            # Ni los datos sintéticos ni los límites de sus paquetes se guardan con los de CrashAPI
+            crashdata.CACHE = crashdata.CrashCache(tempfile.mkdtemp(prefix = "crashdata_"))
+            crashdata.BATCH_SIZER = crashdata.BatchSizer(None)
+        if args.snapshot is not None:
+            crashdata.useSnapshot(args.snapshot)
+        
+        def ready(server : MapService):
+            print("Sirviendo el visualizador en", server.url)
+            print("Por ejemplo:", server.url + "/map.png?year=2014&states=todos")
+        
+        try:
+            asyncio.run(MapService(args.host, args.port, args.jobs, args.dpi).serveForever(ready))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if stand_in is not None:
+                stand_in.stop()
+    
+    if args.command == "check":
+        from benchmark import runChecks
+        
+        results = runChecks()
+        for name, result in results.items():
+            print(name.ljust(34), "bien" if result["ok"] else "MAL", result)
+        
+        if not all(result["ok"] for result in results.values()):
+            return 1
+    
+    return 0
 
-            # Dibujar el mapa con la información obtenida            
-            fig = plotMapAccidents(accident_count, int(values['-SLIDER-']))
-            fig2 = plotMapAccidentsLeyend(accident_count)
-            
-            # Colocar los dibujos generados en la ventana mediante embedding
-            figure_canvas_agg = FigureCanvasTkAgg(fig, window['plot-canvas'].TKCanvas)
-            figure_canvas_agg.draw()
-            figure_canvas_agg.get_tk_widget().pack(side='top', fill='both', expand=1)
-            
-            figure_canvas_agg2 = FigureCanvasTkAgg(fig2, window['plot-canvas2'].TKCanvas)
-            figure_canvas_agg2.draw()
-            figure_canvas_agg2.get_tk_widget().pack(side='top', fill='both', expand=1)
-            
-            
-    # Al salir, eliminar los dibujos para que no salgan por la lína de comandos y cerrar la ventana
-    if not figure_canvas_agg == None:
-        figure_canvas_agg.get_tk_widget().forget()
-        figure_canvas_agg2.get_tk_widget().forget()
-        plt.close('all')
 
-    window.close()
+def main():
+    """
+        Abre la interfaz gráfica del visualizador.
+    """
+    try:
+        import gui
+    except ImportError:
+        sys.exit("PySimpleGUI no está instalado. Usa 'python main.py render' para generar imágenes sin interfaz.")
     
+    gui.sg.theme('green mono')
+    gui.main()
+
 
 if __name__ == '__main__':
-    sg.theme('green mono')
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
+    
+    main()
@@ -0,0 +1,1211 @@
+# -*- coding: utf-8 -*-
+"""
+Dibujado del mapa de accidentes de Estados Unidos y su leyenda, con
+o sin interfaz gráfica.
+"""
+
+from __future__ import annotations
+
+#%% DEPENDENCIAS
+
+
+# Dibujado de funciones
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import matplotlib.patches as mpatches
+from matplotlib.collections import PathCollection
+from matplotlib.path import Path
+from matplotlib.transforms import Affine2D
+
+# Embedding en la interfaz gráfica, no necesario sin ella
+try:
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+except ImportError:
+    FigureCanvasTkAgg = None
+
+# Dibujado de mapas cartográficos
+from cartopy import crs as ccrs
+import shapefile
+import shapely.geometry
+try:
+    from cartopy.mpl.path import shapely_to_path
+except ImportError:
+    # Versiones de cartopy anteriores a 0.23
+    from cartopy.mpl.patch import geos_to_path
+    shapely_to_path = None
+
+# Manejo de bases de datos
+import pandas as pd
+import numpy as np
+
+# Caché de la geometría y de las imágenes, y dibujado en varios procesos
+import io
+import os
+import threading
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from crashdata import CACHE_DIR, PREPROCESS_COLUMNS, MEASURES, YEARS, getDataframe
+from aggregation import preprocess, groupCountAccidents
+from classification import Classifier
+from instrumentation import RECORDER
+
+
+#%% GEOMETRÍA DE LOS ESTADOS
+
+
+# Mapa de estados incluido en el repositorio
+USA_STATES_SHP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "USA_States.shp")
+
+# Nombre de cada figura de USA_States.shp, en orden. El fichero se
+# distribuye sin su .dbf, por lo que los nombres no se pueden leer de él
+USA_STATES_NAMES = [
+    "Washington", "Montana", "Maine", "North Dakota", "South Dakota", "Wyoming",
+    "Wisconsin", "Idaho", "Vermont", "Minnesota", "Oregon", "New Hampshire",
+    "Iowa", "Massachusetts", "Nebraska", "New York", "Pennsylvania", "Connecticut",
+    "Rhode Island", "New Jersey", "Indiana", "Nevada", "Utah", "California",
+    "Ohio", "Illinois", "District of Columbia", "Delaware", "West Virginia", "Maryland",
+    "Colorado", "Kentucky", "Kansas", "Virginia", "Missouri", "Arizona",
+    "Oklahoma", "North Carolina", "Tennessee", "Texas", "New Mexico", "Alabama",
+    "Mississippi", "Georgia", "South Carolina", "Arkansas", "Louisiana", "Florida",
+    "Michigan", "Hawaii", "Alaska"
+]
+
+# Proyección en la que se dibuja el mapa
+MAP_PROJECTION = ccrs.LambertConformal()
+
+
+def _geometryPath(geometry) -> Path:
+    """
+        Convierte una geometría de shapely en un Path de matplotlib.
+    """
+    if shapely_to_path is not None:
+        return shapely_to_path(geometry)
+    return Path.make_compound_path(*geos_to_path(geometry))
+
+
+class StateGeometry:
+    """
+        Contornos de los estados, leídos una sola vez de un shapefile
+        y proyectados una sola vez a cada proyección de mapa. Los contornos
+        proyectados se guardan en disco, por lo que los siguientes
+        arranques no tienen que leer el shapefile ni volver a proyectar.
+        No necesita conexión a internet.
+        
+        path : str             -> Shapefile con los estados (en grados,
+                                    PlateCarree). Si tiene .dbf, el nombre
+                                    se lee del campo 'name', 'NAME' o
+                                    'STATE_NAME'. Si no, se usa USA_STATES_NAMES.
+        cache_dir : str        -> Carpeta donde guardar los contornos proyectados.
+    """
+    
+    NAME_FIELDS = ("name", "NAME", "STATE_NAME")
+    
+    def __init__(self, path : str = USA_STATES_SHP, cache_dir : str = CACHE_DIR):
+        self.path = path
+        self.cache_dir = cache_dir
+        self._projected = dict()
+        self._lock = threading.Lock()
+    
+    
+    def _records(self) -> tuple[list[str], list]:
+        """
+            Lee del shapefile el nombre y la geometría de cada estado.
+        """
+        dbf = os.path.splitext(self.path)[0] + ".dbf"
+        
+        if os.path.exists(dbf):
+            reader = shapefile.Reader(self.path)
+            fields = [field[0] for field in reader.fields[1:]]
+            name_field = next(field for field in self.NAME_FIELDS if field in fields)
+            names = [record[name_field] for record in reader.records()]
+            shapes = reader.shapes()
+            reader.close()
+        else:
+            with open(self.path, "rb") as shp:
+                shapes = shapefile.Reader(shp = shp).shapes()
+            names = USA_STATES_NAMES
+            if len(names) != len(shapes):
+                raise ValueError("El shapefile " + self.path + " no tiene .dbf con los nombres de los estados")
+        
+        return names, [shapely.geometry.shape(shape.__geo_interface__) for shape in shapes]
+    
+    
+    def _cacheFile(self, projection : ccrs.Projection) -> str:
+        """
+            Fichero de caché de los contornos, que cambia si lo hace el
+            shapefile o la proyección.
+        """
+        info = os.stat(self.path)
+        key = "|".join([os.path.abspath(self.path), str(info.st_size), str(info.st_mtime_ns), projection.to_wkt()])
+        return os.path.join(self.cache_dir, "geometry_" + hashlib.sha1(key.encode()).hexdigest()[:16] + ".npz")
+    
+    
+    def paths(self, projection : ccrs.Projection = MAP_PROJECTION) -> tuple[list[str], list[Path]]:
+        """
+            Devuelve los nombres de los estados y sus contornos proyectados
+            como Path de matplotlib, en coordenadas de 'projection'.
+            
+            projection : ccrs.Projection -> Proyección del mapa.
+        """
+        key = projection.to_wkt()
+        
+        with self._lock:
+            if key not in self._projected:
+                cache_file = self._cacheFile(projection)
+                try:
+                    self._projected[key] = self._load(cache_file)
+                except (OSError, ValueError, KeyError):
+                    names, geometries = self._records()
+                    paths = [_geometryPath(projection.project_geometry(geometry, ccrs.PlateCarree()))
+                             for geometry in geometries]
+                    self._projected[key] = (names, paths)
+                    self._save(cache_file, names, paths)
+        
+        return self._projected[key]
+    
+    
+    @staticmethod
+    def _load(cache_file : str) -> tuple[list[str], list[Path]]:
+        with np.load(cache_file, allow_pickle = False) as data:
+            names = data["names"].tolist()
+            offsets = data["offsets"]
+            vertices = data["vertices"]
+            codes = data["codes"]
+        
+        paths = [Path(vertices[start:stop], codes[start:stop]) 
+                 for start, stop in zip(offsets[:-1], offsets[1:])]
+        return names, paths
+    
+    
+    @staticmethod
+    def _save(cache_file : str, names : list[str], paths : list[Path]):
+        # Todos los vértices seguidos y la posición en la que empieza cada estado
+        offsets = np.cumsum([0] + [len(path.vertices) for path in paths])
+        codes = [path.codes if path.codes is not None else np.full(len(path.vertices), Path.LINETO) 
+                 for path in paths]
+        
+        os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+        with open(cache_file + ".tmp", "wb") as f:
+            np.savez(f,
+                     names = np.array(names, dtype = str),
+                     offsets = offsets,
+                     vertices = np.concatenate([path.vertices for path in paths]),
+                     codes = np.concatenate(codes).astype(np.uint8))
+        os.replace(cache_file + ".tmp", cache_file)
+
+
+# Geometría compartida por todos los mapas
+STATE_GEOMETRY = StateGeometry()
+
+
+#%% GEOMETRÍA DE LOS CONDADOS
+
+
+# Mapa de condados, que no se incluye en el repositorio por su tamaño. Sirve
+# cualquier shapefile con el código FIPS de cada condado en el campo GEOID
+# (o STATEFP y COUNTYFP), como los cb_*_us_county_*.shp del censo
+USA_COUNTIES_SHP = os.environ.get("USA_COUNTIES_SHP", 
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), "USA_Counties.shp"))
+
+# Tolerancias de simplificación de cada nivel de detalle, en unidades de la
+# proyección (metros). El nivel 0 es la geometría original
+COUNTY_TOLERANCES = (0, 500, 2500, 10000)
+
+
+class CountyGeometry(StateGeometry):
+    """
+        Contornos de los unos 3.000 condados, proyectados y simplificados
+        una sola vez en varios niveles de detalle (COUNTY_TOLERANCES) y
+        guardados en disco como los de los estados. Con el mapa completo
+        se dibuja el nivel más simplificado; al acercarse, niveles con más
+        detalle, pero solo de los condados visibles, que se buscan en un
+        índice espacial (STRtree) de sus rectángulos.
+        
+        path : str             -> Shapefile de condados con .dbf.
+        cache_dir : str        -> Carpeta donde guardar los contornos proyectados.
+        tolerances : tuple     -> Tolerancia de cada nivel de detalle, de menor a mayor.
+    """
+    
+    def __init__(self, path : str = USA_COUNTIES_SHP, cache_dir : str = CACHE_DIR, 
+                 tolerances : tuple = COUNTY_TOLERANCES):
+        super().__init__(path, cache_dir)
+        self.tolerances = tolerances
+        self._indexes = dict()
+    
+    
+    def _records(self) -> tuple[list[str], list]:
+        """
+            Lee del shapefile el código FIPS y la geometría de cada condado.
+        """
+        if not os.path.exists(self.path):
+            raise FileNotFoundError("No se encuentra el mapa de condados " + self.path + 
+                                    ". Se puede indicar otro con la variable de entorno USA_COUNTIES_SHP")
+        
+        reader = shapefile.Reader(self.path)
+        fields = [field[0] for field in reader.fields[1:]]
+        
+        if "GEOID" in fields:
+            names = [str(record["GEOID"]).zfill(5) for record in reader.records()]
+        elif "STATEFP" in fields and "COUNTYFP" in fields:
+            names = [str(record["STATEFP"]).zfill(2) + str(record["COUNTYFP"]).zfill(3) for record in reader.records()]
+        else:
+            reader.close()
+            raise ValueError("El shapefile " + self.path + " no tiene el campo GEOID ni STATEFP y COUNTYFP")
+        
+        shapes = reader.shapes()
+        reader.close()
+        
+        return names, [shapely.geometry.shape(shape.__geo_interface__) for shape in shapes]
+    
+    
+    def paths(self, projection : ccrs.Projection = MAP_PROJECTION, level : int = 0) -> tuple[list[str], list[Path]]:
+        """
+            Devuelve los códigos FIPS de los condados y sus contornos
+            proyectados en el nivel de detalle 'level'. El orden es el
+            mismo en todos los niveles.
+            
+            projection : ccrs.Projection -> Proyección del mapa.
+            level : int                  -> Nivel de detalle, índice de 'tolerances'.
+        """
+        key = (projection.to_wkt(), level)
+        
+        with self._lock:
+            if key not in self._projected:
+                try:
+                    self._projected[key] = self._load(self._levelFile(projection, level))
+                except (OSError, ValueError, KeyError):
+                    self._build(projection)
+        
+        return self._projected[key]
+    
+    
+    def _levelFile(self, projection : ccrs.Projection, level : int) -> str:
+        return self._cacheFile(projection)[:-len(".npz")] + "_lod" + str(self.tolerances[level]) + ".npz"
+    
+    
+    def _build(self, projection : ccrs.Projection):
+        """
+            Proyecta los condados y guarda todos los niveles de detalle.
+        """
+        with RECORDER.span("geometry", counties = True):
+            names, geometries = self._records()
+            projected = self._project(geometries, projection)
+            
+            for level, tolerance in enumerate(self.tolerances):
+                if tolerance > 0:
+                    geometries = [geometry.simplify(tolerance, preserve_topology = True) for geometry in projected]
+                else:
+                    geometries = projected
+                paths = [_geometryPath(geometry) for geometry in geometries]
+                
+                self._projected[(projection.to_wkt(), level)] = (names, paths)
+                self._save(self._levelFile(projection, level), names, paths)
+    
+    
+    @staticmethod
+    def _project(geometries : list, projection : ccrs.Projection) -> list:
+        """
+            Proyecta todos los condados del hemisferio occidental con una
+            sola llamada a transform_points sobre todos sus vértices, mucho
+            más rápido que proyectarlos uno a uno. Los que cruzan el
+            antimeridiano (islas Aleutianas) se proyectan con
+            project_geometry(), que los corta correctamente.
+        """
+        geometries = np.array(geometries, dtype = object)
+        bounds = shapely.bounds(geometries)
+        western = (bounds[:, 0] >= -180) & (bounds[:, 2] <= 0)
+        
+        def transform(coordinates : np.ndarray) -> np.ndarray:
+            return projection.transform_points(ccrs.PlateCarree(), coordinates[:, 0], coordinates[:, 1])[:, :2]
+        
+        projected = np.empty(len(geometries), dtype = object)
+        projected[western] = shapely.transform(geometries[western], transform)
+        for i in np.flatnonzero(~western):
+            projected[i] = projection.project_geometry(geometries[i], ccrs.PlateCarree())
+        
+        return list(projected)
+    
+    
+    def level(self, units_per_pixel : float) -> int:
+        """
+            Nivel con menos detalle cuya simplificación no llega a notarse,
+            es decir, con una tolerancia menor que un píxel.
+            
+            units_per_pixel : float -> Unidades de la proyección por píxel en pantalla.
+        """
+        return max(level for level, tolerance in enumerate(self.tolerances) 
+                   if tolerance <= units_per_pixel or level == 0)
+    
+    
+    def visible(self, extent : tuple, projection : ccrs.Projection = MAP_PROJECTION) -> np.ndarray:
+        """
+            Posiciones de los condados cuyo rectángulo corta la vista.
+            El índice espacial se crea la primera vez con los contornos
+            del nivel más simplificado, que tienen el mismo rectángulo.
+            
+            extent : tuple               -> (x mínimo, x máximo, y mínimo, y máximo)
+                                                en unidades de la proyección.
+            projection : ccrs.Projection -> Proyección del mapa.
+        """
+        key = projection.to_wkt()
+        
+        if key not in self._indexes:
+            _, paths = self.paths(projection, len(self.tolerances) - 1)
+            boxes = [shapely.geometry.box(*path.vertices.min(axis = 0), *path.vertices.max(axis = 0)) 
+                     if len(path.vertices) else shapely.geometry.Point(np.inf, np.inf)
+                     for path in paths]
+            self._indexes[key] = shapely.STRtree(boxes)
+        
+        x0, x1, y0, y1 = extent
+        return np.sort(self._indexes[key].query(shapely.geometry.box(x0, y0, x1, y1)))
+
+
+# Geometría de los condados, que solo se lee al dibujar por condados
+COUNTY_GEOMETRY = CountyGeometry()
+
+
+#%% DIBUJADO DEL MAPA
+
+
+# Colores de cada rango de accidentes, de los estados sin datos al máximo
+MAP_COLORS = ["white", "lightyellow", "yellow", "gold", "orange", "xkcd:pumpkin", 
+              "xkcd:vermillion", "xkcd:brownish red", "xkcd:dried blood"]
+
+
+# Clasificador por defecto, compartido por el mapa y la leyenda
+CLASSIFIER = Classifier()
+RECORDER.watch("classifier", CLASSIFIER.stats)
+
+
+def _stateColors(names : list[str], accident_count : pd.DataFrame, 
+                 classifier : Classifier = CLASSIFIER, column : str = "accidents") -> np.ndarray:
+    """
+        Color de MAP_COLORS de cada estado de 'names' según su número de
+        accidentes. Los estados sin datos o con 0 accidentes quedan en blanco.
+        
+        names : list[str]             -> Nombres de los estados en el orden
+                                            en que se van a dibujar.
+        accident_count : pd.Dataframe -> Observaciones contadas por estado.
+        classifier : Classifier       -> Clasificador de los rangos de colores.
+        column : str                  -> Columna de 'accident_count' que representar,
+                                            según MEASURES.
+    """
+    
+    # Un único cruce de los nombres con el índice de la tabla de accidentes
+    accidents = accident_count[column].reindex(names).fillna(0).to_numpy()
+    
+    # Rango de cada estado: 1 hasta el primer límite incluido, 2 hasta el segundo...
+    classes = classifier.classify(accidents, classifier.bounds(accident_count[column]))
+    
+    return np.array(MAP_COLORS)[classes]
+
+
+def _mapTitle(year : int = None, measure : str = "accidentes") -> str:
+    title = 'Accidentes de Estados Unidos' if measure == "accidentes" else measure.capitalize() + ' en Estados Unidos'
+    if year == None:
+        return title
+    return title + ' en ' + str(year)
+
+
+def _drawMap(fig : plt.Figure, accident_count : pd.DataFrame = None, year : int = None, 
+             classifier : Classifier = CLASSIFIER, 
+             measure : str = "accidentes") -> tuple[plt.Axes, PathCollection, list[str]]:
+    """
+        Dibuja en 'fig' el mapa de los estados como una única colección
+        de contornos. Devuelve los ejes, la colección y el nombre de cada
+        estado en el orden de la colección, para poder recolorearla después.
+        
+        fig : plt.Figure              -> Figura vacía en la que dibujar.
+        accident_count : pd.Dataframe -> Observaciones contadas por estado.
+                                            Si es None, los estados quedan en blanco.
+        year : int                    -> Año que mostrar en el título.
+        classifier : Classifier       -> Clasificador de los rangos de colores.
+        measure : str                 -> Qué representar, según MEASURES.
+    """
+    
+    # Elección de ejes cartesianos para el mapa de la Tierra (en vez de un mapa curvado)
+    ax = fig.add_axes([0, 0, 1, 1], 
+                      projection = MAP_PROJECTION,
+                      frameon = False)
+    
+    # Ocultar los ejes 
+    ax.patch.set_visible(False)
+    
+    # Centrar el mapa en Estados Unidos
+    ax.set_extent([-125, -66.5, 20, 50], ccrs.Geodetic())
+    
+    # Título de la imagen
+    ax.set_title(_mapTitle(year, measure))
+    
+    # Nombre y contorno ya proyectado de cada estado
+    names, paths = STATE_GEOMETRY.paths(ax.projection)
+    
+    if accident_count is None:
+        facecolors = [MAP_COLORS[0]] * len(names)
+    else:
+        facecolors = _stateColors(names, accident_count, classifier, MEASURES[measure][0])
+    
+    # Coloreado de todos los estados a la vez segun el numero de accidentes
+    collection = ax.add_collection(PathCollection(paths, 
+                                                  facecolors = facecolors, 
+                                                  edgecolors = 'black',
+                                                  transform = ax.transData),
+                                   autolim = False)
+    
+    return ax, collection, names
+
+
+class CountyLayer:
+    """
+        Condados coloreados bajo los contornos de los estados de un mapa.
+        Solo se dibujan los condados visibles y con el nivel de detalle
+        que corresponde a la escala de la vista; al acercarse o moverse
+        se vuelven a elegir con refresh(), que se llama sola al cambiar
+        los límites de los ejes.
+        
+        ax : plt.Axes               -> Ejes del mapa, según _drawMap().
+        geometry : CountyGeometry   -> Contornos de los condados. Por defecto
+                                        COUNTY_GEOMETRY.
+    """
+    
+    def __init__(self, ax : plt.Axes, geometry : CountyGeometry = None):
+        self.ax = ax
+        self.geometry = COUNTY_GEOMETRY if geometry is None else geometry
+        
+        # Al mover el mapa se usa un nivel con menos detalle, para que siga el ratón
+        self.coarse = False
+        
+        self.names, _ = self.geometry.paths(ax.projection)
+        self.colors = np.array(MAP_COLORS)[np.zeros(len(self.names), dtype = int)]
+        
+        self.collection = ax.add_collection(PathCollection([], 
+                                                           edgecolors = 'grey', 
+                                                           linewidths = 0.2,
+                                                           transform = ax.transData,
+                                                           zorder = 0.5),
+                                            autolim = False)
+        self._shown = None
+        
+        ax.callbacks.connect("xlim_changed", lambda ax: self.refresh())
+        ax.callbacks.connect("ylim_changed", lambda ax: self.refresh())
+    
+    
+    def update(self, county_count : pd.DataFrame, classifier : Classifier = CLASSIFIER, 
+               column : str = "accidents"):
+        """
+            Colorea los condados según sus accidentes.
+            
+            county_count : pd.Dataframe -> Accidentes por condado según
+                                            groupCountAccidentsByCounty().
+            classifier : Classifier     -> Clasificador de los rangos de colores.
+            column : str                -> Columna que representar, según MEASURES.
+        """
+        self.colors = _stateColors(self.names, county_count, classifier, column)
+        self.refresh(force = True)
+    
+    
+    def refresh(self, force : bool = False):
+        """
+            Elige los condados visibles y su nivel de detalle según la
+            vista actual de los ejes.
+        """
+        x0, x1 = self.ax.get_xlim()
+        y0, y1 = self.ax.get_ylim()
+        units_per_pixel = abs(x1 - x0) / max(self.ax.bbox.width, 1)
+        level = self.geometry.level(units_per_pixel * (4 if self.coarse else 1))
+        
+        visible = self.geometry.visible((min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1)), self.ax.projection)
+        
+        # Nada que cambiar si se ven los mismos condados con el mismo detalle
+        shown = (level, visible.tobytes())
+        if shown == self._shown and not force:
+            return
+        self._shown = shown
+        
+        with RECORDER.span("render", figure = "condados", level = level, counties = len(visible)):
+            _, paths = self.geometry.paths(self.ax.projection, level)
+            self.collection.set_paths([paths[i] for i in visible])
+            self.collection.set_facecolors(self.colors[visible])
+    
+    
+    def set_visible(self, visible : bool):
+        self.collection.set_visible(visible)
+
+
+def _drawLegend(fig : plt.Figure, labels : list[str]):
+    """
+        Dibuja en 'fig' la leyenda de los rangos de colores y la devuelve.
+        
+        fig : plt.Figure       -> Figura vacía en la que dibujar.
+        labels : list[str]     -> Texto de cada rango según Classifier.labels().
+    """
+    
+    ax = fig.add_axes([0, 0, 1, 1],
+                      frameon = True)
+    
+    # Ocultar los ejes
+    ax.patch.set_visible(False)
+    
+    # Lista de rangos de datos con sus correspondientes colores
+    legend_info = [mpatches.Patch(color = color, label = label) 
+                   for color, label in zip(MAP_COLORS, labels)]
+    legend_info[0].set_linestyle("-")
+    
+    # Generar la leyenda
+    return ax.legend(handles = legend_info)
+
+
+def plotMapAccidents(accident_count : pd.DataFrame, year : int = None, 
+                     classifier : Classifier = CLASSIFIER, county_count : pd.DataFrame = None, 
+                     measure : str = "accidentes") -> plt.Figure():
+    """
+        Dibuja el mapa de estados unidos y colorea cada estado
+        según los rangos de datos de 'classifier'. Por defecto:
+            - En tercios entre el mínimo y la mediana
+            - En sextos entre la mediana y el máximo saltándose
+                tercer sexto ya que no suele contener observaciones
+        Para obtener la leyenda de los datos, utilizar plotMapAccidentsLeyend()
+        con el mismo clasificador.
+        
+        accident_count : pd.Dataframe -> Dataframe obtenido de CrashAPI, preprocesado, agrupado
+                                            por estados y con las observaciones contadas.
+                                            Se recomienda utilizar groupCountAccidents().
+        year : int                    -> Año que mostrar en el título.
+        classifier : Classifier       -> Clasificador de los rangos de colores.
+        county_count : pd.Dataframe   -> Si se indica, se colorean los condados según
+                                            groupCountAccidentsByCounty() y los estados
+                                            quedan solo como contorno. La leyenda
+                                            debe generarse entonces con 'county_count'.
+        measure : str                 -> Qué representar, según MEASURES: accidentes,
+                                            fallecidos, fallecidos por accidente...
+    """
+    
+    with RECORDER.span("render", figure = "mapa"):
+        
+        # Generación de la imagen vacía    
+        fig = plt.figure()
+        
+        ax, collection, _ = _drawMap(fig, accident_count, year, classifier, measure)
+        
+        if county_count is not None:
+            collection.set_facecolor("none")
+            CountyLayer(ax).update(county_count, classifier, MEASURES[measure][0])
+    
+    return fig
+
+
+def plotMapAccidentsLeyend(count_of_accidents : pd.DataFrame, extra_info : bool = True, 
+                           classifier : Classifier = CLASSIFIER, measure : str = "accidentes"):
+    """
+        Dibuja la leyenda del mapa generado por plotMapAccidents(),
+        generada aparte para no tapar el propio mapa.
+        
+        accident_count : pd.Dataframe -> Dataframe obtenido de CrashAPI, preprocesado, agrupado
+                                            por estados y con las observaciones contadas.
+                                            Se recomienda utilizar groupCountAccidents().
+        extra_info : bool             -> Por defecto True. Muestra información adicional sobre
+                                            los datos por la línea de comandos.
+        classifier : Classifier       -> Clasificador de los rangos de colores, el
+                                            mismo que en plotMapAccidents().
+        measure : str                 -> Qué se representa, según MEASURES.
+    """
+    
+    with RECORDER.span("render", figure = "leyenda"):
+        
+        # Generación de la imagen vacía  
+        fig = plt.figure(figsize = (3.5, 2.1))
+        
+        # Límites de los rangos, ya calculados si se ha dibujado el mapa con el mismo clasificador
+        column, decimals = MEASURES[measure]
+        _drawLegend(fig, classifier.labels(classifier.bounds(count_of_accidents[column]), measure, decimals))
+    
+    # Mostrar información adicional de la base de datos
+    if extra_info:
+        print(count_of_accidents.describe())
+    
+    return fig
+
+
+#%% CACHÉ DE IMÁGENES
+
+
+class RenderCache:
+    """
+        Imágenes ya dibujadas del mapa y la leyenda (regiones RGBA de
+        copy_from_bbox()), de la más a la menos usada, hasta ocupar como
+        mucho 'budget' bytes. Volver a un año, conjunto de estados o
+        esquema de colores ya vistos solo copia la imagen al canvas, sin
+        volver a dibujar las figuras.
+        
+        budget : int           -> Memoria máxima de las imágenes, en bytes.
+    """
+    
+    def __init__(self, budget : int = 64 * 1024**2):
+        self.budget = budget
+        
+        # Estadísticas de uso
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+    
+    
+    def get(self, key : str):
+        """
+            Imagen guardada con 'key', o None si no está.
+        """
+        with self._lock:
+            if key not in self._images:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._images.move_to_end(key)
+            return self._images[key][0]
+    
+    
+    def put(self, key : str, image, size : int):
+        """
+            Guarda una imagen de 'size' bytes, descartando las menos usadas
+            si no cabe. Las que no caben ni solas no se guardan.
+        """
+        if size > self.budget:
+            return
+        
+        with self._lock:
+            if key in self._images:
+                self.bytes -= self._images.pop(key)[1]
+            self._images[key] = (image, size)
+            self.bytes += size
+            
+            while self.bytes > self.budget:
+                self.bytes -= self._images.popitem(last = False)[1][1]
+    
+    
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.bytes = 0
+    
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._images), "bytes": self.bytes}
+
+
+# Caché de imágenes compartida por todos los mapas de la ventana
+RENDER_CACHE = RenderCache()
+RECORDER.watch("render cache", RENDER_CACHE.stats)
+
+
+#%% MAPA INTERACTIVO
+
+
+class MapView:
+    """
+        Mapa y leyenda persistentes. Las figuras, los ejes, la colección
+        de estados y la leyenda se crean una sola vez; cada nuevo año o
+        selección de estados solo cambia los colores, el título y el
+        texto de la leyenda, y pide un redibujado con draw_idle().
+        
+        Cada imagen dibujada se guarda en 'render_cache' según lo que
+        contiene: título, colores, vista y textos de la leyenda, y tamaño
+        del canvas. Si un nuevo dibujo coincide con uno guardado, la
+        imagen se copia directamente al canvas (restore_region() y blit())
+        en lugar de dibujarse de nuevo.
+        
+        En la ventana, la rueda del ratón acerca y aleja el mapa, arrastrar
+        lo mueve y un doble click vuelve a la vista completa.
+        
+        map_canvas : tk.Canvas    -> Canvas de Tk donde colocar el mapa.
+                                        Si es None, se dibuja sin ventana (Agg).
+        legend_canvas : tk.Canvas -> Canvas de Tk donde colocar la leyenda.
+        classifier : Classifier   -> Clasificador de los rangos de colores.
+                                        Se puede cambiar entre dibujos.
+        render_cache : RenderCache -> Caché de imágenes. None para no usarla.
+    """
+    
+    def __init__(self, map_canvas = None, legend_canvas = None, classifier : Classifier = CLASSIFIER, 
+                 render_cache : RenderCache = RENDER_CACHE):
+        
+        self.classifier = classifier
+        self.render_cache = render_cache
+        
+        # Figuras fuera de pyplot, para que no se acumulen en su registro
+        self.fig = Figure()
+        self.legend_fig = Figure(figsize = (3.5, 2.1))
+        
+        self.ax, self.collection, self.names = _drawMap(self.fig)
+        self.extent = (self.ax.get_xlim(), self.ax.get_ylim())
+        
+        # Capa de condados, creada la primera vez que se dibuja por condados
+        self.counties = None
+        self.legend = _drawLegend(self.legend_fig, classifier.labels(np.zeros(len(MAP_COLORS))))
+        
+        if map_canvas is None:
+            self.canvas = FigureCanvasAgg(self.fig)
+            self.legend_canvas = FigureCanvasAgg(self.legend_fig)
+        else:
+            # Colocar los dibujos en la ventana mediante embedding
+            self.canvas = FigureCanvasTkAgg(self.fig, map_canvas)
+            self.canvas.get_tk_widget().pack(side='top', fill='both', expand=1)
+            
+            self.legend_canvas = FigureCanvasTkAgg(self.legend_fig, legend_canvas)
+            self.legend_canvas.get_tk_widget().pack(side='top', fill='both', expand=1)
+        
+        # Con Tk el dibujado ocurre después de update(), cuando la ventana
+        # está libre. Se mide desde la petición hasta que termina de dibujarse
+        self._requested = {"mapa": None, "leyenda": None}
+        self._dragging = None
+        self.canvas.mpl_connect("draw_event", lambda event: self._drawn("mapa"))
+        self.legend_canvas.mpl_connect("draw_event", lambda event: self._drawn("leyenda"))
+        
+        # Acercar y mover el mapa con el ratón
+        self.canvas.mpl_connect("scroll_event", self._zoom)
+        self.canvas.mpl_connect("button_press_event", self._press)
+        self.canvas.mpl_connect("motion_notify_event", self._drag)
+        self.canvas.mpl_connect("button_release_event", self._release)
+    
+    
+    def _figure(self, figure : str) -> tuple:
+        """
+            Canvas y figura de "mapa" o "leyenda".
+        """
+        if figure == "mapa":
+            return self.canvas, self.fig
+        return self.legend_canvas, self.legend_fig
+    
+    
+    def _imageKey(self, figure : str) -> str:
+        """
+            Resumen de todo lo que se ve en la figura, que identifica su imagen.
+        """
+        canvas, fig = self._figure(figure)
+        
+        if figure == "mapa":
+            parts = [self.ax.get_title(), self.ax.get_xlim(), self.ax.get_ylim(), self.collection.get_facecolors()]
+            if self.counties is not None and self.counties.collection.get_visible():
+                parts += [self.counties._shown, self.counties.collection.get_facecolors()]
+        else:
+            parts = [[text.get_text() for text in self.legend.get_texts()]]
+        parts.append(tuple(fig.bbox.size))
+        
+        digest = hashlib.sha1()
+        for part in parts:
+            digest.update(part.tobytes() if isinstance(part, np.ndarray) else repr(part).encode())
+        return figure + "_" + digest.hexdigest()
+    
+    
+    def _restore(self, figure : str) -> bool:
+        """
+            Copia al canvas la imagen guardada de la figura, si la hay.
+        """
+        if self.render_cache is None:
+            return False
+        
+        image = self.render_cache.get(self._imageKey(figure))
+        if image is None:
+            return False
+        
+        canvas, fig = self._figure(figure)
+        with RECORDER.span("render", figure = figure, cached = True):
+            renderer = canvas.get_renderer()
+            if (renderer.width, renderer.height) != tuple(int(v) for v in fig.bbox.size):
+                return False
+            canvas.restore_region(image)
+            canvas.blit(fig.bbox)
+        
+        return True
+    
+    
+    def _drawn(self, figure : str):
+        if self._requested[figure] is not None:
+            RECORDER.record("render", self._requested[figure], figure = figure)
+            self._requested[figure] = None
+        
+        # Guardar la imagen recién dibujada, salvo mientras se arrastra el mapa
+        if self.render_cache is not None and self._dragging is None:
+            canvas, fig = self._figure(figure)
+            image = canvas.copy_from_bbox(fig.bbox)
+            self.render_cache.put(self._imageKey(figure), image, int(fig.bbox.width) * int(fig.bbox.height) * 4)
+    
+    
+    def _zoom(self, event):
+        """
+            Acerca o aleja el mapa manteniendo fijo el punto bajo el ratón.
+        """
+        if event.inaxes is not self.ax:
+            return
+        
+        factor = 1 / 1.25 if event.button == "up" else 1.25
+        (x0, x1), (y0, y1) = self.ax.get_xlim(), self.ax.get_ylim()
+        
+        self.ax.set_xlim(event.xdata - (event.xdata - x0) * factor, event.xdata + (x1 - event.xdata) * factor)
+        self.ax.set_ylim(event.ydata - (event.ydata - y0) * factor, event.ydata + (y1 - event.ydata) * factor)
+        self.canvas.draw_idle()
+    
+    
+    def _press(self, event):
+        if event.inaxes is not self.ax or event.button != 1:
+            return
+        
+        if event.dblclick:
+            self.ax.set_xlim(*self.extent[0])
+            self.ax.set_ylim(*self.extent[1])
+            self.canvas.draw_idle()
+            return
+        
+        self._dragging = (event.x, event.y, self.ax.get_xlim(), self.ax.get_ylim())
+        if self.counties is not None:
+            self.counties.coarse = True
+    
+    
+    def _drag(self, event):
+        """
+            Mueve el mapa lo mismo que el ratón desde que se pulsó.
+        """
+        if self._dragging is None:
+            return
+        
+        x, y, (x0, x1), (y0, y1) = self._dragging
+        dx = (event.x - x) * (x1 - x0) / self.ax.bbox.width
+        dy = (event.y - y) * (y1 - y0) / self.ax.bbox.height
+        
+        self.ax.set_xlim(x0 - dx, x1 - dx)
+        self.ax.set_ylim(y0 - dy, y1 - dy)
+        self.canvas.draw_idle()
+    
+    
+    def _release(self, event):
+        if self._dragging is None:
+            return
+        
+        # Al soltar, el detalle que corresponde a la vista
+        self._dragging = None
+        if self.counties is not None:
+            self.counties.coarse = False
+            self.counties.refresh()
+            self.canvas.draw_idle()
+    
+    
+    def update(self, accident_count : pd.DataFrame, year : int = None, county_count : pd.DataFrame = None, 
+               measure : str = "accidentes", draw : bool = True):
+        """
+            Recolorea el mapa y actualiza la leyenda con nuevos datos.
+            
+            accident_count : pd.Dataframe -> Observaciones contadas por estado.
+                                                Se recomienda utilizar groupCountAccidents().
+            year : int                    -> Año que mostrar en el título.
+            county_count : pd.Dataframe   -> Si se indica, se colorean los condados
+                                                según groupCountAccidentsByCounty()
+                                                y la leyenda es la de los condados.
+            measure : str                 -> Qué representar, según MEASURES. Todas
+                                                las medidas están ya en los recuentos,
+                                                así que cambiarla no vuelve a agrupar.
+            draw : bool                   -> Pedir el redibujado. False si después
+                                                se guardan con savefig(), que ya
+                                                las dibuja.
+        """
+        
+        column, decimals = MEASURES[measure]
+        
+        with RECORDER.span("render", figure = "colores", measure = measure):
+            if county_count is None:
+                self.collection.set_facecolors(_stateColors(self.names, accident_count, self.classifier, column))
+                if self.counties is not None:
+                    self.counties.set_visible(False)
+            else:
+                # Los estados quedan como contorno sobre los condados
+                if self.counties is None:
+                    self.counties = CountyLayer(self.ax)
+                self.collection.set_facecolor("none")
+                self.counties.update(county_count, self.classifier, column)
+                self.counties.set_visible(True)
+                accident_count = county_count
+            
+            self.ax.set_title(_mapTitle(year, measure))
+            
+            # Los límites ya están calculados por _stateColors()
+            labels = self.classifier.labels(self.classifier.bounds(accident_count[column]), measure, decimals)
+            for text, label in zip(self.legend.get_texts(), labels):
+                text.set_text(label)
+        
+        if not draw:
+            return
+        
+        # Dibujar solo las figuras cuya imagen no está ya guardada
+        for figure in ("mapa", "leyenda"):
+            if not self._restore(figure):
+                self._requested[figure] = RECORDER.now()
+                self._figure(figure)[0].draw_idle()
+    
+    
+    def close(self):
+        """
+            Quita los dibujos de la ventana.
+        """
+        if FigureCanvasTkAgg is not None and isinstance(self.canvas, FigureCanvasTkAgg):
+            self.canvas.get_tk_widget().destroy()
+            self.legend_canvas.get_tk_widget().destroy()
+
+
+#%% VARIOS AÑOS A LA VEZ
+
+
+def _mapExtent() -> tuple[tuple, tuple]:
+    """
+        Límites (xlim, ylim) del mapa de _drawMap() en MAP_PROJECTION.
+    """
+    ax = Figure().add_axes([0, 0, 1, 1], projection = MAP_PROJECTION)
+    ax.set_extent([-125, -66.5, 20, 50], ccrs.Geodetic())
+    return ax.get_xlim(), ax.get_ylim()
+
+
+class SmallMultiples:
+    """
+        Cuadrícula con un mapa pequeño por año, para comparar los años
+        entre sí. Todos los mapas usan la misma lista de contornos ya
+        proyectados de STATE_GEOMETRY y una única clasificación calculada
+        con los valores de todos los años, así que un color significa lo
+        mismo en cualquier mapa. Son ejes normales de matplotlib con los
+        límites del mapa completo, sin cartopy, y se crean una sola vez:
+        cada update() solo cambia los colores y los textos.
+        
+        canvas : tk.Canvas      -> Canvas de Tk donde colocar la cuadrícula.
+                                    Si es None, se dibuja sin ventana (Agg).
+        years : list[int]       -> Año de cada mapa.
+        classifier : Classifier -> Clasificador de los rangos de colores.
+                                    Se puede cambiar entre dibujos.
+        columns : int           -> Mapas por fila.
+    """
+    
+    def __init__(self, canvas = None, years : list[int] = YEARS, classifier : Classifier = CLASSIFIER, 
+                 columns : int = 4):
+        
+        self.years = list(years)
+        self.classifier = classifier
+        
+        rows = -(-len(self.years) // columns)
+        self.fig = Figure(figsize = (2 * columns, 1.3 * rows + 1.2))
+        self.fig.subplots_adjust(left = 0.01, right = 0.99, top = 0.9, bottom = 0.17, wspace = 0.02, hspace = 0.15)
+        self.title = self.fig.suptitle(_mapTitle())
+        
+        # Los mismos contornos para todos los mapas, simplificados una vez
+        # a medio píxel de un mapa pequeño a 100 ppp, lo que deja menos de
+        # la mitad de los vértices y del tiempo de dibujado
+        xlim, ylim = _mapExtent()
+        pixel = Affine2D().scale(100 * self.fig.get_figwidth() / columns / (xlim[1] - xlim[0]) / 4.5)
+        self.names, paths = STATE_GEOMETRY.paths()
+        paths = [pixel.inverted().transform_path(path.cleaned(transform = pixel, simplify = True)) for path in paths]
+        
+        self.collections = list()
+        for i, year in enumerate(self.years):
+            ax = self.fig.add_subplot(rows, columns, i + 1)
+            ax.set_axis_off()
+            ax.set_xlim(*xlim)
+            ax.set_ylim(*ylim)
+            ax.set_aspect("equal")
+            # Con 'y' fijo, matplotlib no recoloca el título midiendo los ejes en cada dibujo
+            ax.set_title(str(year), fontsize = 8, pad = 2, y = 1.0)
+            
+            self.collections.append(ax.add_collection(PathCollection(paths, 
+                                                                     facecolors = MAP_COLORS[0], 
+                                                                     edgecolors = 'black', 
+                                                                     linewidths = 0.2,
+                                                                     transform = ax.transData),
+                                                      autolim = False))
+        
+        # Una sola leyenda para toda la cuadrícula
+        legend_info = [mpatches.Patch(facecolor = color, edgecolor = 'black', linewidth = 0.3, label = label) 
+                       for color, label in zip(MAP_COLORS, self.classifier.labels(np.zeros(len(MAP_COLORS))))]
+        self.legend = self.fig.legend(handles = legend_info, loc = 'lower center', ncol = 3, 
+                                      fontsize = 6, frameon = False)
+        
+        if canvas is None:
+            self.canvas = FigureCanvasAgg(self.fig)
+        else:
+            self.canvas = FigureCanvasTkAgg(self.fig, canvas)
+            self.canvas.get_tk_widget().pack(side='top', fill='both', expand=1)
+        
+        # Se mide desde la petición hasta que termina de dibujarse, como en MapView
+        self._requested = None
+        self.canvas.mpl_connect("draw_event", lambda event: self._drawn())
+    
+    
+    def _drawn(self):
+        if self._requested is not None:
+            RECORDER.record("render", self._requested, figure = "años")
+            self._requested = None
+    
+    
+    def update(self, year_count : pd.DataFrame, measure : str = "accidentes", label : str = None, 
+               draw : bool = True):
+        """
+            Recolorea todos los mapas con una clasificación común.
+            
+            year_count : pd.Dataframe -> Valores con los estados como índice y
+                                            los años como columnas, como
+                                            AccidentCube.countByYear() con la
+                                            columna de 'measure'.
+            measure : str             -> Qué se representa, según MEASURES.
+            label : str               -> Texto que añadir al título, por
+                                            ejemplo el periodo elegido.
+            draw : bool               -> Pedir el redibujado. False si después
+                                            se guarda con savefig().
+        """
+        
+        with RECORDER.span("classify", figure = "años"):
+            # Matriz estados x años en el orden de los contornos
+            values = year_count.reindex(index = self.names, columns = self.years).fillna(0).to_numpy()
+            
+            # Límites con los valores de todos los años a la vez, sin las
+            # celdas vacías, como el mapa de un año sin estados sin accidentes
+            cells = year_count.to_numpy().ravel()
+            bounds = self.classifier.bounds(cells[cells > 0])
+            classes = self.classifier.classify(values.ravel(), bounds).reshape(values.shape)
+            colors = np.array(MAP_COLORS)[classes]
+        
+        for i, collection in enumerate(self.collections):
+            collection.set_facecolor(colors[:, i])
+        
+        title = _mapTitle(None, measure) + ' (' + str(self.years[0]) + '-' + str(self.years[-1]) + ')'
+        self.title.set_text(title if label is None else title + ', ' + label)
+        
+        labels = self.classifier.labels(bounds, measure, MEASURES[measure][1])
+        for text, text_label in zip(self.legend.get_texts(), labels):
+            text.set_text(text_label)
+        
+        if draw:
+            self._requested = RECORDER.now()
+            self.canvas.draw_idle()
+    
+    
+    def close(self):
+        if FigureCanvasTkAgg is not None and isinstance(self.canvas, FigureCanvasTkAgg):
+            self.canvas.get_tk_widget().destroy()
+
+
+#%% DIBUJADO SIN INTERFAZ GRÁFICA
+
+
+# Mapa y clasificadores reutilizados por cada proceso de dibujado
+_WORKER_VIEW = None
+_WORKER_CLASSIFIERS = dict()
+
+
+def _workerView(accident_count : pd.DataFrame, year : int, scheme : str, measure : str) -> MapView:
+    """
+        MapView del proceso, creado la primera vez y recoloreado con los
+        datos de cada tarea. No se dibuja aquí: lo hace savefig() al guardar.
+    """
+    global _WORKER_VIEW
+    
+    if _WORKER_VIEW is None:
+        # savefig() siempre vuelve a dibujar, así que la caché de imágenes no sirve aquí
+        _WORKER_VIEW = MapView(render_cache = None)
+    if scheme not in _WORKER_CLASSIFIERS:
+        _WORKER_CLASSIFIERS[scheme] = Classifier(scheme)
+    
+    _WORKER_VIEW.classifier = _WORKER_CLASSIFIERS[scheme]
+    _WORKER_VIEW.update(accident_count, year, measure = measure, draw = False)
+    
+    return _WORKER_VIEW
+
+
+def _renderTask(task : tuple) -> list[str]:
+    """
+        Dibuja y guarda el mapa y la leyenda de un año y un conjunto de
+        estados. Se ejecuta en los procesos de renderBatch(), cada uno con
+        su propio MapView que solo se recolorea entre tareas.
+        
+        task : tuple           -> (accident_count, year, prefix, formats, dpi, scheme, measure)
+    """
+    accident_count, year, prefix, formats, dpi, scheme, measure = task
+    
+    _workerView(accident_count, year, scheme, measure)
+    
+    written = list()
+    for extension in formats:
+        for fig, name in ((_WORKER_VIEW.fig, "mapa"), (_WORKER_VIEW.legend_fig, "leyenda")):
+            path = prefix.replace("{figura}", name) + "." + extension
+            fig.savefig(path, dpi = dpi)
+            written.append(path)
+    
+    return written
+
+
+def renderImages(task : tuple) -> dict:
+    """
+        Dibuja el mapa y la leyenda de un año y un conjunto de estados y
+        devuelve {"mapa": bytes, "leyenda": bytes} con las imágenes en el
+        formato pedido. Se ejecuta en los procesos del servicio HTTP
+        (ver service.py), igual que _renderTask().
+        
+        task : tuple           -> (accident_count, year, extension, dpi, scheme, measure)
+    """
+    accident_count, year, extension, dpi, scheme, measure = task
+    
+    view = _workerView(accident_count, year, scheme, measure)
+    
+    images = dict()
+    for fig, name in ((view.fig, "mapa"), (view.legend_fig, "leyenda")):
+        buffer = io.BytesIO()
+        with RECORDER.span("render", figure = name, format = extension):
+            fig.savefig(buffer, format = extension, dpi = dpi)
+        images[name] = buffer.getvalue()
+    
+    return images
+
+
+def renderBatch(years : list[int], state_sets : dict, out_dir : str, formats : list[str] = ("png",), 
+                jobs : int = None, dpi : int = 100, request_together : int = None, 
+                scheme : str = "mediana", measure : str = "accidentes") -> list[str]:
+    """
+        Genera sin interfaz gráfica las imágenes del mapa y la leyenda para
+        cada año y cada conjunto de estados, repartiendo el dibujado entre
+        varios procesos. Los datos se piden una sola vez en este proceso
+        (quedando en la caché de disco) y los contornos proyectados se
+        preparan antes de repartir, por lo que los procesos solo cargan
+        los contornos de disco y dibujan.
+        
+        years : list[int]      -> Años que dibujar.
+        state_sets : dict      -> {nombre: lista de estados según STATE_CODES}.
+                                    El nombre forma parte del fichero generado.
+        out_dir : str          -> Carpeta donde guardar las imágenes.
+        formats : list[str]    -> Formatos de imagen, por ejemplo ["png", "svg"].
+        jobs : int             -> Número de procesos. Por defecto, uno por núcleo.
+        dpi : int              -> Resolución de las imágenes.
+        request_together : int -> Número de estados que pedir juntos a CrashAPI.
+                                    Por defecto, según crashdata.BATCH_SIZER.
+        scheme : str           -> Esquema de clasificación de los colores,
+                                    según classification.SCHEMES.
+        measure : str          -> Qué representar, según MEASURES.
+    """
+    
+    # Comprobar el esquema y la medida antes de pedir ningún dato
+    Classifier(scheme)
+    if measure not in MEASURES:
+        raise ValueError("La medida debe ser una de: " + ", ".join(MEASURES))
+    
+    os.makedirs(out_dir, exist_ok = True)
+    
+    # Proyectar los contornos una vez para que los procesos los lean de disco
+    STATE_GEOMETRY.paths()
+    
+    # Obtener y contar los datos de todos los años y conjuntos de estados
+    tasks = list()
+    for year in years:
+        for set_name, states in state_sets.items():
+            df = preprocess(getDataframe(states, year, request_together, columns = PREPROCESS_COLUMNS))
+            prefix = os.path.join(out_dir, "{figura}_" + str(year) + "_" + set_name)
+            tasks.append((groupCountAccidents(df), year, prefix, formats, dpi, scheme, measure))
+    
+    # Procesos nuevos (spawn), como en service.py: copiar con fork un proceso
+    # con matplotlib cargado e hilos en marcha no es seguro
+    with ProcessPoolExecutor(max_workers = jobs, mp_context = multiprocessing.get_context("spawn")) as executor:
+        return [path for written in executor.map(_renderTask, tasks) for path in written]
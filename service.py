@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+Servicio HTTP local con los conteos, mapas y leyendas del visualizador,
+para que varios usuarios los consulten a la vez desde el navegador sin
+abrir cada uno la interfaz gráfica ni pedir cada uno los datos a CrashAPI.
+
+    GET /counts?year=2014&states=1,6       -> groupCountAccidents() en JSON
+    GET /map.png?year=2014&states=todos    -> Mapa (png, svg o pdf)
+    GET /legend.png?year=2014&states=todos -> Leyenda (png, svg o pdf)
+    GET /stats                             -> Estadísticas de las cachés
+
+Los mapas y leyendas admiten además 'scheme' (classification.SCHEMES) y
+'measure' (crashdata.MEASURES). Los conteos y las imágenes se guardan en
+cachés compartidas por todos los clientes, y las peticiones simultáneas
+de lo mismo esperan a un único cálculo. El dibujado se reparte entre
+varios procesos.
+"""
+
+from __future__ import annotations
+
+#%% DEPENDENCIAS
+
+
+# Servidor HTTP asíncrono
+import json
+import asyncio
+import hashlib
+import multiprocessing
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from crashdata import STATE_CODES, YEARS, MEASURES, PREPROCESS_COLUMNS, getDataframe
+from aggregation import preprocess, groupCountAccidents
+from classification import SCHEMES
+from rendering import STATE_GEOMETRY, RenderCache, renderImages
+from instrumentation import RECORDER
+
+
+# Formatos de imagen y su tipo MIME
+IMAGE_TYPES = {"png": "image/png", "svg": "image/svg+xml", "pdf": "application/pdf"}
+
+# Nombre de cada figura en la dirección y en renderImages()
+FIGURES = {"map": "mapa", "legend": "leyenda"}
+
+_STATE_NAMES = {code: name for name, code in STATE_CODES.items()}
+
+
+#%% PETICIONES COMPARTIDAS
+
+
+class Coalescer:
+    """
+        Agrupa las peticiones simultáneas de una misma clave en un único
+        cálculo: la primera lo lanza y las demás esperan a su resultado.
+        El cálculo no se cancela aunque se desconecte quien lo lanzó.
+    """
+    
+    def __init__(self):
+        # Estadísticas de uso
+        self.started = 0
+        self.coalesced = 0
+        
+        self._running = dict()
+    
+    
+    async def run(self, key, compute):
+        """
+            Resultado de 'compute()', una corrutina, para 'key'.
+        """
+        task = self._running.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.started += 1
+            task = asyncio.ensure_future(compute())
+            self._running[key] = task
+            task.add_done_callback(lambda _: self._running.pop(key, None))
+        
+        return await asyncio.shield(task)
+    
+    
+    def stats(self) -> dict:
+        return {"started": self.started, "coalesced": self.coalesced, "running": len(self._running)}
+
+
+#%% SERVICIO
+
+
+def _parseStates(text : str) -> tuple[int]:
+    """
+        Convierte "todos" o "1,6" (códigos o nombres de STATE_CODES) en
+        una tupla ordenada de estados, para usarla como clave.
+    """
+    if text in ("todos", "all"):
+        return tuple(sorted(STATE_CODES.values()))
+    
+    codes = set()
+    for state in text.split(","):
+        state = state.strip()
+        code = int(state) if state.isdigit() else STATE_CODES.get(state)
+        if code not in _STATE_NAMES:
+            raise ValueError("Estado desconocido: " + state)
+        codes.add(code)
+    return tuple(sorted(codes))
+
+
+def _parseQuery(query : str) -> tuple[int, tuple[int], str, str]:
+    """
+        Año, estados, esquema y medida de la consulta de una dirección.
+    """
+    params = {name: values[-1] for name, values in parse_qs(query).items()}
+    
+    try:
+        year = int(params.get("year", 2014))
+    except ValueError:
+        raise ValueError("El año debe ser un número") from None
+    if year not in YEARS:
+        raise ValueError("El año debe estar entre " + str(YEARS[0]) + " y " + str(YEARS[-1]))
+    
+    scheme = params.get("scheme", "mediana")
+    if scheme not in SCHEMES:
+        raise ValueError("El esquema debe ser uno de: " + ", ".join(SCHEMES))
+    
+    measure = params.get("measure", "accidentes")
+    if measure not in MEASURES:
+        raise ValueError("La medida debe ser una de: " + ", ".join(MEASURES))
+    
+    return year, _parseStates(params.get("states", "todos")), scheme, measure
+
+
+class MapService:
+    """
+        Servicio HTTP asíncrono del visualizador (ver el comienzo del módulo).
+        Los datos se piden y se cuentan en hilos de este proceso, con la
+        caché de CrashAPI compartida, y las figuras se dibujan en 'jobs'
+        procesos que reutilizan su MapView entre peticiones.
+        
+        host : str             -> Dirección en la que escuchar.
+        port : int             -> Puerto. 0 para elegir uno libre.
+        jobs : int             -> Procesos de dibujado. Por defecto, uno por núcleo.
+        dpi : int              -> Resolución de las imágenes.
+        image_budget : int     -> Memoria máxima de las imágenes guardadas, en bytes.
+        count_budget : int     -> Memoria máxima de los conteos guardados, en bytes.
+    """
+    
+    def __init__(self, host : str = "127.0.0.1", port : int = 8080, jobs : int = None, dpi : int = 100,
+                 image_budget : int = 128 * 1024**2, count_budget : int = 16 * 1024**2):
+        self.host = host
+        self.port = port
+        self.jobs = jobs
+        self.dpi = dpi
+        
+        self.counts = RenderCache(count_budget)
+        self.images = RenderCache(image_budget)
+        self.coalescer = Coalescer()
+        
+        # Estadísticas de uso
+        self.requests = 0
+        self.not_modified = 0
+        
+        self._pool = None
+        self._threads = None
+        self._server = None
+        
+        RECORDER.watch("service counts", self.counts.stats)
+        RECORDER.watch("service images", self.images.stats)
+        RECORDER.watch("service coalescing", self.coalescer.stats)
+    
+    
+    @staticmethod
+    def _count(year : int, states : tuple[int]):
+        """
+            Pide y cuenta los accidentes de un año y unos estados.
+        """
+        df = getDataframe(list(states), year, columns = PREPROCESS_COLUMNS)
+        if df is None or len(df) == 0:
+            raise LookupError("No hay datos de " + str(year) + " para esos estados")
+        return groupCountAccidents(preprocess(df))
+    
+    
+    async def accidentCount(self, year : int, states : tuple[int]):
+        """
+            Resultado de groupCountAccidents() de un año y unos estados.
+        """
+        key = ("counts", year, states)
+        accident_count = self.counts.get(key)
+        if accident_count is not None:
+            return accident_count
+        
+        async def compute():
+            loop = asyncio.get_running_loop()
+            accident_count = await loop.run_in_executor(self._threads, self._count, year, states)
+            self.counts.put(key, accident_count, int(accident_count.memory_usage(deep = True).sum()))
+            return accident_count
+        
+        return await self.coalescer.run(key, compute)
+    
+    
+    async def image(self, figure : str, extension : str, year : int, states : tuple[int],
+                    scheme : str, measure : str) -> bytes:
+        """
+            Imagen del mapa o la leyenda. Las dos figuras se dibujan y se
+            guardan juntas, porque se suelen pedir a la vez.
+            
+            figure : str           -> "mapa" o "leyenda".
+            extension : str        -> Formato, según IMAGE_TYPES.
+        """
+        key = (extension, year, states, scheme, measure)
+        image = self.images.get((figure,) + key)
+        if image is not None:
+            return image
+        
+        async def compute():
+            accident_count = await self.accidentCount(year, states)
+            loop = asyncio.get_running_loop()
+            images = await loop.run_in_executor(self._pool, renderImages,
+                                                (accident_count, year, extension, self.dpi, scheme, measure))
+            for name, data in images.items():
+                self.images.put((name,) + key, data, len(data))
+            return images
+        
+        return (await self.coalescer.run(("images",) + key, compute))[figure]
+    
+    
+    async def _route(self, target : str) -> tuple[int, str, bytes]:
+        """
+            Estado HTTP, tipo y cuerpo de la respuesta a 'target'.
+        """
+        url = urlsplit(target)
+        name, _, extension = url.path.strip("/").partition(".")
+        
+        try:
+            if name == "counts":
+                year, states, _, _ = _parseQuery(url.query)
+                accident_count = await self.accidentCount(year, states)
+                body = {"year": year, "states": list(states),
+                        "counts": accident_count.to_dict(orient = "index")}
+                return 200, "application/json", json.dumps(body, ensure_ascii = False).encode()
+            
+            if name in FIGURES and extension in IMAGE_TYPES:
+                image = await self.image(FIGURES[name], extension, *_parseQuery(url.query))
+                return 200, IMAGE_TYPES[extension], image
+            
+            if name == "stats":
+                summary = RECORDER.summary()
+                body = {"requests": self.requests, "not_modified": self.not_modified,
+                        "counters": summary["counters"], "sources": summary["sources"]}
+                return 200, "application/json", json.dumps(body, default = str).encode()
+        
+        except ValueError as error:
+            return 400, "application/json", json.dumps({"error": str(error)}).encode()
+        except LookupError as error:
+            return 404, "application/json", json.dumps({"error": str(error)}).encode()
+        except Exception as error:
+            # Fallos de CrashAPI o del dibujado
+            return 502, "application/json", json.dumps({"error": repr(error)}).encode()
+        
+        return 404, "application/json", json.dumps({"error": "No existe " + url.path}).encode()
+    
+    
+    async def _client(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        """
+            Atiende las peticiones de una conexión, que se mantiene abierta
+            entre peticiones con HTTP/1.1.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    header, _, value = line.decode("latin-1").partition(":")
+                    headers[header.strip().lower()] = value.strip()
+                
+                self.requests += 1
+                
+                with RECORDER.span("service", path = target) as info:
+                    if method != "GET":
+                        status, content_type, body = 405, "application/json", b'{"error": "Solo GET"}'
+                    else:
+                        status, content_type, body = await self._route(target)
+                    info["status"] = status
+                
+                # Las imágenes y conteos no cambian: revalidar por ETag sin reenviarlos
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                if status == 200 and headers.get("if-none-match") == etag:
+                    self.not_modified += 1
+                    status, body = 304, b""
+                
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                reason = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+                          405: "Method Not Allowed", 502: "Bad Gateway"}[status]
+                
+                head = ["HTTP/1.1 " + str(status) + " " + reason,
+                        "Content-Type: " + content_type,
+                        "Content-Length: " + str(len(body)),
+                        "ETag: " + etag,
+                        "Connection: " + ("keep-alive" if keep_alive else "close")]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+                await writer.drain()
+                
+                if not keep_alive:
+                    break
+        
+        except (ConnectionError, ValueError):
+            # Conexión cortada o petición mal formada
+            pass
+        finally:
+            writer.close()
+    
+    
+    async def start(self) -> MapService:
+        """
+            Prepara los procesos de dibujado y empieza a escuchar.
+        """
+        # Proyectar los contornos una vez para que los procesos los lean de disco
+        STATE_GEOMETRY.paths()
+        
+        # Procesos nuevos y no copias de este, que ya tiene hilos en marcha
+        self._pool = ProcessPoolExecutor(max_workers = self.jobs, mp_context = multiprocessing.get_context("spawn"))
+        self._threads = ThreadPoolExecutor(max_workers = 8)
+        
+        self._server = await asyncio.start_server(self._client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+    
+    
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._pool.shutdown(cancel_futures = True)
+        self._threads.shutdown(cancel_futures = True)
+    
+    
+    @property
+    def url(self) -> str:
+        return "http://" + self.host + ":" + str(self.port)
+    
+    
+    async def serveForever(self, ready = None):
+        """
+            Atiende peticiones hasta que se cancele.
+            
+            ready : callable       -> Función ready(servicio) al empezar a escuchar.
+        """
+        await self.start()
+        try:
+            if ready is not None:
+                ready(self)
+            await self._server.serve_forever()
+        finally:
+            await self.stop()